@@ -0,0 +1,127 @@
+"""
+Measures what moving nova instance rows to the aggregation workers costs
+the API worker against aggregating them in process.
+
+    python benchmark-aggregate.py --rows 20000 --processes 4
+
+The transfer cost is everything the API worker does for the workers:
+sharding, packing and pickling the rows, unpickling the results. The round
+trip is the fixed cost of a report through the pool. The break even is the
+report size from which a pooled report finishes before one aggregated in
+process, with a core idle for each process.
+"""
+import argparse
+import datetime
+import timeit
+
+from six.moves import cPickle as pickle
+
+from os_usage.nova import aggregate
+
+START = datetime.datetime(2016, 1, 1)
+STOP = datetime.datetime(2016, 2, 1)
+
+
+def make_rows(count, tenants):
+    """Build aggregation rows.
+
+    :param count: Integer
+    :param tenants: Integer
+    :returns: List of dicts - see aggregate.slim_row
+    """
+    rows = []
+    for i in range(count):
+        launched_at = START + datetime.timedelta(minutes=i % 40000)
+        instance = {
+            'uuid': 'server-{0:08d}'.format(i),
+            'display_name': 'server-{0}'.format(i),
+            'memory_mb': 2048,
+            'root_gb': 20,
+            'ephemeral_gb': 0,
+            'vcpus': 2,
+            'project_id': 'tenant-{0:06d}'.format(i % tenants),
+            'host': 'compute-{0:03d}'.format(i % 100),
+            'launched_at': launched_at,
+            'terminated_at': (None if i % 3 else
+                              launched_at + datetime.timedelta(days=1)),
+            'vm_state': 'active'
+        }
+        rows.append(aggregate.slim_row(instance, {'name': 'm1.small'}))
+    return rows
+
+
+def send(rows, processes, detailed):
+    """Pack and pickle the shards of a report as sent to the workers.
+
+    :param rows: List of dicts
+    :param processes: Integer
+    :param detailed: Boolean
+    """
+    args = (START, STOP, STOP)
+    for shard_rows in aggregate.shard(rows, processes):
+        aggregate.dumps((aggregate.tenant_usages,
+                         aggregate.pack(shard_rows),
+                         args, {'detailed': detailed}))
+
+
+def replies(rows, detailed):
+    """Pickle the result of a report as a worker would reply it.
+
+    :param rows: List of dicts
+    :param detailed: Boolean
+    :returns: Bytes
+    """
+    result = aggregate.tenant_usages(rows, START, STOP, STOP,
+                                     detailed=detailed)
+    return aggregate.dumps((True, result))
+
+
+def best(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--tenants', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.tenants)
+    round_trip = best(
+        lambda: aggregate.aggregate(aggregate.tenant_usages, rows[:1],
+                                    START, STOP, processes=args.processes,
+                                    detailed=False),
+        args.repeat
+    )
+    print("{0} rows, {1} processes, round trip {2:.2f}ms".format(
+        args.rows, args.processes, round_trip * 1000
+    ))
+    for detailed in (False, True):
+        in_process = best(
+            lambda: aggregate.tenant_usages(rows, START, STOP, STOP,
+                                            detailed=detailed),
+            args.repeat
+        )
+        sent = best(lambda: send(rows, args.processes, detailed),
+                    args.repeat)
+        data = replies(rows, detailed)
+        received = best(lambda: pickle.loads(data), args.repeat)
+        transfer = sent + received
+        # A pooled report waits for the transfer and for the share of one
+        # worker, the round trip is paid once.
+        per_row = (in_process * (1 - 1.0 / args.processes) -
+                   transfer) / args.rows
+        even = ("{0:.0f} rows".format(round_trip / per_row)
+                if per_row > 0 else "never")
+        print("detailed={0}: in process {1:.2f}us/row, transfer "
+              "{2:.2f}us/row, break even {3}".format(
+                  detailed, in_process * 1e6 / args.rows,
+                  transfer * 1e6 / args.rows, even
+              ))
+    aggregate.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares decoding a nova usage payload through novaclient Resources with
+the raw row translation used by the usage clients.
+
+    python benchmark-translate.py --tenants 5000 --servers 20
+"""
+import argparse
+import json
+import timeit
+
+from os_usage.nova.client import Usage
+from os_usage.nova.client import UsageClient
+
+
+def make_payload(tenants, servers):
+    """Build a detailed tenant usage response body.
+
+    :param tenants: Integer
+    :param servers: Integer - server usages per tenant
+    :returns: String
+    """
+    rows = []
+    for t in range(tenants):
+        tenant_id = 'tenant-{0:06d}'.format(t)
+        rows.append({
+            'tenant_id': tenant_id,
+            'total_hours': 24.0 * servers,
+            'total_local_gb_usage': 480.0 * servers,
+            'total_memory_mb_usage': 49152.0 * servers,
+            'total_vcpus_usage': 48.0 * servers,
+            'start': '2016-01-01T00:00:00',
+            'stop': '2016-01-02T00:00:00',
+            'server_usages': [{
+                'instance_id': '{0}-{1:04d}'.format(tenant_id, s),
+                'name': 'server-{0}'.format(s),
+                'hours': 24.0,
+                'memory_mb': 2048,
+                'local_gb': 20,
+                'vcpus': 2,
+                'tenant_id': tenant_id,
+                'flavor': 'm1.small',
+                'started_at': '2015-12-01T00:00:00',
+                'ended_at': None,
+                'state': 'active',
+                'uptime': 86400
+            } for s in range(servers)]
+        })
+    return json.dumps({'tenant_usages': rows})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--tenants', type=int, default=2000)
+    parser.add_argument('--servers', type=int, default=10,
+                        help="Server usages per tenant.")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    payload = make_payload(args.tenants, args.servers)
+    rows = json.loads(payload)['tenant_usages']
+    client = UsageClient(None)
+
+    # Both paths decode the same JSON, it is timed once on its own.
+    def decode():
+        return json.loads(payload)
+
+    def resources():
+        return client.to_dict([Usage(client, row, loaded=True)
+                               for row in rows if row])
+
+    def raw():
+        return client.rows_to_dict(rows)
+
+    assert resources() == raw()
+    print("payload: {0} tenants, {1} servers each, {2} bytes".format(
+        args.tenants, args.servers, len(payload)
+    ))
+    for name, func in (('decode', decode), ('resources', resources),
+                       ('raw', raw)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("{0:>9}: {1:.3f}s".format(name, best))
+
+
+if __name__ == '__main__':
+    main()
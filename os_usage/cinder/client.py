@@ -2,11 +2,36 @@
 This module provides a class to be used in conjunction with the
 python-cinderclient.
 """
+import json
 import six
 from six.moves.urllib import parse
 
 from cinderclient import base
 
+from os_usage.common import job_client
+from os_usage.common import json_stream
+from os_usage.common import store as usage_store
+from os_usage.common.http_cache import ByteCounter
+from os_usage.common.http_cache import cached_get
+from os_usage.common.usage_dict import Schema
+from os_usage.common.usage_dict import add_tenant_usage
+from os_usage.common.usage_dict import get_group
+from os_usage.common.usage_dict import translate
+from os_usage.common.windows import fetch_windows
+
+
+SCHEMA = Schema(
+    tenant_key='project_id',
+    metrics=(
+        'total_gb_usage',
+        'total_hours'
+    ),
+    resources_key='volume_usages'
+)
+
+USAGE_PATH = '/usages'
+JOBS_PATH = '/usage_jobs'
+
 
 class Usage(base.Resource):
     def __repr__(self):
@@ -17,7 +42,20 @@ class UsageClient(base.ManagerWithFind):
     """Classs to be used with python-cinderclient."""
     resource_class = Usage
 
-    def list(self, start, end, metadata=None):
+    def __init__(self, api, cache=None):
+        """Inits the usage client.
+
+        :param api: cinderclient.client.Client
+        :param cache: os_usage.common.http_cache.ResponseCache|None -
+            revalidate and reuse tagged responses
+        """
+        super(UsageClient, self).__init__(api)
+        self.cache = cache
+        # Body bytes of every usage response received.
+        self.received = ByteCounter()
+
+    def list(self, start, end, metadata=None, detailed=False, split=1,
+             concurrency=None, group_by_metadata=None, breakdown=None):
         """List volume usages.
 
         List volume usages between start and end that also have the provided
@@ -25,16 +63,119 @@ class UsageClient(base.ManagerWithFind):
 
         :param start: Datetime
         :param end: Datetime
-        :param metadata: json
+        :param metadata: Dict|None - filter, see os_usage.common.metadata
+        :param detailed: Boolean - Add volume information to query
+        :param split: Integer - split the range into this many sub windows
+            requested in parallel and merged
+        :param concurrency: Integer|None - max sub windows requested at once
+        :param group_by_metadata: String|None - also report usage per value
+            of this metadata key under 'groups'
+        :param breakdown: String|None - also report usage per volume_type under
+            'groups'
+        """
+        if split > 1:
+            return fetch_windows(
+                lambda s, e: self.list(s, e, metadata=metadata,
+                                       detailed=detailed,
+                                       group_by_metadata=group_by_metadata,
+                                       breakdown=breakdown),
+                start, end, split, concurrency
+            )
+
+        return cached_get(
+            self.cache, self.api.client,
+            self._url(start, end, metadata, detailed, group_by_metadata,
+                      breakdown),
+            lambda resp, body: self.rows_to_dict(body['tenant_usages']),
+            self.received
+        )
+
+    def iter_list(self, start, end, metadata=None, detailed=False,
+                  group_by_metadata=None, breakdown=None,
+                  chunk_size=json_stream.CHUNK_SIZE,
+                  raw_resources=False):
+        """Stream volume usages between start and end.
+
+        Rows are decoded as the response arrives instead of after the whole
+        body is read. Grouped rows of a tenant are yielded separately.
+
+        :param start: Datetime
+        :param end: Datetime
+        :param metadata: Dict|None - filter, see os_usage.common.metadata
+        :param detailed: Boolean - Add volume information to query
+        :param group_by_metadata: String|None
+        :param breakdown: String|None
+        :param chunk_size: Integer - bytes read at a time
+        :param raw_resources: Boolean - keep the resource usages of each
+            row as a json_stream.RawList instead of decoding them
+        :yields: Dict - usage dict of one response row
+        """
+        url = self._url(start, end, metadata, detailed, group_by_metadata,
+                        breakdown)
+        raw_key = SCHEMA.resources_key if raw_resources else None
+        for row in json_stream.stream_items(self.api.client, url,
+                                            'tenant_usages', chunk_size,
+                                            raw_key, self.received):
+            yield self.rows_to_dict([row])
+
+    def submit_job(self, start, end, metadata=None, detailed=False,
+                   group_by_metadata=None, breakdown=None):
+        """Submit a report job computing volume usages in the background.
+
+        Takes the same arguments as list without splitting.
+
+        :returns: String - job id
+        """
+        url = self._url(start, end, metadata, detailed, group_by_metadata,
+                        breakdown, path=JOBS_PATH)
+        return job_client.submit_job(self.api.client, url)['id']
+
+    def get_job(self, job_id):
+        """Get a report job.
+
+        :param job_id: String
+        :returns: Dict - the job, with its result once done
+        """
+        return job_client.get_job(self.api.client, self._job_url(job_id))
+
+    def wait_for_job(self, job_id, interval=job_client.POLL_INTERVAL,
+                     timeout=None):
+        """Wait for a report job and get its result.
+
+        :param job_id: String
+        :param interval: Float - seconds between polls
+        :param timeout: Float|None - seconds to wait, None waits forever
+        :returns: Dict - usage dict of the report
+        :raises: os_usage.common.job_client.JobFailed,
+            os_usage.common.job_client.JobTimeout
+        """
+        job = job_client.wait_for_job(self.api.client, self._job_url(job_id),
+                                      interval, timeout)
+        return self.rows_to_dict(job['result']['tenant_usages'])
+
+    def _job_url(self, job_id):
+        return '{0}/{1}'.format(JOBS_PATH, parse.quote(job_id))
+
+    def _url(self, start, end, metadata, detailed, group_by_metadata,
+             breakdown, path=USAGE_PATH):
+        """Build the url of a volume usage request.
+
+        :returns: String
         """
         if metadata is None:
             metadata = {}
 
         opts = {
             'start': start.isoformat(),
-            'end': end.isoformat()
+            'end': end.isoformat(),
+            'detailed': int(bool(detailed)),
+            'group_by_metadata': group_by_metadata,
+            'breakdown': breakdown
         }
 
+        if isinstance(metadata, dict):
+            metadata = json.dumps(metadata)
+
         if metadata:
             opts['metadata'] = metadata
 
@@ -46,10 +187,22 @@ class UsageClient(base.ManagerWithFind):
                 qparams[opt] = val
 
         query_string = '?%s' % parse.urlencode(qparams)
-        resp = self._list(
-            "/usages%s" % (query_string), 'tenant_usages'
-        )
-        return self.to_dict(resp)
+        return "%s%s" % (path, query_string)
+
+    def scope(self):
+        """Get the endpoint, project and user usage is read with.
+
+        :returns: Dict - see os_usage.common.store.client_scope
+        """
+        return usage_store.client_scope(self.api.client)
+
+    def rows_to_dict(self, rows):
+        """Translates raw volume usage rows into a usage dict.
+
+        :param rows: List of dicts - decoded tenant_usages
+        :returns: Dict
+        """
+        return translate(rows, SCHEMA)
 
     def to_dict(self, resp):
         """Translates response into dictionary.
@@ -57,21 +210,15 @@ class UsageClient(base.ManagerWithFind):
         :param resp: List
         :returns: Dict
         """
-        attrs = [
-            'total_gb_usage',
-            'total_hours'
-        ]
+        attrs = SCHEMA.metrics
         usage = {}
         for tenant_usage in resp:
-            tenant_id = tenant_usage.project_id
-            usage[tenant_id] = {
-                'metrics': {},
-                'resource_usages': []
-            }
-            for attr in attrs:
-                usage[tenant_id]['metrics'][attr] = \
-                    getattr(tenant_usage, attr, 0)
-            usage[tenant_id]['resource_usages'].extend(
-                getattr(tenant_usage, 'volume_usages', [])
+            get = lambda name, default: getattr(tenant_usage, name, default)
+            add_tenant_usage(
+                usage,
+                tenant_usage.project_id,
+                dict((attr, get(attr, 0)) for attr in attrs),
+                get('volume_usages', []),
+                get_group(get)
             )
         return usage
@@ -4,14 +4,14 @@ from magic_the_decorating.decorator import Base as BaseDecorator
 class _RouterDecorator(BaseDecorator):
     """Callable that alters cinder's v2 router.
 
-    Adds the usage endpoint.
+    Adds the usage and usage job endpoints.
     """
     def __init__(self):
         """Calls parent class init and sets signature."""
         super(_RouterDecorator, self).__init__('__cinder_router_decorator__')
 
     def setup_routes(self, module, config):
-        """Adds the usage api endpoint to routes.
+        """Adds the usage api endpoints to routes.
 
         :param module: Python module containing APIRouter class
         :param config: Dict - unused at this point.
@@ -36,6 +36,11 @@ class _RouterDecorator(BaseDecorator):
             mapper.resource("usage", "usages",
                             controller=api_router_self.resources['usages'])
 
+            api_router_self.resources['usage_jobs'] = \
+                usage.create_job_resource(ext_mgr)
+            mapper.resource("usage_job", "usage_jobs",
+                            controller=api_router_self.resources['usage_jobs'])
+
         setattr(klass, method_name, new_setup_routes)
         return module
 
@@ -17,41 +17,43 @@
 
 
 import datetime
-import iso8601
-import six
-import six.moves.urllib.parse as urlparse
 
+from oslo_config import cfg
 from oslo_log import log as logging
-from oslo_serialization import jsonutils
 from oslo_utils import timeutils
 from webob import exc
 
-from cinder import exception
 from cinder.api.openstack import wsgi
 from cinder.api.v2.views import volumes as volume_views
 from cinder.db.sqlalchemy import models
 from cinder.db.sqlalchemy.api import get_session
 from cinder.i18n import _
 
+from os_usage.common import admission as usage_admission
+from os_usage.common import config as usage_config
+from os_usage.common import deadline as usage_deadline
+from os_usage.common import etag as usage_etag
+from os_usage.common import interval_index
+from os_usage.common import jobs as usage_jobs
+from os_usage.common import metadata as usage_metadata
+from os_usage.common import request
+from os_usage.ledger import ledger as usage_ledger
+from os_usage.ledger import notifications as ledger_notifications
 from sqlalchemy import or_
-from sqlalchemy.orm import aliased
 from sqlalchemy.sql import null
 
 
 LOG = logging.getLogger(__name__)
+CONF = usage_config.register_opts(cfg.CONF)
 SCHEDULER_HINTS_NAMESPACE =\
     "http://docs.openstack.org/block-service/ext/scheduler-hints/api/v2"
 
+VOLUME_METADATA = usage_metadata.MetadataTable(
+    models.VolumeMetadata, models.Volume, foreign_key='volume_id'
+)
 
-class InvalidStrTime(exception.Invalid):
-    msg_fmt = _("Invalid datetime string: %(reason)s")
-
-
-def parse_strtime(dstr, fmt):
-    try:
-        return timeutils.parse_strtime(dstr, fmt)
-    except (TypeError, ValueError) as e:
-        raise InvalidStrTime(reason=six.text_type(e))
+# Server side breakdown dimensions.
+BREAKDOWNS = ('volume_type',)
 
 
 class UsagesController(wsgi.Controller):
@@ -63,73 +65,136 @@ class UsagesController(wsgi.Controller):
         self.ext_mgr = ext_mgr
         super(UsagesController, self).__init__()
 
-    def _parse_datetime(self, dtstr):
-        """Parse a datetimestring
+    def index(self, req):
+        """Returns a dictionary of volume usages."""
+        context = req.environ['cinder.context']
+        params = self._params(req)
+
+        etag = self._etag(req, params)
+        if usage_etag.not_modified(req, etag):
+            raise exc.HTTPNotModified()
+
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is None:
+            deadline = usage_deadline.from_params(CONF.os_usage, params)
+            with usage_deadline.enforce(deadline), \
+                    usage_admission.admit(CONF.os_usage, params):
+                usages = self._get_volumes(
+                    context, params.start, params.end,
+                    detailed=params.detailed, metadata=params.metadata,
+                    group_by_metadata=params.group_by_metadata,
+                    breakdown=params.breakdown, deadline=deadline
+                )
+        usages = request.paginate(usages, 'project_id', params)
+        response = wsgi.ResponseObject({"tenant_usages": usages})
+        if etag is not None:
+            response['ETag'] = usage_etag.header(etag)
+        return response
+
+    def _params(self, req):
+        """Validate the query parameters of a request.
+
+        :param req: webob.Request
+        :returns: os_usage.common.request.UsageParams
+        :raises: webob.exc.HTTPBadRequest
+        """
+        try:
+            return request.UsageParams.from_request(
+                req, breakdowns=BREAKDOWNS
+            )
+        except request.InvalidRequest as e:
+            raise exc.HTTPBadRequest(explanation=_(e.msg))
+
+    def _ledger_usages(self, context, params):
+        """Get volume usages from the notification ledger if configured.
 
-        :param dtstr: String containing datetime
+        :param context: cinder context from request
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
         """
-        if not dtstr:
-            value = timeutils.utcnow()
-        elif isinstance(dtstr, datetime.datetime):
-            value = dtstr
-        else:
-            for fmt in ["%Y-%m-%dT%H:%M:%S",
-                        "%Y-%m-%dT%H:%M:%S.%f",
-                        "%Y-%m-%d %H:%M:%S.%f"]:
-                try:
-                    value = parse_strtime(dtstr, fmt)
-                    break
-                except InvalidStrTime:
-                    pass
-            else:
-                msg = _("Datetime is in invalid format")
-                raise InvalidStrTime(reason=msg)
+        return ledger_notifications.ledger_summaries(
+            usage_ledger.get_ledger(CONF.os_usage.ledger_path), 'cinder',
+            params, lambda at: self._ledger_resources(context, at)
+        )
 
-        # NOTE(mriedem): Instance object DateTime fields are timezone-aware
-        # so we have to force UTC timezone for comparing this datetime against
-        # volume object fields and still maintain backwards compatibility
-        # in the API.
-        if value.utcoffset() is None:
-            value = value.replace(tzinfo=iso8601.iso8601.Utc())
-        return value
+    def _index_usages(self, params):
+        """Get volume usages from the interval index if enabled.
 
-    def _get_datetime_range(self, req):
-        """Gets the datetime range from the request.
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
+        """
+        return interval_index.index_summaries(
+            CONF.os_usage, 'cinder', params, self._volume_lifetimes
+        )
 
-        :param req: Dict
+    def _volume_lifetimes(self, since=None):
+        """Get the lifetimes of volumes for the interval index.
+
+        :param since: Datetime|None - only volumes changed from then on
+        :returns: List of tuples, see interval_index.load_lifetimes
         """
-        qs = req.environ.get('QUERY_STRING', '')
-        env = urlparse.parse_qs(qs)
-        # NOTE(lzyeval): env.get() always returns a list
-        period_start = self._parse_datetime(env.get('start', [None])[0])
-        period_stop = self._parse_datetime(env.get('end', [None])[0])
+        return interval_index.load_lifetimes(
+            get_session(), models.Volume, 'cinder', 'id', 'project_id',
+            'launched_at', 'terminated_at', ('size',), since
+        )
 
-        if not period_start < period_stop:
-            msg = _("Invalid start time. The start time cannot occur after "
-                    "the end time.")
-            raise exc.HTTPBadRequest(explanation=msg)
+    def _job_report(self, context, params):
+        """Compute the whole report of a report job.
 
-        detailed = env.get('detailed', ['0'])[0] == '1'
-        return (period_start, period_stop, detailed)
+        :param context: cinder context from request
+        :param params: os_usage.common.request.UsageParams
+        :returns: Dict - response body
+        """
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is None:
+            usages = self._get_volumes(
+                context, params.start, params.end,
+                detailed=params.detailed, metadata=params.metadata,
+                group_by_metadata=params.group_by_metadata,
+                breakdown=params.breakdown,
+                deadline=usage_deadline.Deadline(
+                    CONF.os_usage.job_timeout or None
+                )
+            )
+        return {"tenant_usages": list(usages)}
 
-    def index(self, req):
-        """Returns a dictionary of volume usages."""
-        context = req.environ['cinder.context']
-        metadata = req.GET.get('metadata', '{}')
-        metadata = jsonutils.loads(metadata)
-        try:
-            (period_start, period_stop, detailed) = \
-                self._get_datetime_range(req)
-        except InvalidStrTime as e:
-            raise exc.HTTPBadRequest(explanation=e.format_message())
+    def _etag(self, req, params):
+        """Get the ETag of a report, None unless the window is closed.
 
-        now = timeutils.parse_isotime(timeutils.strtime())
-        if period_stop > now:
-            period_stop = now
+        :param req: webob.Request
+        :param params: os_usage.common.request.UsageParams
+        :returns: String|None
+        """
+        if not params.closed:
+            return None
+        session = get_session()
+        states = [usage_etag.window_state(
+            session, models.Volume, 'launched_at', 'terminated_at',
+            params.start, params.end
+        )]
+        if params.metadata or params.group_by_metadata:
+            states.append(
+                usage_etag.table_state(session, models.VolumeMetadata)
+            )
+        if params.breakdown == 'volume_type':
+            states.append(usage_etag.table_state(session, models.VolumeTypes))
+        return usage_etag.make_etag(req.GET, states)
 
-        usages = self._get_volumes(context, period_start, period_stop,
-                                   detailed=True, metadata=metadata)
-        return {"tenant_usages": usages}
+    def _ledger_resources(self, context, at):
+        """Get the volumes active at a time to seed the ledger with.
+
+        :param context: cinder context from request
+        :param at: Datetime
+        :returns: List of tuples - (project_id, volume id, rates)
+        """
+        volumes = self._volume_api_get_all(context, at, at, None)
+        return [(volume['project_id'], volume['id'],
+                 ledger_notifications.cinder_rates(volume))
+                for volume in volumes]
 
     def _hours_for(self, volume, period_start, period_stop):
         """Determine number of active hours in period
@@ -172,7 +237,8 @@ class UsagesController(wsgi.Controller):
             return 0
 
     def _volume_api_get_all(self, context, period_start, period_stop,
-                            tenant_id, metadata=None):
+                            tenant_id, metadata=None, group_by_metadata=None,
+                            deadline=None):
         """Simulate the volume_api.get_active_by_window()
 
         :param context: wsgi context
@@ -180,6 +246,8 @@ class UsagesController(wsgi.Controller):
         :param period_stop: Datetime
         :param tenant_id: String
         :param metadata: Dict|None
+        :param group_by_metadata: String|None
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
         # Convert the datetime objects to strings for the remote call
         period_start = timeutils.isotime(period_start)
@@ -188,12 +256,16 @@ class UsagesController(wsgi.Controller):
             context,
             period_start, period_stop,
             tenant_id,
-            metadata=metadata
+            metadata=metadata,
+            group_by_metadata=group_by_metadata,
+            deadline=deadline
         )
 
     def __get_active_by_window_metadata(self, context, period_start,
                                         period_stop, project_id,
-                                        metadata=None):
+                                        metadata=None,
+                                        group_by_metadata=None,
+                                        deadline=None):
         """Simulate second to bottom layer
 
         :param context: wsgi context
@@ -201,6 +273,8 @@ class UsagesController(wsgi.Controller):
         :param period_stop: String
         :param project_id: String
         :param metadata: Dict|None
+        :param group_by_metadata: String|None
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
         period_start = timeutils.parse_isotime(period_start)
         period_stop = timeutils.parse_isotime(period_stop)
@@ -208,7 +282,9 @@ class UsagesController(wsgi.Controller):
             context,
             period_start, period_stop,
             project_id,
-            metadata=metadata
+            metadata=metadata,
+            group_by_metadata=group_by_metadata,
+            deadline=deadline
         )
         return db_volume_list
 
@@ -216,7 +292,9 @@ class UsagesController(wsgi.Controller):
                                          period_stop=None,
                                          project_id=None,
                                          metadata=None,
-                                         use_slave=False):
+                                         use_slave=False,
+                                         group_by_metadata=None,
+                                         deadline=None):
         """Simulate bottom most layer
 
         :param context: wsgi context
@@ -225,16 +303,12 @@ class UsagesController(wsgi.Controller):
         :param project_id: String|None
         :param metadata: Dict|None
         :param use_slave: Boolean
+        :param group_by_metadata: String|None - metadata key whose value is
+            stored in each volume dict under GROUP_VALUE_KEY
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
-        if metadata:
-            aliases = [aliased(models.VolumeMetadata) for i in metadata]
-        else:
-            aliases = []
         session = get_session(use_slave=use_slave)
-        query = session.query(
-            models.Volume,
-            *aliases
-        )
+        query = session.query(models.Volume)
 
         query = query.filter(or_(models.Volume.terminated_at == null(),
                                  models.Volume.terminated_at > period_start))
@@ -246,27 +320,40 @@ class UsagesController(wsgi.Controller):
             query = query.filter_by(project_id=project_id)
 
         if metadata:
-            for keypair, alias in zip(metadata.items(), aliases):
-                query = query.filter(alias.key == keypair[0])
-                query = query.filter(alias.value == keypair[1])
-                query = query.filter(alias.volume_id == models.Volume.id)
-                query = query.filter(or_(
-                    alias.deleted_at == null(),
-                    alias.deleted_at == models.Volume.deleted_at
-                ))
+            query = query.filter(
+                usage_metadata.metadata_filter(VOLUME_METADATA, metadata)
+            )
+
+        if group_by_metadata:
+            query = usage_metadata.add_group_value(
+                query, VOLUME_METADATA, group_by_metadata
+            )
 
         volumes = []
-        for tup in query.all():
-            # If no metadata filters, then no aliases.
-            if aliases:
-                volume = tup[0]
+        for tup in usage_deadline.iter_rows(session, query, deadline):
+            # Rows are tuples only when the group value column is added.
+            if group_by_metadata:
+                volume = dict(tup[0])
             else:
-                volume = tup
-            volumes.append(dict(volume))
+                volume = dict(tup)
+            if group_by_metadata:
+                volume[usage_metadata.GROUP_VALUE_KEY] = tup[-1]
+            volumes.append(volume)
         return volumes
 
+    def _volume_type_names(self, context):
+        """Map volume type ids to names, including deleted types.
+
+        :param context: cinder context from request
+        :returns: Dict
+        """
+        session = get_session()
+        query = session.query(models.VolumeTypes.id, models.VolumeTypes.name)
+        return dict(query.all())
+
     def _get_volumes(self, context, period_start, period_stop,
-                     tenant_id=None, detailed=False, metadata=None):
+                     tenant_id=None, detailed=False, metadata=None,
+                     group_by_metadata=None, breakdown=None, deadline=None):
         """Returns a list of volumes
 
         :param context: cinder context from request
@@ -275,9 +362,19 @@ class UsagesController(wsgi.Controller):
         :param tenant_id: String|None Id of a tenant
         :param detailed: Optionally include detailed volume info
         :param metadata: Dict|None Dictionary of metadata search terms
+        :param group_by_metadata: String|None Report one summary per
+            (tenant, value of this metadata key). Volumes without the key
+            are reported with a metadata_value of None.
+        :param breakdown: String|None One of BREAKDOWNS. Report one summary
+            per (tenant, value of this dimension).
+        :param deadline: Deadline|None Deadline of the query
         """
-        volumes = self._volume_api_get_all(context, period_start,
-                                           period_stop, tenant_id, metadata)
+        volumes = self._volume_api_get_all(
+            context, period_start, period_stop, tenant_id, metadata,
+            group_by_metadata=group_by_metadata, deadline=deadline
+        )
+        if breakdown == 'volume_type':
+            volume_types = self._volume_type_names(context)
         rval = {}
         for volume in volumes:
             info = {}
@@ -296,8 +393,18 @@ class UsagesController(wsgi.Controller):
             info['status'] = volume['status']
             info['attach_status'] = volume['attach_status']
 
-            if info['project_id'] not in rval:
-                summary = {}
+            group = {}
+            if group_by_metadata:
+                group['metadata_key'] = group_by_metadata
+                group['metadata_value'] = \
+                    volume[usage_metadata.GROUP_VALUE_KEY]
+            if breakdown == 'volume_type':
+                group['volume_type'] = \
+                    volume_types.get(volume['volume_type_id'])
+            key = (info['project_id'],) + tuple(sorted(group.items()))
+
+            if key not in rval:
+                summary = dict(group)
                 summary['project_id'] = info['project_id']
                 if detailed:
                     summary['volume_usages'] = []
@@ -305,9 +412,9 @@ class UsagesController(wsgi.Controller):
                 summary['total_hours'] = 0
                 summary['start'] = timeutils.normalize_time(period_start)
                 summary['stop'] = timeutils.normalize_time(period_stop)
-                rval[info['project_id']] = summary
+                rval[key] = summary
 
-            summary = rval[info['project_id']]
+            summary = rval[key]
             summary['total_gb_usage'] += info['size'] * info['hours']
             summary['total_hours'] += info['hours']
             if detailed:
@@ -315,5 +422,34 @@ class UsagesController(wsgi.Controller):
         return rval.values()
 
 
+class UsageJobsController(wsgi.Controller):
+    """Report jobs of the volume usage reports."""
+
+    def __init__(self, ext_mgr):
+        self.usages = UsagesController(ext_mgr)
+        super(UsageJobsController, self).__init__()
+
+    @wsgi.response(202)
+    def create(self, req, body=None):
+        """Submits a report job with the query parameters of a report."""
+        context = req.environ['cinder.context']
+        params = self.usages._params(req)
+        job = usage_jobs.submit(
+            CONF.os_usage, context.project_id, req.GET,
+            lambda: self.usages._job_report(context, params)
+        )
+        return {"job": job}
+
+    def show(self, req, id):
+        """Returns the status of a report job, and its result once done."""
+        context = req.environ['cinder.context']
+        return {"job": usage_jobs.show(CONF.os_usage, context.project_id,
+                                       id)}
+
+
 def create_resource(ext_mgr):
     return wsgi.Resource(UsagesController(ext_mgr))
+
+
+def create_job_resource(ext_mgr):
+    return wsgi.Resource(UsageJobsController(ext_mgr))
@@ -0,0 +1,348 @@
+"""
+Command line interface for collecting usage from nova, glance and cinder.
+
+Authentication is read from a clouds.yaml cloud given with --os-cloud or
+the OS_CLOUD environment variable, otherwise from the OS_* environment
+variables.
+
+Services are fetched in parallel. Rows are written as each service
+completes, except for table output which needs every row to size its
+columns.
+"""
+import argparse
+import collections
+import csv
+import datetime
+import json
+import os
+import sys
+
+from os_usage.clients import ClientManager
+from os_usage.common import export
+from os_usage.common.store import UsageStore
+from os_usage.common.usages import RESOURCES_DROP
+from os_usage.common.usages import SERVICES
+from os_usage.common.usages import Usages
+
+FORMATS = ('table', 'jsonl', 'csv')
+
+CLOUDS_YAML_PATHS = (
+    'clouds.yaml',
+    os.path.join('~', '.config', 'openstack', 'clouds.yaml'),
+    os.path.join(os.sep, 'etc', 'openstack', 'clouds.yaml')
+)
+
+# Environment variables and the password auth options they provide.
+AUTH_ENV = (
+    ('OS_AUTH_URL', 'auth_url'),
+    ('OS_USERNAME', 'username'),
+    ('OS_PASSWORD', 'password'),
+    ('OS_PROJECT_ID', 'project_id'),
+    ('OS_PROJECT_NAME', 'project_name'),
+    ('OS_USER_DOMAIN_NAME', 'user_domain_name'),
+    ('OS_PROJECT_DOMAIN_NAME', 'project_domain_name')
+)
+AUTH_OPTIONS = tuple(option for _, option in AUTH_ENV)
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+class CliError(Exception):
+    pass
+
+
+def parse_time(value):
+    """Parse a command line time. Times are UTC.
+
+    :param value: String
+    :returns: Datetime
+    """
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        "Invalid time {0}. Use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS.".format(
+            value
+        )
+    )
+
+
+def parse_services(value):
+    """Parse a comma separated list of services.
+
+    :param value: String
+    :returns: List
+    """
+    services = [service.strip() for service in value.split(',')]
+    for service in services:
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError(
+                "Invalid service {0}. Must be one of {1}.".format(
+                    service, ', '.join(SERVICES)
+                )
+            )
+    return services
+
+
+def parse_metadata(value):
+    """Parse a metadata filter given as a JSON object.
+
+    :param value: String
+    :returns: Dict
+    """
+    try:
+        metadata = json.loads(value)
+    except ValueError:
+        metadata = None
+    if not isinstance(metadata, dict):
+        raise argparse.ArgumentTypeError("Metadata must be a JSON object.")
+    return metadata
+
+
+def build_parser():
+    """Build the argument parser.
+
+    :returns: argparse.ArgumentParser
+    """
+    parser = argparse.ArgumentParser(
+        prog='os-usage',
+        description="Report tenant usage from nova, glance and cinder."
+    )
+    parser.add_argument('--os-cloud', default=os.environ.get('OS_CLOUD'),
+                        help="Cloud in clouds.yaml to authenticate with.")
+    parser.add_argument('--services', type=parse_services,
+                        default=list(SERVICES),
+                        help="Comma separated services. Default: all.")
+    parser.add_argument('--start', type=parse_time,
+                        help="Start of the window in UTC. Default: --days "
+                             "before the end.")
+    parser.add_argument('--end', type=parse_time,
+                        help="End of the window in UTC. Default: now.")
+    parser.add_argument('--days', type=int, default=1,
+                        help="Length of the window when --start is not "
+                             "given. Default: 1.")
+    parser.add_argument('--metadata', type=parse_metadata,
+                        help="Metadata filter as a JSON object.")
+    parser.add_argument('--resources', action='store_true',
+                        help="Output one row per resource instead of per "
+                             "tenant metric.")
+    parser.add_argument('--split', type=int, default=1,
+                        help="Split each service's window into this many "
+                             "sub windows fetched in parallel.")
+    parser.add_argument('--concurrency', type=int,
+                        help="Max sub windows fetched at once per service.")
+    parser.add_argument('--store',
+                        help="SQLite file reused for closed day windows.")
+    parser.add_argument('--token-cache',
+                        help="File used to reuse the keystone token.")
+    parser.add_argument('--http-cache',
+                        help="Directory of usage responses revalidated "
+                             "with the API instead of downloaded again.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Decode responses as they arrive and write "
+                             "tenants as they are decoded. Ignored with "
+                             "--store or --split.")
+    parser.add_argument('--format', choices=FORMATS, default='table',
+                        help="Output format. Default: table.")
+    parser.add_argument('--output', help="Output file. Default: stdout.")
+    parser.add_argument('--profile', action='store_true',
+                        help="Print per service latency and response "
+                             "bytes received to stderr.")
+    return parser
+
+
+def load_cloud(cloud, paths=CLOUDS_YAML_PATHS):
+    """Load the auth options of a cloud from the first clouds.yaml found.
+
+    :param cloud: String - cloud name
+    :param paths: Tuple of String - clouds.yaml locations in order
+    :returns: Dict
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise CliError("PyYAML is required to read clouds.yaml.")
+    for path in paths:
+        path = os.path.expanduser(path)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            config = yaml.safe_load(f) or {}
+        clouds = config.get('clouds') or {}
+        if cloud not in clouds:
+            raise CliError("Cloud {0} not found in {1}.".format(cloud, path))
+        auth = clouds[cloud].get('auth') or {}
+        return dict((option, auth[option]) for option in AUTH_OPTIONS
+                    if auth.get(option))
+    raise CliError("No clouds.yaml found.")
+
+
+def auth_kwargs(args, environ=os.environ):
+    """Get the keystone password auth options.
+
+    :param args: argparse.Namespace
+    :param environ: Dict
+    :returns: Dict
+    """
+    if args.os_cloud:
+        kwargs = load_cloud(args.os_cloud)
+    else:
+        kwargs = dict((option, environ[name]) for name, option in AUTH_ENV
+                      if environ.get(name))
+    if 'auth_url' not in kwargs:
+        raise CliError("No auth url. Set OS_AUTH_URL or use --os-cloud.")
+    return kwargs
+
+
+def service_rows(service, usage_dict, resources=False):
+    """Flatten a service usage dict into output rows.
+
+    :param service: String
+    :param usage_dict: Dict
+    :param resources: Boolean - resource rows instead of metric rows
+    :yields: tuple - of export.RESOURCE_COLUMNS or export.METRIC_COLUMNS
+    """
+    for tenant_id, tenant_dict in sorted(usage_dict.items()):
+        if resources:
+            for resource_usage in tenant_dict.get('resource_usages', []):
+                yield export.resource_row(tenant_id, resource_usage)
+        else:
+            metrics = tenant_dict.get('metrics', {})
+            for name, value in sorted(metrics.items()):
+                yield (tenant_id, '{0}-{1}'.format(service, name), value)
+
+
+class RowWriter(object):
+    """Writes rows in one of FORMATS."""
+
+    def __init__(self, fmt, columns, fileobj):
+        """
+        :param fmt: String - one of FORMATS
+        :param columns: Tuple of String
+        :param fileobj: File like object opened for writing
+        """
+        self.fmt = fmt
+        self.columns = columns
+        self.fileobj = fileobj
+        self.table = []
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.writer(fileobj)
+            self.csv.writerow(columns)
+
+    def write(self, rows):
+        """Write rows.
+
+        :param rows: Iterable of tuples
+        """
+        for row in rows:
+            if self.fmt == 'jsonl':
+                self.fileobj.write(
+                    json.dumps(dict(zip(self.columns, row)), default=str)
+                )
+                self.fileobj.write('\n')
+            elif self.fmt == 'csv':
+                self.csv.writerow([export.encode(value) for value in row])
+            else:
+                self.table.append(['' if value is None else
+                                   u'{0}'.format(value) for value in row])
+        self.fileobj.flush()
+
+    def close(self):
+        """Write buffered table output."""
+        if self.fmt != 'table':
+            return
+        widths = [len(column) for column in self.columns]
+        for row in self.table:
+            widths = [max(width, len(value))
+                      for width, value in zip(widths, row)]
+        for row in [self.columns] + self.table:
+            line = u'  '.join(value.ljust(width)
+                              for value, width in zip(row, widths))
+            self.fileobj.write(export.encode(line.rstrip() + u'\n'))
+        self.fileobj.flush()
+
+
+def collect(args, usages, out, err):
+    """Fetch usages and write output rows as services complete.
+
+    :param args: argparse.Namespace
+    :param usages: os_usage.common.usages.Usages
+    :param out: File like object for rows
+    :param err: File like object for profile output
+    """
+    end = args.end or datetime.datetime.utcnow()
+    start = args.start or end - datetime.timedelta(days=args.days)
+    if not start < end:
+        raise CliError("The start must be before the end.")
+
+    columns = export.RESOURCE_COLUMNS if args.resources \
+        else export.METRIC_COLUMNS
+    writer = RowWriter(args.format, columns, out)
+    # Streamed services yield several usage dicts, profile totals are
+    # kept per service in completion order. Bytes are the response bodies
+    # the usage clients received.
+    profile = collections.OrderedDict()
+    for service, usage_dict, seconds in usages.iter_service_usages(
+            start, end, args.metadata, detailed=args.resources,
+            split=args.split, concurrency=args.concurrency):
+        writer.write(service_rows(service, usage_dict, args.resources))
+        if args.profile:
+            resources = sum(len(tenant_dict.get('resource_usages', []))
+                            for tenant_dict in usage_dict.values())
+            totals = profile.get(service, (0, 0, 0))
+            profile[service] = (seconds, totals[1] + len(usage_dict),
+                                totals[2] + resources)
+    writer.close()
+
+    for service, (seconds, tenants, resources) in profile.items():
+        err.write(
+            "{0}: {1:.3f}s, {2} tenants, {3} resources, {4} bytes\n".format(
+                service, seconds, tenants, resources,
+                usages.received_bytes.get(service, 0)
+            )
+        )
+
+
+def main(argv=None):
+    """Console entry point.
+
+    :param argv: List|None - arguments, defaults to sys.argv
+    :returns: Integer - exit status
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    out = sys.stdout
+    store = None
+    try:
+        kwargs = auth_kwargs(args)
+        if args.output:
+            out = open(args.output, 'w')
+        if args.store:
+            store = UsageStore(args.store)
+        clients = ClientManager(token_cache=args.token_cache,
+                                http_cache=args.http_cache, **kwargs)
+        # Rows are written from the usage dicts, the per tenant copy of
+        # resource usages would never be read.
+        usages = Usages(clients,
+                        nova='nova' in args.services,
+                        glance='glance' in args.services,
+                        cinder='cinder' in args.services,
+                        store=store,
+                        stream=args.stream,
+                        resources=RESOURCES_DROP)
+        collect(args, usages, out, sys.stderr)
+    except CliError as e:
+        parser.error(str(e))
+    finally:
+        if store is not None:
+            store.close()
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
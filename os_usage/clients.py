@@ -7,21 +7,38 @@ from cinderclient import client as cinderclient
 from novaclient import client as novaclient
 from glanceclient import Client as glanceclient
 
+from os_usage.common.http_cache import ResponseCache
+from os_usage.common.token_cache import TokenCache
+
 
 class ClientManager(object):
     """Object that manages multiple openstack clients.
 
     Operates with the intention of sharing one keystone auth session.
     """
-    def __init__(self, **kwargs):
+    def __init__(self, token_cache=None, token_cache_margin=300,
+                 http_cache=None, **kwargs):
         """Inits the client manager.
 
         :param auth_url: String keystone auth url
         :param username: String openstack username
         :param password: String openstack password
         :param project_id: String project_id - Tenant uuid
+        :param token_cache: String|None - path of a file used to persist
+            the token and service catalog between runs
+        :param token_cache_margin: Integer - seconds before expiry a cached
+            token is no longer reused
+        :param http_cache: String|None - directory of a response cache
+            shared by the usage clients, see os_usage.common.http_cache
         """
         self.session = None
+        self.token_cache = None
+        if token_cache is not None:
+            self.token_cache = TokenCache(token_cache,
+                                          margin=token_cache_margin)
+        self.response_cache = None
+        if http_cache is not None:
+            self.response_cache = ResponseCache(http_cache)
         self.nova = None
         self.glance = None
         self.cinder = None
@@ -36,6 +53,10 @@ class ClientManager(object):
             loader = loading.get_plugin_loader('password')
             auth = loader.load_from_options(**self.auth_kwargs)
             self.session = session.Session(auth=auth)
+            if self.token_cache is not None and \
+                    not self.token_cache.load(auth):
+                auth.get_access(self.session)
+                self.token_cache.save(auth)
         return self.session
 
     def get_nova(self, version='2.1'):
@@ -0,0 +1,172 @@
+"""
+Provides admission control of usage queries in an API worker.
+
+A month long detailed report loads every row active during the month and
+holds a database connection and a worker while it is summarized. A few of
+them at once can starve the other calls of the API the extension is loaded
+into. Each worker therefore limits the usage queries it runs at once,
+overall and per cost class. A request without a free slot waits up to the
+queue timeout and is then rejected with 429 and a Retry-After header.
+
+The cost of a request is the length of its window in hours, multiplied by
+the detailed factor for detailed requests. Requests costing at least the
+heavy cost are heavy, the others light.
+"""
+import contextlib
+import threading
+import time
+
+from webob import exc
+
+LIGHT = 'light'
+HEAVY = 'heavy'
+COST_CLASSES = (LIGHT, HEAVY)
+
+
+class Slots(object):
+    """Counting semaphore whose acquire waits at most a timeout."""
+
+    def __init__(self, limit):
+        """
+        :param limit: Integer - slots, 0 for unlimited
+        """
+        self.limit = limit
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout):
+        """Take a slot.
+
+        :param timeout: Float - seconds to wait for a free slot
+        :returns: Boolean - False if none became free in time
+        """
+        if not self.limit:
+            return True
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.active += 1
+        return True
+
+    def release(self):
+        """Give a slot back."""
+        if not self.limit:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class Admission(object):
+    """Limits the usage queries running at once in a worker."""
+
+    def __init__(self, max_queries=0, max_heavy_queries=0, heavy_cost=720,
+                 detailed_factor=4.0, queue_timeout=0.0, retry_after=10):
+        """
+        :param max_queries: Integer - queries at once, 0 for unlimited
+        :param max_heavy_queries: Integer - heavy queries at once, 0 for
+            unlimited
+        :param heavy_cost: Float - cost from which a query is heavy
+        :param detailed_factor: Float - cost multiplier of detailed queries
+        :param queue_timeout: Float - seconds a query waits for a slot
+        :param retry_after: Integer - seconds sent in Retry-After
+        """
+        self.heavy_cost = heavy_cost
+        self.detailed_factor = detailed_factor
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.slots = Slots(max_queries)
+        self.class_slots = {LIGHT: Slots(0), HEAVY: Slots(max_heavy_queries)}
+
+    def cost(self, params):
+        """Estimate the cost of a request.
+
+        :param params: os_usage.common.request.UsageParams
+        :returns: Float
+        """
+        delta = params.end - params.start
+        hours = (delta.days * 86400 + delta.seconds) / 3600.0
+        if params.detailed:
+            hours *= self.detailed_factor
+        return hours
+
+    def cost_class(self, params):
+        """Get the cost class of a request.
+
+        :param params: os_usage.common.request.UsageParams
+        :returns: String - one of COST_CLASSES
+        """
+        if self.cost(params) >= self.heavy_cost:
+            return HEAVY
+        return LIGHT
+
+    def _reject(self, cost_class):
+        return exc.HTTPTooManyRequests(
+            explanation="Too many {0} usage queries in progress, retry "
+                        "later.".format(cost_class),
+            headers={'Retry-After': str(self.retry_after)}
+        )
+
+    @contextlib.contextmanager
+    def admit(self, params):
+        """Hold a slot while running a usage query.
+
+        The cost class slot is taken first so a heavy query waiting on it
+        does not hold one of the overall slots light queries could use.
+
+        :param params: os_usage.common.request.UsageParams
+        :raises: webob.exc.HTTPTooManyRequests
+        """
+        cost_class = self.cost_class(params)
+        class_slots = self.class_slots[cost_class]
+        deadline = time.time() + self.queue_timeout
+        if not class_slots.acquire(self.queue_timeout):
+            raise self._reject(cost_class)
+        try:
+            if not self.slots.acquire(deadline - time.time()):
+                raise self._reject(cost_class)
+            try:
+                yield
+            finally:
+                self.slots.release()
+        finally:
+            class_slots.release()
+
+
+_admissions = {}
+_admissions_lock = threading.Lock()
+
+
+def get_admission(conf):
+    """Get the admission control of a worker for its configuration.
+
+    :param conf: oslo_config group of the usage options
+    :returns: Admission
+    """
+    key = (
+        conf.max_usage_queries,
+        conf.max_heavy_usage_queries,
+        conf.heavy_usage_cost,
+        conf.detailed_usage_cost_factor,
+        conf.usage_queue_timeout,
+        conf.usage_retry_after
+    )
+    with _admissions_lock:
+        if key not in _admissions:
+            _admissions[key] = Admission(*key)
+        return _admissions[key]
+
+
+def admit(conf, params):
+    """Hold a slot of the configured admission control.
+
+    :param conf: oslo_config group of the usage options
+    :param params: os_usage.common.request.UsageParams
+    :returns: Context manager
+    :raises: webob.exc.HTTPTooManyRequests
+    """
+    return get_admission(conf).admit(params)
@@ -0,0 +1,169 @@
+"""
+Provides pandas DataFrames and vectorized rollups over Usages.
+
+Tenant metrics and resource usages are converted in one bulk step using
+the row layout of os_usage.common.export. Rollups are plain pandas
+group-bys over the resulting frames.
+
+Requires pandas.
+"""
+import datetime
+
+from os_usage.common.export import METRIC_COLUMNS
+from os_usage.common.export import RESOURCE_COLUMNS
+from os_usage.common.export import iter_metric_rows
+from os_usage.common.export import iter_resource_rows
+
+try:
+    import numpy
+    import pandas
+except ImportError:
+    numpy = pandas = None
+
+
+# Usage columns summed by the rollups.
+USAGE_COLUMNS = (
+    'hours',
+    'gb_hours',
+    'vcpu_hours',
+    'memory_mb_hours'
+)
+
+if numpy is not None:
+    ONE_DAY = numpy.timedelta64(1, 'D')
+    ZERO = numpy.timedelta64(0, 'ns')
+
+
+def _require_pandas():
+    if pandas is None:
+        raise ImportError("pandas is required for usage analytics.")
+
+
+def metrics_frame(usages):
+    """Build a frame of tenant metrics with one column per metric.
+
+    :param usages: os_usage.common.usages.Usages
+    :returns: pandas.DataFrame indexed by tenant_id
+    """
+    _require_pandas()
+    frame = pandas.DataFrame.from_records(
+        list(iter_metric_rows(usages)), columns=METRIC_COLUMNS
+    )
+    frame['value'] = pandas.to_numeric(frame['value'], errors='coerce')
+    return frame.pivot_table(index='tenant_id', columns='metric',
+                             values='value', aggfunc='sum')
+
+
+def resources_frame(usages):
+    """Build a frame with one row per resource usage.
+
+    Adds gb_hours, vcpu_hours and memory_mb_hours columns and parses
+    started_at and ended_at as datetimes.
+
+    :param usages: os_usage.common.usages.Usages
+    :returns: pandas.DataFrame
+    """
+    _require_pandas()
+    frame = pandas.DataFrame.from_records(
+        list(iter_resource_rows(usages)), columns=RESOURCE_COLUMNS
+    )
+    for column in ('started_at', 'ended_at'):
+        frame[column] = pandas.to_datetime(frame[column], errors='coerce')
+    hours = frame['hours'].fillna(0)
+    frame['gb_hours'] = frame['size_gb'].fillna(0) * hours
+    frame['vcpu_hours'] = frame['vcpus'].fillna(0) * hours
+    frame['memory_mb_hours'] = frame['memory_mb'].fillna(0) * hours
+    return frame
+
+
+def usage_by(frame, by):
+    """Sum the usage columns of a resources frame grouped by columns.
+
+    :param frame: pandas.DataFrame from resources_frame
+    :param by: String|List of String - columns to group by
+    :returns: pandas.DataFrame
+    """
+    return frame.groupby(by)[list(USAGE_COLUMNS)].sum()
+
+
+def by_tenant(frame):
+    """Usage per (tenant_id, service)."""
+    return usage_by(frame, ['tenant_id', 'service'])
+
+
+def by_flavor(frame):
+    """Usage per nova flavor."""
+    return usage_by(frame[frame['service'] == 'nova'], 'flavor')
+
+
+def by_state(frame):
+    """Usage per (service, state).
+
+    State is the vm state of servers and the status of volumes and images.
+    """
+    return usage_by(frame, ['service', 'state'])
+
+
+def by_day(frame, start=None, end=None):
+    """Usage per (service, day).
+
+    The interval of each resource from started_at to ended_at is split at
+    day boundaries and its usage is shared out between the days in
+    proportion to the time it ran on each. Resources without started_at
+    are left out.
+
+    :param frame: pandas.DataFrame from resources_frame
+    :param start: Datetime|None - intervals are clipped to start
+    :param end: Datetime|None - intervals are clipped to end. Resources
+        still running run until end. Defaults to now.
+    :returns: pandas.DataFrame
+    """
+    if end is None:
+        end = datetime.datetime.utcnow()
+    end = pandas.Timestamp(end)
+    frame = frame[frame['started_at'].notnull()]
+    begin = frame['started_at']
+    if start is not None:
+        start = pandas.Timestamp(start)
+        begin = begin.where(begin > start, start)
+    stop = frame['ended_at'].fillna(end)
+    stop = stop.where(stop < end, end)
+    stop = stop.where(stop > begin, begin)
+
+    # One row per day a resource ran on, a zero length interval gets one.
+    first = begin.dt.floor('D').values
+    days = (stop.dt.ceil('D').values - first) // ONE_DAY
+    days = numpy.maximum(days.astype(numpy.int64), 1)
+    rows = numpy.repeat(numpy.arange(len(frame)), days)
+    offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(days) -
+                                                     days, days)
+    day = first[rows] + offsets * ONE_DAY
+
+    begin = begin.values[rows]
+    stop = stop.values[rows]
+    overlap = (numpy.minimum(stop, day + ONE_DAY) -
+               numpy.maximum(begin, day))
+    length = stop - begin
+    share = numpy.where(length > ZERO, overlap / numpy.where(
+        length > ZERO, length, ONE_DAY
+    ), 1.0)
+
+    usage = frame[list(USAGE_COLUMNS)].iloc[rows].mul(share, axis=0)
+    usage['service'] = frame['service'].values[rows]
+    usage['day'] = day
+    return usage.groupby(['service', 'day'])[list(USAGE_COLUMNS)].sum()
+
+
+def top_n(frame, n=10, column='gb_hours', by='tenant_id'):
+    """Get the n largest groups by a usage column.
+
+    :param frame: pandas.DataFrame from resources_frame
+    :param n: Integer
+    :param column: String - usage column to rank by
+    :param by: String|List of String|None - columns to group by. None ranks
+        individual resources.
+    :returns: pandas.DataFrame
+    """
+    if by is not None:
+        frame = usage_by(frame, by)
+    return frame.nlargest(n, column)
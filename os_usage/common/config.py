@@ -0,0 +1,163 @@
+"""
+Configuration options of the usage API extensions.
+
+Options are registered in the [os_usage] group of the configuration of the
+service the extension is loaded into.
+"""
+from oslo_config import cfg
+
+GROUP = 'os_usage'
+
+aggregate_opts = [
+    cfg.IntOpt('aggregate_processes',
+               default=0,
+               min=0,
+               help="Number of worker processes forked by each API worker "
+                    "to aggregate large summary reports. 0 aggregates in "
+                    "the API worker. Detailed reports are always "
+                    "aggregated in the API worker."),
+    cfg.IntOpt('aggregate_process_threshold',
+               default=10000,
+               min=1,
+               help="Minimum number of rows in a summary report before it "
+                    "is aggregated in the worker processes. Moving a row "
+                    "to a worker costs the API worker about 90% of "
+                    "aggregating it, see benchmark-aggregate.py. The "
+                    "workers mostly keep the eventlet hub free, the default "
+                    "sends reports that would block it for over 40ms."),
+]
+
+cells_opts = [
+    cfg.ListOpt('cell_connections',
+                default=[],
+                secret=True,
+                help="SQLAlchemy connection urls of the nova cell "
+                     "databases queried for usage. Empty queries the nova "
+                     "database."),
+    cfg.IntOpt('cell_concurrency',
+               min=1,
+               help="Max cell databases queried at once. Defaults to all "
+                    "of them."),
+]
+
+ledger_opts = [
+    cfg.StrOpt('ledger_path',
+               help="Path to the SQLite usage ledger kept by "
+                    "os-usage-ledger. Empty answers every request from the "
+                    "service database."),
+    cfg.ListOpt('ledger_topics',
+                default=['notifications'],
+                help="Notification topics os-usage-ledger listens on."),
+    cfg.IntOpt('ledger_history_days',
+               default=0,
+               min=0,
+               help="Days of history os-usage-ledger keeps in the ledger. "
+                    "Windows starting earlier are answered from the "
+                    "service database. 0 keeps all history."),
+]
+
+admission_opts = [
+    cfg.IntOpt('max_usage_queries',
+               default=0,
+               min=0,
+               help="Max usage queries an API worker runs at once. 0 is "
+                    "unlimited."),
+    cfg.IntOpt('max_heavy_usage_queries',
+               default=0,
+               min=0,
+               help="Max heavy usage queries an API worker runs at once. "
+                    "0 is unlimited."),
+    cfg.FloatOpt('heavy_usage_cost',
+                 default=720.0,
+                 min=0,
+                 help="Cost from which a usage query is heavy. The cost is "
+                      "the window length in hours, multiplied by "
+                      "detailed_usage_cost_factor for detailed queries."),
+    cfg.FloatOpt('detailed_usage_cost_factor',
+                 default=4.0,
+                 min=1,
+                 help="Cost multiplier of detailed usage queries."),
+    cfg.FloatOpt('usage_queue_timeout',
+                 default=0.0,
+                 min=0,
+                 help="Seconds a usage query waits for a free slot before "
+                      "it is rejected with 429. 0 rejects at once."),
+    cfg.IntOpt('usage_retry_after',
+               default=10,
+               min=0,
+               help="Seconds sent in the Retry-After header of rejected "
+                    "usage queries."),
+]
+
+deadline_opts = [
+    cfg.FloatOpt('usage_timeout',
+                 default=0.0,
+                 min=0,
+                 help="Seconds a usage report may query the database for "
+                      "before it is aborted with 504. 0 sets no deadline."),
+    cfg.FloatOpt('max_usage_timeout',
+                 default=0.0,
+                 min=0,
+                 help="Cap of the timeout parameter of usage requests and "
+                      "of usage_timeout. 0 is uncapped."),
+]
+
+job_opts = [
+    cfg.StrOpt('job_path',
+               help="Directory of usage report job files, shared by the "
+                    "API workers of the service. Empty disables report "
+                    "jobs."),
+    cfg.IntOpt('job_workers',
+               default=2,
+               min=1,
+               help="Report jobs an API worker computes at once."),
+    cfg.IntOpt('job_expiry',
+               default=86400,
+               min=1,
+               help="Seconds a report job and its result are kept after it "
+                    "was submitted or finished."),
+    cfg.FloatOpt('job_timeout',
+                 default=0.0,
+                 min=0,
+                 help="Seconds a report job may query the database for. 0 "
+                      "sets no deadline."),
+]
+
+interval_index_opts = [
+    cfg.BoolOpt('interval_index',
+                default=False,
+                help="Keep the resource lifetimes of the service in memory "
+                     "in each API worker and answer tenant totals of any "
+                     "window from them."),
+    cfg.FloatOpt('interval_index_refresh',
+                 default=10.0,
+                 min=0,
+                 help="Seconds between reads of the lifetimes changed "
+                      "since the last read."),
+]
+
+
+def register_opts(conf=cfg.CONF):
+    """Register the usage options.
+
+    :param conf: oslo_config.cfg.ConfigOpts
+    :returns: oslo_config.cfg.ConfigOpts
+    """
+    conf.register_opts(aggregate_opts, group=GROUP)
+    conf.register_opts(cells_opts, group=GROUP)
+    conf.register_opts(ledger_opts, group=GROUP)
+    conf.register_opts(admission_opts, group=GROUP)
+    conf.register_opts(deadline_opts, group=GROUP)
+    conf.register_opts(job_opts, group=GROUP)
+    conf.register_opts(interval_index_opts, group=GROUP)
+    return conf
+
+
+def list_opts():
+    """List the usage options for oslo-config-generator.
+
+    :returns: List of tuples
+    """
+    return [(GROUP, aggregate_opts + cells_opts + ledger_opts +
+             admission_opts + deadline_opts + job_opts +
+             interval_index_opts)]
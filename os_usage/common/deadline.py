@@ -0,0 +1,179 @@
+"""
+Provides deadlines bounding how long a usage report may query for.
+
+A client or load balancer giving up on a long report does not stop the
+query behind it. Each request therefore gets a deadline, the configured
+usage_timeout of the service or the timeout parameter of the request,
+capped by max_usage_timeout. Rows are read with iter_rows which sets a
+statement timeout on the database connection for the time remaining and
+checks the deadline between batches of rows while they are converted.
+
+MySQL and MariaDB abort statements with max_execution_time and
+max_statement_time, PostgreSQL with statement_timeout. SQLite is
+interrupted through a progress handler.
+"""
+import contextlib
+import time
+
+from sqlalchemy import text
+from webob import exc
+
+# Rows read between deadline checks.
+BATCH_SIZE = 1000
+
+# Virtual machine instructions SQLite runs between deadline checks.
+SQLITE_PROGRESS_STEPS = 10000
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.msg = "Usage query exceeded its deadline of {0} seconds. " \
+                   "Narrow the window or raise the timeout.".format(seconds)
+        super(DeadlineExceeded, self).__init__(self.msg)
+
+
+class Deadline(object):
+    """Point in time by which a report must be done."""
+
+    def __init__(self, seconds=None):
+        """
+        :param seconds: Float|None - seconds from now, None for no deadline
+        """
+        self.seconds = seconds
+        self.expires = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        """Get the seconds left.
+
+        :returns: Float|None - None without a deadline
+        """
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.time())
+
+    @property
+    def expired(self):
+        """True once the deadline has passed."""
+        return self.expires is not None and time.time() >= self.expires
+
+    def check(self):
+        """Raise if the deadline has passed.
+
+        :raises: DeadlineExceeded
+        """
+        if self.expired:
+            raise DeadlineExceeded(self.seconds)
+
+
+def from_params(conf, params):
+    """Get the deadline of a usage request.
+
+    :param conf: oslo_config group of the usage options
+    :param params: os_usage.common.request.UsageParams
+    :returns: Deadline
+    """
+    seconds = params.timeout or conf.usage_timeout or None
+    if conf.max_usage_timeout:
+        seconds = min(seconds or conf.max_usage_timeout,
+                      conf.max_usage_timeout)
+    return Deadline(seconds)
+
+
+@contextlib.contextmanager
+def enforce(deadline):
+    """Turn an exceeded deadline into a 504 response.
+
+    :param deadline: Deadline
+    :raises: webob.exc.HTTPGatewayTimeout
+    """
+    try:
+        yield deadline
+    except DeadlineExceeded as e:
+        raise exc.HTTPGatewayTimeout(explanation=e.msg)
+
+
+@contextlib.contextmanager
+def _statement_timeout(connection, deadline):
+    """Abort statements of a connection once the deadline passes.
+
+    :param connection: sqlalchemy.engine.Connection
+    :param deadline: Deadline
+    """
+    milliseconds = max(1, int(deadline.remaining() * 1000))
+    dialect = connection.dialect
+    if dialect.name == 'sqlite':
+        dbapi_connection = connection.connection
+        dbapi_connection.set_progress_handler(
+            lambda: deadline.expired, SQLITE_PROGRESS_STEPS
+        )
+        try:
+            yield
+        finally:
+            dbapi_connection.set_progress_handler(None, 0)
+        return
+
+    if dialect.name == 'mysql':
+        if getattr(dialect, '_is_mariadb', False):
+            variable = 'max_statement_time'
+            value = milliseconds / 1000.0
+        else:
+            variable = 'max_execution_time'
+            value = milliseconds
+        connection.execute(
+            text('SET SESSION {0} = :value'.format(variable)), value=value
+        )
+        reset = 'SET SESSION {0} = DEFAULT'.format(variable)
+    elif dialect.name == 'postgresql':
+        # A timed out statement aborts the transaction, which then refuses
+        # a reset. A local setting ends with the transaction instead.
+        connection.execute(
+            text('SET LOCAL statement_timeout = {0:d}'.format(milliseconds))
+        )
+        yield
+        return
+    else:
+        yield
+        return
+    try:
+        yield
+    finally:
+        connection.execute(text(reset))
+
+
+def iter_rows(session, query, deadline, batch_size=BATCH_SIZE):
+    """Iterate over the rows of a query within a deadline.
+
+    The query runs in a transaction of the session so the statement
+    timeout is set on the connection running it. On PostgreSQL the timeout
+    lasts until the end of the session's transaction.
+
+    :param session: SQLAlchemy session of the query
+    :param query: sqlalchemy.orm.Query
+    :param deadline: Deadline|None
+    :param batch_size: Integer - rows between deadline checks
+    :yields: Rows of the query
+    :raises: DeadlineExceeded
+    """
+    if deadline is None or deadline.expires is None:
+        for row in query:
+            yield row
+        return
+
+    deadline.check()
+    with session.begin(subtransactions=True):
+        connection = session.connection()
+        with _statement_timeout(connection, deadline):
+            try:
+                for i, row in enumerate(query):
+                    if not i % batch_size:
+                        deadline.check()
+                    yield row
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                # The database aborting the statement surfaces as a driver
+                # error of its own.
+                if deadline.expired:
+                    raise DeadlineExceeded(deadline.seconds)
+                raise
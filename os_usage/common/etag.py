@@ -0,0 +1,102 @@
+"""
+Provides ETag validators for usage reports of closed windows.
+
+A report of a window that ended in the past only changes when rows active
+during the window change. Nova, cinder and glance stamp updated_at on every
+change and deleted_at on soft deletes, so the row count and the latest of
+those stamps over the window identify its state. They are read with one
+aggregate query instead of loading and summarizing every row.
+
+Windows still open are never tagged, their usage grows with every request.
+"""
+import hashlib
+import json
+
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.sql import null
+
+# Environ key a controller leaves the ETag of its response under for a
+# serializer that only sees the response.
+ENVIRON_KEY = 'os_usage.etag'
+
+
+def window_state(session, model, begin_column, end_column, begin, end,
+                 criteria=()):
+    """Get the state of the rows of a table active during a window.
+
+    :param session: SQLAlchemy session
+    :param model: SQLAlchemy model with updated_at and deleted_at columns
+    :param begin_column: String - column the row became active at
+    :param end_column: String - column the row stopped being active at
+    :param begin: Datetime
+    :param end: Datetime
+    :param criteria: Iterable of SQL expressions further filtering rows
+    :returns: Tuple - (count, max updated_at, max deleted_at)
+    """
+    begin_column = getattr(model, begin_column)
+    end_column = getattr(model, end_column)
+    query = session.query(
+        func.count(),
+        func.max(model.updated_at),
+        func.max(model.deleted_at)
+    )
+    query = query.filter(or_(end_column == null(), end_column > begin))
+    query = query.filter(begin_column < end)
+    for criterion in criteria:
+        query = query.filter(criterion)
+    return tuple(query.one())
+
+
+def table_state(session, model):
+    """Get the state of a whole table, such as a metadata table.
+
+    :param session: SQLAlchemy session
+    :param model: SQLAlchemy model with updated_at and deleted_at columns
+    :returns: Tuple - (count, max updated_at, max deleted_at)
+    """
+    return tuple(session.query(
+        func.count(),
+        func.max(model.updated_at),
+        func.max(model.deleted_at)
+    ).one())
+
+
+def _default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return repr(value)
+
+
+def make_etag(params, states):
+    """Make an ETag from the request parameters and table states.
+
+    :param params: Dict like - query parameters of the request
+    :param states: List - results of window_state and table_state
+    :returns: String - the unquoted entity tag
+    """
+    data = json.dumps(
+        [sorted(params.items()), states], default=_default, sort_keys=True
+    )
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def header(etag):
+    """Format an entity tag as an ETag header value.
+
+    :param etag: String
+    :returns: String
+    """
+    return '"{0}"'.format(etag)
+
+
+def not_modified(req, etag):
+    """Determine if the client already holds the tagged report.
+
+    :param req: webob.Request
+    :param etag: String|None - None when the report is not tagged
+    :returns: Boolean
+    """
+    if etag is None:
+        return False
+    return etag in req.if_none_match
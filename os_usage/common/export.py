@@ -0,0 +1,286 @@
+"""
+Provides streaming exporters for Usages.
+
+Tenant metrics and resource usages are flattened into rows with a fixed
+set of columns and written in batches to CSV, Arrow record batches or
+Parquet files. Only one batch of rows is held at a time.
+
+Arrow and Parquet output require pyarrow.
+"""
+import csv
+
+import six
+
+from os_usage.common.usage_dict import RESOURCE_SERVICES
+from os_usage.common.usage_dict import resource_id
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+
+METRIC_COLUMNS = ('tenant_id', 'metric', 'value')
+
+RESOURCE_COLUMNS = (
+    'tenant_id',
+    'service',
+    'resource_id',
+    'name',
+    'flavor',
+    'state',
+    'hours',
+    'size_gb',
+    'vcpus',
+    'memory_mb',
+    'started_at',
+    'ended_at'
+)
+
+DEFAULT_BATCH_SIZE = 65536
+
+BYTES_PER_GB = 1024.0 * 1024 * 1024
+
+
+def _number(value):
+    """Get value as a float, None if it is not numeric."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def resource_row(tenant_id, resource_usage):
+    """Flatten a resource usage dict into a tuple of RESOURCE_COLUMNS.
+
+    :param tenant_id: String
+    :param resource_usage: Dict
+    :returns: tuple
+    """
+    key = resource_id(resource_usage)
+    service = RESOURCE_SERVICES[key[0]] if key else None
+    get = resource_usage.get
+    if service == 'nova':
+        name = get('name')
+        state = get('state')
+        size_gb = get('local_gb')
+    elif service == 'cinder':
+        name = get('display_name')
+        state = get('status')
+        size_gb = get('size')
+    else:
+        name = get('name')
+        state = get('status')
+        size_gb = _number(get('size'))
+        if size_gb is not None:
+            size_gb /= BYTES_PER_GB
+    return (
+        tenant_id,
+        service,
+        key[1] if key else None,
+        name,
+        get('flavor'),
+        state,
+        _number(get('hours')),
+        _number(size_gb),
+        _number(get('vcpus')),
+        _number(get('memory_mb')),
+        get('started_at'),
+        get('ended_at')
+    )
+
+
+def iter_metric_rows(usages):
+    """Iterate tenant metrics as tuples of METRIC_COLUMNS.
+
+    :param usages: os_usage.common.usages.Usages
+    :yields: tuple
+    """
+    for tenant_id, tenant_usage in usages:
+        for metric_name, metric_value in tenant_usage:
+            yield (tenant_id, metric_name, metric_value)
+
+
+def iter_resource_rows(usages):
+    """Iterate resource usages as tuples of RESOURCE_COLUMNS.
+
+    :param usages: os_usage.common.usages.Usages
+    :yields: tuple
+    """
+    for tenant_id, tenant_usage in usages:
+        for resource_usage in tenant_usage.resource_usages:
+            yield resource_row(tenant_id, resource_usage)
+
+
+def iter_batches(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """Group rows into lists of at most batch_size rows.
+
+    :param rows: Iterable
+    :param batch_size: Integer
+    :yields: List
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode(value):
+    """Encode text for the python 2 csv module.
+
+    :param value: Any
+    :returns: Any
+    """
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def write_csv(rows, columns, fileobj):
+    """Write rows to a csv file with a header row.
+
+    :param rows: Iterable of tuples
+    :param columns: Tuple of String - header
+    :param fileobj: File like object opened for writing
+    :returns: Integer - number of rows written
+    """
+    writer = csv.writer(fileobj)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([encode(value) for value in row])
+        count += 1
+    return count
+
+
+def metrics_to_csv(usages, fileobj):
+    """Write tenant metrics of usages as csv.
+
+    :param usages: os_usage.common.usages.Usages
+    :param fileobj: File like object opened for writing
+    :returns: Integer - number of rows written
+    """
+    return write_csv(iter_metric_rows(usages), METRIC_COLUMNS, fileobj)
+
+
+def resources_to_csv(usages, fileobj):
+    """Write resource usages of usages as csv.
+
+    :param usages: os_usage.common.usages.Usages
+    :param fileobj: File like object opened for writing
+    :returns: Integer - number of rows written
+    """
+    return write_csv(iter_resource_rows(usages), RESOURCE_COLUMNS, fileobj)
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("pyarrow is required for Arrow and Parquet export.")
+
+
+def metric_schema():
+    """Arrow schema for metric record batches."""
+    _require_pyarrow()
+    return pyarrow.schema([
+        ('tenant_id', pyarrow.string()),
+        ('metric', pyarrow.string()),
+        ('value', pyarrow.float64())
+    ])
+
+
+def resource_schema():
+    """Arrow schema for resource usage record batches."""
+    _require_pyarrow()
+    string_columns = ('tenant_id', 'service', 'resource_id', 'name',
+                      'flavor', 'state', 'started_at', 'ended_at')
+    return pyarrow.schema([
+        (column, pyarrow.string() if column in string_columns
+         else pyarrow.float64())
+        for column in RESOURCE_COLUMNS
+    ])
+
+
+def _record_batches(rows, schema, batch_size):
+    for batch in iter_batches(rows, batch_size):
+        columns = list(zip(*batch))
+        arrays = []
+        for field, values in zip(schema, columns):
+            if pyarrow.types.is_floating(field.type):
+                values = [_number(value) for value in values]
+            else:
+                values = [None if value is None else six.text_type(value)
+                          for value in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def metric_batches(usages, batch_size=DEFAULT_BATCH_SIZE):
+    """Iterate tenant metrics as Arrow record batches.
+
+    :param usages: os_usage.common.usages.Usages
+    :param batch_size: Integer - rows per batch
+    :yields: pyarrow.RecordBatch
+    """
+    return _record_batches(iter_metric_rows(usages), metric_schema(),
+                           batch_size)
+
+
+def resource_batches(usages, batch_size=DEFAULT_BATCH_SIZE):
+    """Iterate resource usages as Arrow record batches.
+
+    :param usages: os_usage.common.usages.Usages
+    :param batch_size: Integer - rows per batch
+    :yields: pyarrow.RecordBatch
+    """
+    return _record_batches(iter_resource_rows(usages), resource_schema(),
+                           batch_size)
+
+
+def write_parquet(batches, schema, path):
+    """Write record batches to a parquet file one row group per batch.
+
+    :param batches: Iterable of pyarrow.RecordBatch
+    :param schema: pyarrow.Schema
+    :param path: String
+    :returns: Integer - number of rows written
+    """
+    _require_pyarrow()
+    count = 0
+    writer = parquet.ParquetWriter(path, schema)
+    try:
+        for batch in batches:
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+            count += batch.num_rows
+    finally:
+        writer.close()
+    return count
+
+
+def metrics_to_parquet(usages, path, batch_size=DEFAULT_BATCH_SIZE):
+    """Write tenant metrics of usages to a parquet file.
+
+    :param usages: os_usage.common.usages.Usages
+    :param path: String
+    :param batch_size: Integer - rows per row group
+    :returns: Integer - number of rows written
+    """
+    return write_parquet(metric_batches(usages, batch_size),
+                         metric_schema(), path)
+
+
+def resources_to_parquet(usages, path, batch_size=DEFAULT_BATCH_SIZE):
+    """Write resource usages of usages to a parquet file.
+
+    :param usages: os_usage.common.usages.Usages
+    :param path: String
+    :param batch_size: Integer - rows per row group
+    :returns: Integer - number of rows written
+    """
+    return write_parquet(resource_batches(usages, batch_size),
+                         resource_schema(), path)
@@ -0,0 +1,195 @@
+"""
+Provides a validating cache of usage responses for the usage clients.
+
+The usage APIs tag reports of closed windows with an ETag. A client with a
+cache stores the decoded usage dict of a tagged response under the
+normalized request url and sends the tag back in If-None-Match. A 304
+answer reuses the stored dict, skipping both the transfer and decoding.
+
+Entries are kept in memory and, when the cache has a directory, in one
+owner only file per url so later runs can revalidate too. Untagged
+responses, such as reports of windows still open, are never stored.
+
+The body bytes of each response can be added to a ByteCounter, so callers
+can report what a request actually transferred.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+
+from six.moves.urllib import parse
+
+
+class ByteCounter(object):
+    """Thread safe count of the response bytes received by a client."""
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        """Add received bytes.
+
+        :param count: Integer
+        """
+        with self._lock:
+            self.total += count
+
+
+def response_bytes(resp):
+    """Get the body bytes of a read response.
+
+    The Content-Length header is the size on the wire, compressed bodies
+    included. Without it the read content is measured.
+
+    :param resp: requests.Response
+    :returns: Integer
+    """
+    length = resp.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return int(length)
+    content = getattr(resp, 'content', None)
+    return len(content) if content else 0
+
+
+def cache_key(url):
+    """Normalize a request url so equivalent queries share an entry.
+
+    :param url: String - path and query string
+    :returns: String
+    """
+    path, _, query = url.partition('?')
+    pairs = sorted(parse.parse_qsl(query, keep_blank_values=True))
+    return '{0}?{1}'.format(path, parse.urlencode(pairs))
+
+
+class ResponseCache(object):
+    """In memory and optional on disk cache of tagged usage responses."""
+
+    def __init__(self, path=None, max_entries=256):
+        """Inits the cache.
+
+        :param path: String|None - directory persisting entries between
+            runs. None keeps entries in memory only.
+        :param max_entries: Integer - entries kept in memory, least recently
+            used first out
+        """
+        self.path = os.path.expanduser(path) if path else None
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if self.path and not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+
+    def _file(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.json')
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Get a cached entry.
+
+        :param key: String - see cache_key
+        :returns: Tuple|None - (etag, usage dict)
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+        if not self.path:
+            return None
+        try:
+            with open(self._file(key)) as f:
+                data = json.load(f)
+            if data['key'] != key:
+                return None
+            entry = (data['etag'], data['value'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, etag, value):
+        """Cache a tagged usage dict.
+
+        The file is written to a temporary file that is renamed over the
+        entry so readers never see a partial write.
+
+        :param key: String - see cache_key
+        :param etag: String - ETag header of the response
+        :param value: Dict - decoded usage dict
+        """
+        self._remember(key, (etag, value))
+        if not self.path:
+            return
+        data = json.dumps({'key': key, 'etag': etag, 'value': value})
+        path = self._file(key)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                           threading.current_thread().ident)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+        if not self.path:
+            return
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                try:
+                    os.unlink(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+
+def cached_get(cache, http_client, url, decode, counter=None):
+    """GET a usage url through a cache.
+
+    Cached dicts are shared between calls and must not be modified.
+
+    :param cache: ResponseCache|None - None always fetches
+    :param http_client: Client with a get(url, headers=...) method
+        returning (response, body) like the nova, cinder and glance clients
+    :param url: String - path and query string
+    :param decode: Callable accepting the response and body and returning
+        a usage dict
+    :param counter: ByteCounter|None - counts the body bytes received
+    :returns: Dict
+    """
+    if cache is None:
+        resp, body = http_client.get(url)
+        if counter is not None:
+            counter.add(response_bytes(resp))
+        return decode(resp, body)
+    key = cache_key(url)
+    entry = cache.get(key)
+    headers = {}
+    if entry is not None:
+        headers['If-None-Match'] = entry[0]
+    resp, body = http_client.get(url, headers=headers)
+    if counter is not None:
+        counter.add(response_bytes(resp))
+    if resp.status_code == 304 and entry is not None:
+        return entry[1]
+    value = decode(resp, body)
+    etag = resp.headers.get('ETag')
+    if etag:
+        cache.put(key, etag, value)
+    return value
@@ -0,0 +1,298 @@
+"""
+Provides an in process index of resource lifetimes per tenant.
+
+Dashboards ask for many arbitrary windows. Instead of a range scan of the
+service database for each one, every API worker can keep the lifetimes of
+all instances, volumes or images in memory, loaded once and then kept
+fresh by reading only rows created, updated or deleted since the latest
+change already seen. Each refresh reads a little before it again, so rows
+committed late with earlier stamps are still picked up.
+
+The usage of a tenant over a window is the integral of its rates over the
+window. For each tenant the begin and end times are kept sorted with prefix
+sums of the rates and of rate * time, so the integral up to any time is
+two binary searches and the usage of a window is the difference of two
+integrals, O(log n) per tenant whatever the window.
+
+Like the ledger the index holds tenant totals only. Detailed, filtered and
+grouped requests still go to the database.
+"""
+import bisect
+import datetime
+import threading
+import time
+
+from array import array
+from sqlalchemy import or_
+
+from os_usage.ledger import ledger as usage_ledger
+from os_usage.ledger import notifications as ledger_notifications
+
+# Seconds before the latest change seen that a refresh reads again at
+# least. A transaction stamping a row before that change may commit after
+# it was read.
+REFRESH_MARGIN = 300
+
+
+class TenantIntervals(object):
+    """Lifetimes of the resources of one tenant."""
+
+    __slots__ = ('width', 'resources', '_begins', '_ends', '_begin_sums',
+                 '_end_sums', '_built')
+
+    def __init__(self, width):
+        """
+        :param width: Integer - number of rates of each resource
+        """
+        self.width = width
+        # Resource id to (begin, end|None, rates), times in epoch seconds.
+        self.resources = {}
+        self._built = False
+
+    def set(self, resource_id, begin, end, rates):
+        """Add or replace the lifetime of a resource.
+
+        :param resource_id: String
+        :param begin: Float
+        :param end: Float|None - None while the resource is active
+        :param rates: List of floats
+        """
+        if end is not None and end < begin:
+            end = begin
+        self.resources[resource_id] = (begin, end, rates)
+        self._built = False
+
+    def remove(self, resource_id):
+        """Remove a resource.
+
+        :param resource_id: String
+        """
+        if self.resources.pop(resource_id, None) is not None:
+            self._built = False
+
+    def _prefix_sums(self, points):
+        """Sort points and sum rates and rate * time up to each one.
+
+        :param points: List of (time, rates)
+        :returns: Tuple - (times, list of (rate sums, rate * time sums))
+        """
+        points.sort(key=lambda point: point[0])
+        sums = []
+        for i in range(self.width):
+            rate_sums = array('d', [0.0])
+            time_sums = array('d', [0.0])
+            for at, rates in points:
+                rate_sums.append(rate_sums[-1] + rates[i])
+                time_sums.append(time_sums[-1] + rates[i] * at)
+            sums.append((rate_sums, time_sums))
+        return array('d', [at for at, _rates in points]), sums
+
+    def _build(self):
+        self._begins, self._begin_sums = self._prefix_sums(
+            [(begin, rates) for begin, _end, rates in
+             self.resources.values()]
+        )
+        self._ends, self._end_sums = self._prefix_sums(
+            [(end, rates) for _begin, end, rates in self.resources.values()
+             if end is not None]
+        )
+        self._built = True
+
+    def _integral(self, at):
+        """Integrate the rates from the beginning of time up to a time.
+
+        :param at: Float
+        :returns: List of floats - rate seconds per rate
+        """
+        begun = bisect.bisect_left(self._begins, at)
+        ended = bisect.bisect_left(self._ends, at)
+        values = []
+        for i in range(self.width):
+            begin_rates, begin_times = self._begin_sums[i]
+            end_rates, end_times = self._end_sums[i]
+            values.append(
+                at * begin_rates[begun] - begin_times[begun] -
+                (at * end_rates[ended] - end_times[ended])
+            )
+        return values
+
+    def usage(self, start, end):
+        """Get the usage of the tenant over a window.
+
+        :param start: Float
+        :param end: Float
+        :returns: List|None - rate hours per rate, None when no resource
+            was active during the window
+        """
+        if not self._built:
+            self._build()
+        # Resources begun before the end, less those ended by the start.
+        active = bisect.bisect_left(self._begins, end) - \
+            bisect.bisect_right(self._ends, start)
+        if active <= 0:
+            return None
+        before = self._integral(start)
+        after = self._integral(end)
+        return [(a - b) / 3600.0 for a, b in zip(after, before)]
+
+
+class IntervalIndex(object):
+    """Lifetimes of the resources of one service."""
+
+    def __init__(self, service):
+        """
+        :param service: String - one of os_usage.ledger.ledger.METRICS
+        """
+        self.service = service
+        self.metrics = usage_ledger.METRICS[service]
+        self.tenants = {}
+        self.owners = {}
+        # Latest change seen, changes from it on are read on refresh.
+        self.since = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def update(self, lifetimes):
+        """Apply loaded lifetimes.
+
+        :param lifetimes: Iterable of tuples - (tenant_id, resource_id,
+            begin, end, rates, changed_at), see load_lifetimes
+        """
+        for tenant_id, resource_id, begin, end, rates, changed_at in \
+                lifetimes:
+            if changed_at is not None and \
+                    (self.since is None or changed_at > self.since):
+                self.since = changed_at
+            owner = self.owners.get(resource_id)
+            if owner is not None and (owner != tenant_id or begin is None):
+                self.tenants[owner].remove(resource_id)
+                del self.owners[resource_id]
+            if begin is None or tenant_id is None:
+                continue
+            if tenant_id not in self.tenants:
+                self.tenants[tenant_id] = TenantIntervals(len(self.metrics))
+            self.tenants[tenant_id].set(
+                resource_id,
+                usage_ledger.to_timestamp(begin),
+                usage_ledger.to_timestamp(end) if end is not None else None,
+                list(rates)[:len(self.metrics)]
+            )
+            self.owners[resource_id] = tenant_id
+
+    def refresh(self, load, interval):
+        """Load the lifetimes changed since the last refresh.
+
+        Changes from max(interval, REFRESH_MARGIN) seconds before the
+        latest change seen are read again.
+
+        :param load: Callable accepting a Datetime|None, the time changes
+            are read from or None for all of them, and returning lifetimes
+        :param interval: Float - seconds between refreshes
+        """
+        now = time.time()
+        if self.refreshed_at is not None and \
+                now - self.refreshed_at < interval:
+            return
+        since = self.since
+        if since is not None:
+            since -= datetime.timedelta(seconds=max(interval,
+                                                    REFRESH_MARGIN))
+        self.update(load(since))
+        self.refreshed_at = now
+
+    def usage(self, start, end):
+        """Get the usage of each tenant over a window.
+
+        :param start: Datetime
+        :param end: Datetime
+        :returns: Dict - tenant id to dict of metric name to value
+        """
+        start = usage_ledger.to_timestamp(start)
+        end = usage_ledger.to_timestamp(end)
+        usage = {}
+        for tenant_id, intervals in self.tenants.items():
+            values = intervals.usage(start, end)
+            if values is not None:
+                usage[tenant_id] = dict(zip(self.metrics, values))
+        return usage
+
+    def summaries(self, start, end):
+        """Get usage summaries shaped like the service's usage response.
+
+        :param start: Datetime
+        :param end: Datetime
+        :returns: List of dicts
+        """
+        summaries = []
+        for tenant_id, metrics in self.usage(start, end).items():
+            summary = dict(metrics)
+            summary[usage_ledger.TENANT_KEYS[self.service]] = tenant_id
+            summary['start'] = usage_ledger.to_naive(start)
+            summary['stop'] = usage_ledger.to_naive(end)
+            summaries.append(summary)
+        return summaries
+
+
+def load_lifetimes(session, model, service, id_column, tenant_column,
+                   begin_column, end_column, rate_columns, since=None):
+    """Read resource lifetimes from a service table.
+
+    :param session: SQLAlchemy session
+    :param model: SQLAlchemy model with created_at, updated_at and
+        deleted_at columns
+    :param service: String - rates are computed with its ledger rates
+    :param id_column: String
+    :param tenant_column: String
+    :param begin_column: String - column the resource became active at
+    :param end_column: String - column the resource stopped being active at
+    :param rate_columns: Tuple of String - columns the rates are read from
+    :param since: Datetime|None - only read rows changed from then on
+    :returns: List of tuples - (tenant_id, resource_id, begin, end, rates,
+        changed_at)
+    """
+    names = (id_column, tenant_column, begin_column, end_column) + \
+        tuple(rate_columns)
+    query = session.query(
+        model.created_at, model.updated_at, model.deleted_at,
+        *[getattr(model, name) for name in names]
+    )
+    if since is not None:
+        query = query.filter(or_(model.created_at >= since,
+                                 model.updated_at >= since,
+                                 model.deleted_at >= since))
+    rates = ledger_notifications.RATES[service]
+    lifetimes = []
+    for row in query:
+        stamps = [stamp for stamp in row[:3] if stamp is not None]
+        changed_at = max(stamps) if stamps else None
+        values = dict(zip(names, row[3:]))
+        lifetimes.append((
+            values[tenant_column], values[id_column], values[begin_column],
+            values[end_column], rates(values), changed_at
+        ))
+    return lifetimes
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_summaries(conf, service, params, load):
+    """Answer a usage request from the interval index when enabled.
+
+    :param conf: oslo_config group of the usage options
+    :param service: String
+    :param params: os_usage.common.request.UsageParams
+    :param load: Callable, see IntervalIndex.refresh
+    :returns: List|None - summaries, None when the database must be used
+    """
+    if not conf.interval_index or \
+            not ledger_notifications.can_answer(params):
+        return None
+    with _indexes_lock:
+        if service not in _indexes:
+            _indexes[service] = IntervalIndex(service)
+        index = _indexes[service]
+    with index.lock:
+        index.refresh(load, conf.interval_index_refresh)
+        return index.summaries(params.start, params.end)
@@ -0,0 +1,77 @@
+"""
+Client side of the usage report jobs.
+
+A job is submitted by POSTing the query string of a usage request to the
+jobs endpoint of a service. The returned job is then polled until it is
+done, its result is the response body the usage request would have had.
+"""
+import time
+
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds between polls of a job.
+POLL_INTERVAL = 5
+
+
+class JobFailed(Exception):
+    def __init__(self, job):
+        self.job = job
+        self.msg = "Usage report job {0} failed: {1}".format(
+            job.get('id'), job.get('error')
+        )
+        super(JobFailed, self).__init__(self.msg)
+
+
+class JobTimeout(Exception):
+    def __init__(self, job):
+        self.job = job
+        self.msg = "Usage report job {0} is still {1}.".format(
+            job.get('id'), job.get('status')
+        )
+        super(JobTimeout, self).__init__(self.msg)
+
+
+def submit_job(http_client, url):
+    """Submit a report job.
+
+    :param http_client: Client with post and get methods returning
+        (response, body) like the nova, cinder and glance clients
+    :param url: String - jobs path and usage query string
+    :returns: Dict - the job
+    """
+    resp, _body = http_client.post(url)
+    return resp.json()['job']
+
+
+def get_job(http_client, url):
+    """Get a report job.
+
+    :param http_client: Client, see submit_job
+    :param url: String - path of the job
+    :returns: Dict - the job
+    """
+    resp, _body = http_client.get(url)
+    return resp.json()['job']
+
+
+def wait_for_job(http_client, url, interval=POLL_INTERVAL, timeout=None):
+    """Poll a report job until it is done.
+
+    :param http_client: Client, see submit_job
+    :param url: String - path of the job
+    :param interval: Float - seconds between polls
+    :param timeout: Float|None - seconds to wait, None waits forever
+    :returns: Dict - the job, with its result
+    :raises: JobFailed, JobTimeout
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    while True:
+        job = get_job(http_client, url)
+        if job['status'] == DONE:
+            return job
+        if job['status'] == FAILED:
+            raise JobFailed(job)
+        if deadline is not None and time.time() + interval > deadline:
+            raise JobTimeout(job)
+        time.sleep(interval)
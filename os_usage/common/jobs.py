@@ -0,0 +1,252 @@
+"""
+Provides background report jobs for usage windows too large to compute
+within a request.
+
+A job is submitted with the query parameters of a usage request and is
+computed by a pool of worker threads of the API worker accepting it,
+apart from the interactive requests limited by admission control. The
+state and result of a job are kept in one owner only file per job in the
+job directory, so any worker of the service sharing the directory can
+answer a poll.
+
+A job expires job_expiry seconds after its last change, that is after it
+was submitted or finished. Expired jobs are removed by the next submit.
+"""
+import datetime
+import os
+import re
+import threading
+import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from webob import exc
+
+LOG = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _isotime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat()
+
+
+class JobStore(object):
+    """Directory of report job files."""
+
+    def __init__(self, path, expiry=86400):
+        """
+        :param path: String - directory of the job files
+        :param expiry: Integer - seconds a job is kept after its last change
+        """
+        self.path = os.path.expanduser(path)
+        self.expiry = expiry
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+
+    def _file(self, job_id):
+        return os.path.join(self.path, job_id + '.json')
+
+    def _write(self, job):
+        path = self._file(job['id'])
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                           threading.current_thread().ident)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(jsonutils.dumps(job))
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def create(self, owner, params):
+        """Create a queued job.
+
+        :param owner: String - project allowed to read the job
+        :param params: Dict - query parameters of the usage request
+        :returns: Dict - the job
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'owner': owner,
+            'params': dict(params),
+            'status': QUEUED,
+            'created_at': time.time(),
+            'finished_at': None,
+            'error': None,
+            'result': None
+        }
+        self._write(job)
+        return job
+
+    def update(self, job, **fields):
+        """Change and save a job.
+
+        :param job: Dict
+        :param fields: Job fields to set
+        """
+        job.update(fields)
+        self._write(job)
+
+    def get(self, job_id):
+        """Get a job.
+
+        :param job_id: String
+        :returns: Tuple|None - (job, expiry timestamp), None if unknown or
+            expired
+        """
+        if not _JOB_ID_RE.match(job_id or ''):
+            return None
+        path = self._file(job_id)
+        try:
+            expires = os.path.getmtime(path) + self.expiry
+            if expires <= time.time():
+                return None
+            with open(path) as f:
+                return jsonutils.loads(f.read()), expires
+        except (IOError, OSError, ValueError):
+            return None
+
+    def purge(self):
+        """Remove expired jobs and abandoned temporary files."""
+        now = time.time()
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) + self.expiry <= now:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+class JobRunner(object):
+    """Runs report jobs in a pool of worker threads."""
+
+    def __init__(self, store, workers=2):
+        """
+        :param store: JobStore
+        :param workers: Integer - jobs computed at once
+        """
+        self.store = store
+        self.pool = ThreadPool(workers)
+
+    def submit(self, owner, params, func):
+        """Queue a job.
+
+        :param owner: String - project allowed to read the job
+        :param params: Dict - query parameters of the usage request
+        :param func: Callable returning the response body of the report
+        :returns: Dict - the job
+        """
+        self.store.purge()
+        job = self.store.create(owner, params)
+        self.pool.apply_async(self._run, (job, func))
+        return job
+
+    def _run(self, job, func):
+        self.store.update(job, status=RUNNING)
+        try:
+            result = func()
+        except Exception as e:
+            LOG.exception("Usage report job %s failed.", job['id'])
+            self.store.update(
+                job, status=FAILED, finished_at=time.time(),
+                error=getattr(e, 'msg', None) or "Usage report failed."
+            )
+            return
+        self.store.update(job, status=DONE, finished_at=time.time(),
+                          result=result)
+
+
+def job_view(job, expires):
+    """Format a job for a response.
+
+    :param job: Dict
+    :param expires: Float - expiry timestamp
+    :returns: Dict
+    """
+    view = {
+        'id': job['id'],
+        'status': job['status'],
+        'params': job['params'],
+        'created_at': _isotime(job['created_at']),
+        'finished_at': _isotime(job['finished_at']),
+        'expires_at': _isotime(expires),
+        'error': job['error']
+    }
+    if job['status'] == DONE:
+        view['result'] = job['result']
+    return view
+
+
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def get_runner(conf):
+    """Get the job runner of a worker for its configuration.
+
+    :param conf: oslo_config group of the usage options
+    :returns: JobRunner|None - None when jobs are not enabled
+    """
+    if not conf.job_path:
+        return None
+    key = (conf.job_path, conf.job_workers, conf.job_expiry)
+    with _runners_lock:
+        if key not in _runners:
+            _runners[key] = JobRunner(
+                JobStore(conf.job_path, conf.job_expiry), conf.job_workers
+            )
+        return _runners[key]
+
+
+def _runner(conf):
+    runner = get_runner(conf)
+    if runner is None:
+        raise exc.HTTPNotFound(
+            explanation="Usage report jobs are not enabled."
+        )
+    return runner
+
+
+def submit(conf, owner, params, func):
+    """Submit a report job.
+
+    :param conf: oslo_config group of the usage options
+    :param owner: String - project allowed to read the job
+    :param params: Dict - query parameters of the usage request
+    :param func: Callable returning the response body of the report
+    :returns: Dict - job view
+    :raises: webob.exc.HTTPNotFound
+    """
+    runner = _runner(conf)
+    job = runner.submit(owner, params, func)
+    return job_view(job, job['created_at'] + runner.store.expiry)
+
+
+def show(conf, owner, job_id):
+    """Get a report job of a project.
+
+    :param conf: oslo_config group of the usage options
+    :param owner: String - project of the request
+    :param job_id: String
+    :returns: Dict - job view, including the result once done
+    :raises: webob.exc.HTTPNotFound
+    """
+    found = _runner(conf).store.get(job_id)
+    if found is None or found[0]['owner'] != owner:
+        raise exc.HTTPNotFound(
+            explanation="Usage report job {0} not found.".format(job_id)
+        )
+    return job_view(*found)
@@ -0,0 +1,306 @@
+"""
+Provides incremental decoding of the row list of a usage response.
+
+Usage responses are a JSON object holding one list of rows, for example
+{"tenant_usages": [...]}. ArrayItemDecoder is fed the body as it arrives
+and returns each row as soon as its closing bracket is seen, so a client
+can use the first tenant before a large detailed report has finished
+downloading. Only the row being received is buffered.
+
+Row boundaries are found by jumping between structural characters with a
+regular expression and tracking nesting and strings. Each complete row is
+then decoded with the json module. The list of detailed resource usages of
+a row can be kept as its raw text instead, in a RawList decoded only when
+it is read.
+"""
+import codecs
+import json
+import re
+
+from keystoneauth1 import adapter
+
+# Bytes read from the response at a time.
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\r\n'
+_STRUCTURE_RE = re.compile(r'[\[\]{}",]')
+_STRING_RE = re.compile(r'["\\]')
+# A list holding no other list. A raw list matching it is skipped in one
+# step instead of scanned, others are scanned as usual.
+_FLAT_LIST_RE = re.compile(
+    r'\[(?:[^\[\]"\\]*"(?:[^"\\]|\\.)*")*[^\[\]"\\]*\]'
+)
+
+
+class RawList(object):
+    """A JSON list kept as the text received, decoded when iterated."""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        """
+        :param text: String - JSON text of the list
+        """
+        self.text = text
+
+    def decode(self):
+        """Decode the list.
+
+        :returns: List
+        """
+        return json.loads(self.text)
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __nonzero__(self):
+        return bool(self.text.strip('[] \t\r\n'))
+
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        if isinstance(other, RawList):
+            other = other.decode()
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'RawList({0!r})'.format(self.text)
+
+
+class ArrayItemDecoder(object):
+    """Decodes the items of one list of a JSON object incrementally."""
+
+    def __init__(self, key, raw_key=None):
+        """
+        :param key: String - key of the list in the top level object
+        :param raw_key: String|None - key of a list in each item kept as
+            a RawList instead of being decoded
+        """
+        self._key_re = re.compile(
+            r'"{0}"\s*:\s*\['.format(re.escape(key))
+        )
+        self._raw_key = raw_key
+        self._raw_quoted = json.dumps(raw_key) if raw_key else None
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = u''
+        self._started = False
+        self._done = False
+        # Scan state of the item being received.
+        self._item_start = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        # Raw list of the item being received, offsets from its start.
+        self._string_start = None
+        self._raw_next = False
+        self._raw_start = None
+        self._raw_end = None
+
+    @property
+    def done(self):
+        """True once the closing bracket of the list was seen."""
+        return self._done
+
+    def feed(self, data):
+        """Feed the next part of the body.
+
+        :param data: Bytes|String
+        :returns: List - items completed by this part
+        """
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        if self._done:
+            return []
+        self._buffer += data
+        items = []
+        if not self._started:
+            match = self._key_re.search(self._buffer)
+            if match is None:
+                return items
+            self._started = True
+            self._buffer = self._buffer[match.end():]
+            self._pos = 0
+        self._scan(items)
+        # Drop consumed text so the buffer only holds the current item.
+        start = self._item_start if self._item_start is not None \
+            else self._pos
+        if start:
+            self._buffer = self._buffer[start:]
+            self._pos -= start
+            if self._item_start is not None:
+                self._item_start = 0
+        return items
+
+    def close(self):
+        """Check the body held a complete list.
+
+        :raises: ValueError
+        """
+        if not self._done:
+            raise ValueError("Truncated usage response.")
+
+    def _scan(self, items):
+        buf = self._buffer
+        length = len(buf)
+        pos = self._pos
+        while pos < length and not self._done:
+            if self._item_start is None:
+                # Between items, skip whitespace and separators.
+                char = buf[pos]
+                if char in _WHITESPACE or char == ',':
+                    pos += 1
+                    continue
+                if char == ']':
+                    self._done = True
+                    pos += 1
+                    break
+                self._item_start = pos
+                self._depth = 0
+                self._in_string = False
+                self._raw_next = False
+                self._raw_start = None
+                self._raw_end = None
+
+            if self._in_string:
+                match = _STRING_RE.search(buf, pos)
+                if match is None:
+                    pos = length
+                    break
+                if match.group() == '\\':
+                    if match.end() >= length:
+                        # Resume at the backslash once the escaped
+                        # character arrives.
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                if self._string_start is not None:
+                    # A string of the item object, if it is the raw key
+                    # its value may be the raw list.
+                    start = self._item_start + self._string_start
+                    self._raw_next = buf[start:pos] == self._raw_quoted
+                    self._string_start = None
+                continue
+
+            match = _STRUCTURE_RE.search(buf, pos)
+            if match is None:
+                pos = length
+                break
+            char = match.group()
+            pos = match.end()
+            if self._raw_next:
+                self._raw_next = False
+                if char == '[':
+                    self._raw_start = match.start() - self._item_start
+                    flat = _FLAT_LIST_RE.match(buf, match.start())
+                    if flat is not None:
+                        pos = flat.end()
+                        self._raw_end = pos - self._item_start
+                        continue
+            if char == '"':
+                self._in_string = True
+                if self._raw_key and self._depth == 1 and \
+                        self._raw_start is None:
+                    self._string_start = match.start() - self._item_start
+            elif char in '[{':
+                self._depth += 1
+            elif char in ']}':
+                if self._depth == 0:
+                    # The list closed right after a scalar item.
+                    self._emit(items, match.start())
+                    self._done = True
+                    break
+                self._depth -= 1
+                if self._depth == 1 and self._raw_start is not None and \
+                        self._raw_end is None:
+                    self._raw_end = pos - self._item_start
+                if self._depth == 0:
+                    self._emit(items, pos)
+            elif self._depth == 0:
+                # A comma ending a scalar item.
+                self._emit(items, match.start())
+        self._pos = pos
+
+    def _emit(self, items, end):
+        text = self._buffer[self._item_start:end].strip()
+        if self._raw_end is not None:
+            start, end = self._raw_start, self._raw_end
+            item = json.loads(text[:start] + '[]' + text[end:])
+            item[self._raw_key] = RawList(text[start:end])
+            items.append(item)
+        elif text:
+            items.append(json.loads(text))
+        self._item_start = None
+
+
+def stream_get(http_client, url):
+    """GET a url without reading the body.
+
+    The request goes through the keystoneauth adapter directly since the
+    project clients decode the whole body in their own request methods.
+
+    :param http_client: keystoneauth1.adapter.Adapter - session client of
+        a nova, cinder or glance client
+    :param url: String - path and query string
+    :returns: requests.Response
+    """
+    return adapter.Adapter.request(
+        http_client, url, 'GET', stream=True,
+        headers={'Accept': 'application/json'}
+    )
+
+
+def iter_items(chunks, key, raw_key=None):
+    """Decode the items of a list from an iterable of body parts.
+
+    :param chunks: Iterable of Bytes|String
+    :param key: String - key of the list in the top level object
+    :param raw_key: String|None - see ArrayItemDecoder
+    :yields: Decoded items
+    """
+    decoder = ArrayItemDecoder(key, raw_key)
+    for chunk in chunks:
+        for item in decoder.feed(chunk):
+            yield item
+        if decoder.done:
+            return
+    decoder.close()
+
+
+def _counted(chunks, counter):
+    for chunk in chunks:
+        counter.add(len(chunk))
+        yield chunk
+
+
+def stream_items(http_client, url, key, chunk_size=CHUNK_SIZE,
+                 raw_key=None, counter=None):
+    """GET a usage url and decode its rows as they arrive.
+
+    :param http_client: keystoneauth1.adapter.Adapter
+    :param url: String - path and query string
+    :param key: String - key of the row list, such as tenant_usages
+    :param chunk_size: Integer - bytes read at a time
+    :param raw_key: String|None - key of the resource usages in a row
+        kept as a RawList
+    :param counter: os_usage.common.http_cache.ByteCounter|None - counts
+        the body bytes read
+    :yields: Dict - response rows
+    """
+    resp = stream_get(http_client, url)
+    chunks = resp.iter_content(chunk_size)
+    if counter is not None:
+        chunks = _counted(chunks, counter)
+    try:
+        for item in iter_items(chunks, key, raw_key):
+            yield item
+    finally:
+        resp.close()
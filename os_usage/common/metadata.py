@@ -0,0 +1,296 @@
+"""
+Provides SQL helpers for resource metadata shared by the usage controllers.
+
+Nova instance metadata, cinder volume metadata and glance image properties
+are all key/value tables referencing a parent resource. MetadataTable
+describes one such table so the same query building code serves all three
+services.
+
+Metadata filters are dicts mapping a metadata key to a condition:
+
+    "value"                 key equals value
+    ["a", "b"]              key is one of the values
+    {"in": ["a", "b"]}      key is one of the values
+    {"not": "a"}            key is missing or does not equal the value
+    {"not": ["a", "b"]}     key is missing or is none of the values
+    {"exists": true}        key is present with any value
+    {"exists": false}       key is missing
+
+All conditions must hold. A filter compiles to one predicate of correlated
+EXISTS clauses, so matching resources are never multiplied by joins.
+
+The same syntax filters on columns of the resource table itself, see
+column_filter. There "exists" means the column is not null.
+"""
+import six
+
+from sqlalchemy import Boolean
+from sqlalchemy import and_
+from sqlalchemy import exists
+from sqlalchemy import not_
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import null
+
+# Key under which the grouped metadata value is stored in resource dicts.
+GROUP_VALUE_KEY = 'os_usage_metadata_value'
+
+FILTER_OPERATORS = ('in', 'not', 'exists')
+
+BOOLEAN_VALUES = {
+    'true': True,
+    '1': True,
+    'false': False,
+    '0': False
+}
+
+
+class InvalidMetadataFilter(Exception):
+    def __init__(self, msg):
+        super(InvalidMetadataFilter, self).__init__(msg)
+        self.msg = msg
+
+
+def _filter_values(key, values):
+    """Validate and normalize a value or list of values of a filter.
+
+    :param key: String - metadata key the values belong to
+    :param values: String|Number|List
+    :returns: List of String
+    """
+    if not isinstance(values, list):
+        values = [values]
+    if not values:
+        raise InvalidMetadataFilter(
+            "Metadata filter for {0} has an empty list.".format(key)
+        )
+    normalized = []
+    for value in values:
+        if isinstance(value, (dict, list)) or value is None:
+            raise InvalidMetadataFilter(
+                "Metadata filter values for {0} must be strings or "
+                "numbers.".format(key)
+            )
+        normalized.append(six.text_type(value))
+    return normalized
+
+
+def validate_filter(metadata):
+    """Validate a metadata filter.
+
+    :param metadata: Dict|None
+    :raises: InvalidMetadataFilter
+    """
+    if metadata is None:
+        return
+    if not isinstance(metadata, dict):
+        raise InvalidMetadataFilter("Metadata filter must be an object.")
+    for key, condition in metadata.items():
+        if not isinstance(condition, dict):
+            _filter_values(key, condition)
+            continue
+        if len(condition) != 1:
+            raise InvalidMetadataFilter(
+                "Metadata filter for {0} must have exactly one "
+                "operator.".format(key)
+            )
+        operator, argument = list(condition.items())[0]
+        if operator not in FILTER_OPERATORS:
+            raise InvalidMetadataFilter(
+                "Unknown metadata filter operator {0}. Must be one of "
+                "{1}.".format(operator, ', '.join(FILTER_OPERATORS))
+            )
+        if operator == 'exists':
+            if not isinstance(argument, bool):
+                raise InvalidMetadataFilter(
+                    "Metadata filter exists for {0} must be true or "
+                    "false.".format(key)
+                )
+        else:
+            _filter_values(key, argument)
+
+
+class MetadataTable(object):
+    """Describes a metadata table and how it references its parent."""
+
+    def __init__(self, model, parent, key_column='key',
+                 foreign_key='id', parent_key='id'):
+        """
+        :param model: SQLAlchemy model of the metadata table
+        :param parent: SQLAlchemy model of the resource table
+        :param key_column: String - name of the metadata key column
+        :param foreign_key: String - metadata column referencing the parent
+        :param parent_key: String - parent column referenced
+        """
+        self.model = model
+        self.parent = parent
+        self.key_column = key_column
+        self.foreign_key = foreign_key
+        self.parent_key = parent_key
+
+    def join_condition(self, alias):
+        """Condition joining alias to a live row of the parent.
+
+        Metadata rows are soft deleted together with their resource, so a
+        row deleted at the same time as the resource still applies.
+
+        :param alias: Aliased metadata model
+        :returns: SQL expression
+        """
+        parent = self.parent
+        return and_(
+            getattr(alias, self.foreign_key) ==
+            getattr(parent, self.parent_key),
+            or_(alias.deleted_at == null(),
+                alias.deleted_at == parent.deleted_at)
+        )
+
+
+def add_group_value(query, table, key):
+    """Outer join the value of one metadata key onto a query.
+
+    The value is added as the last column of each result row. Resources
+    without the key get None.
+
+    :param query: SQLAlchemy query selecting table.parent
+    :param table: MetadataTable
+    :param key: String - metadata key to group by
+    :returns: SQLAlchemy query
+    """
+    alias = aliased(table.model)
+    query = query.outerjoin(alias, and_(
+        table.join_condition(alias),
+        getattr(alias, table.key_column) == key
+    ))
+    return query.add_columns(alias.value)
+
+
+def _operator(condition):
+    """Split a validated condition into its operator and argument."""
+    if isinstance(condition, dict):
+        return list(condition.items())[0]
+    return 'in', condition
+
+
+def _key_clause(table, key, condition):
+    """Compile the condition on one metadata key.
+
+    :param table: MetadataTable
+    :param key: String
+    :param condition: see module docstring
+    :returns: SQL expression
+    """
+    alias = aliased(table.model)
+    has_key = and_(
+        table.join_condition(alias),
+        getattr(alias, table.key_column) == key
+    )
+
+    operator, argument = _operator(condition)
+    if operator == 'exists':
+        clause = exists().where(has_key)
+        return clause if argument else not_(clause)
+
+    values = _filter_values(key, argument)
+    if len(values) == 1:
+        matches = alias.value == values[0]
+    else:
+        matches = alias.value.in_(values)
+    clause = exists().where(and_(has_key, matches))
+    if operator == 'not':
+        return not_(clause)
+    return clause
+
+
+def metadata_filter(table, metadata):
+    """Compile a metadata filter into a single predicate on table.parent.
+
+    :param table: MetadataTable
+    :param metadata: Dict|None - see module docstring
+    :returns: SQL expression|None - None when there is nothing to filter
+    :raises: InvalidMetadataFilter
+    """
+    if not metadata:
+        return None
+    validate_filter(metadata)
+    return and_(*[
+        _key_clause(table, key, metadata[key]) for key in sorted(metadata)
+    ])
+
+
+def _column_values(column, key, values):
+    """Convert filter values to the python type of a column.
+
+    :param column: SQLAlchemy column attribute
+    :param key: String - column name
+    :param values: see module docstring
+    :returns: List
+    """
+    values = _filter_values(key, values)
+    if not isinstance(column.type, Boolean):
+        return values
+    converted = []
+    for value in values:
+        if value.lower() not in BOOLEAN_VALUES:
+            raise InvalidMetadataFilter(
+                "Filter values for {0} must be true or false.".format(key)
+            )
+        converted.append(BOOLEAN_VALUES[value.lower()])
+    return converted
+
+
+def _column_clause(column, key, condition):
+    operator, argument = _operator(condition)
+    if operator == 'exists':
+        return column != null() if argument else column == null()
+
+    values = _column_values(column, key, argument)
+    if len(values) == 1:
+        matches = column == values[0]
+    else:
+        matches = column.in_(values)
+    if operator == 'not':
+        return or_(column == null(), not_(matches))
+    return matches
+
+
+def validate_column_filter(filters, columns, model=None):
+    """Validate a filter on resource columns.
+
+    :param filters: Dict|None
+    :param columns: Tuple of String - column names that may be filtered
+    :param model: SQLAlchemy model|None - when given the values are also
+        checked against the types of its columns
+    :raises: InvalidMetadataFilter
+    """
+    validate_filter(filters)
+    for key in filters or ():
+        if key not in columns:
+            raise InvalidMetadataFilter(
+                "Unknown filter column {0}. Must be one of {1}.".format(
+                    key, ', '.join(columns)
+                )
+            )
+        operator, argument = _operator(filters[key])
+        if model is not None and operator != 'exists':
+            _column_values(getattr(model, key), key, argument)
+
+
+def column_filter(model, filters, columns):
+    """Compile a filter on columns of model into a single predicate.
+
+    :param model: SQLAlchemy model of the resource table
+    :param filters: Dict|None - see module docstring
+    :param columns: Tuple of String - column names that may be filtered.
+        Names the model does not have are ignored.
+    :returns: SQL expression|None - None when there is nothing to filter
+    :raises: InvalidMetadataFilter
+    """
+    if not filters:
+        return None
+    columns = tuple(column for column in columns if hasattr(model, column))
+    validate_column_filter(filters, columns, model)
+    return and_(*[
+        _column_clause(getattr(model, key), key, filters[key])
+        for key in sorted(filters)
+    ])
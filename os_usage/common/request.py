@@ -1,77 +1,247 @@
+"""
+Request parameter handling shared by the nova, cinder and glance usage
+controllers.
+"""
 import datetime
 import iso8601
-import six
-import six.moves.urllib.parse as urlparse
+import re
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 from oslo_utils import timeutils
 
+from os_usage.common import metadata as usage_metadata
+
 LOG = logging.getLogger(__name__)
 
+UTC = iso8601.iso8601.Utc()
 
-class StartGreaterThanEnd(Exception):
-    def __init__(self):
-        self.msg = ("Invalid start time. The start time cannot occur after "
-                    "the end time.")
-        super(StartGreaterThanEnd, self).__init__(self.msg)
+# Single pass ISO-8601 parser. Accepts the formats previously tried one at a
+# time with strptime plus an optional UTC offset.
+_DATETIME_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d{1,6})\d*)?'
+    r'(?:(Z)|([+-])(\d{2}):?(\d{2}))?$'
+)
+
+# Parsed datetimes keyed by their string. Usage windows are usually day
+# aligned so the same strings come back request after request.
+_DATETIME_CACHE = {}
+_DATETIME_CACHE_SIZE = 1024
 
+MAX_LIMIT = 1000
 
-class InvalidStrTime(Exception):
+
+class InvalidRequest(Exception):
     def __init__(self, msg):
-        super(InvalidStrTime, self).__init__(msg)
+        super(InvalidRequest, self).__init__(msg)
         self.msg = msg
 
 
-def parse_strtime(dstr, fmt):
+class StartGreaterThanEnd(InvalidRequest):
+    def __init__(self):
+        super(StartGreaterThanEnd, self).__init__(
+            "Invalid start time. The start time cannot occur after "
+            "the end time."
+        )
+
+
+class InvalidStrTime(InvalidRequest):
+    pass
+
+
+def _parse_isotime(dtstr):
+    match = _DATETIME_RE.match(dtstr)
+    if match is None:
+        raise InvalidStrTime("Datetime is in invalid format")
+    (year, month, day, hour, minute, second,
+     fraction, zulu, sign, off_hours, off_minutes) = match.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
     try:
-        return timeutils.parse_strtime(dstr, fmt)
-    except (TypeError, ValueError) as e:
-        raise InvalidStrTime(six.text_type(e))
+        value = datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour), int(minute), int(second), microsecond
+        )
+    except ValueError as e:
+        raise InvalidStrTime(str(e))
+    if sign:
+        offset = datetime.timedelta(hours=int(off_hours),
+                                    minutes=int(off_minutes))
+        if sign == '+':
+            value -= offset
+        else:
+            value += offset
+    # NOTE(mriedem): Instance object DateTime fields are timezone-aware
+    # so we have to force UTC timezone for comparing this datetime against
+    # volume object fields and still maintain backwards compatibility
+    # in the API.
+    return value.replace(tzinfo=UTC)
 
 
 def parse_datetime(dtstr):
     """
     Parse a datetime string.
 
-    :param dtstr: String
+    Empty values are the current time. Naive values are UTC.
+
+    :param dtstr: String|Datetime|None
+    :returns: Datetime - timezone aware
     """
     if not dtstr:
-        value = timeutils.utcnow()
-    elif isinstance(dtstr, datetime.datetime):
-        value = dtstr
-    else:
-        for fmt in ["%Y-%m-%dT%H:%M:%S",
-                    "%Y-%m-%dT%H:%M:%S.%f",
-                    "%Y-%m-%d %H:%M:%S.%f"]:
-            try:
-                value = parse_strtime(dtstr, fmt)
-                break
-            except InvalidStrTime:
-                pass
-        else:
-            msg = "Datetime is in invalid format"
-            raise InvalidStrTime(msg)
+        return timeutils.utcnow().replace(tzinfo=UTC)
+    if isinstance(dtstr, datetime.datetime):
+        if dtstr.utcoffset() is None:
+            return dtstr.replace(tzinfo=UTC)
+        return dtstr
+    value = _DATETIME_CACHE.get(dtstr)
+    if value is None:
+        value = _parse_isotime(dtstr)
+        if len(_DATETIME_CACHE) >= _DATETIME_CACHE_SIZE:
+            _DATETIME_CACHE.clear()
+        _DATETIME_CACHE[dtstr] = value
+    return value
+
+
+def _choice(params, name, choices):
+    value = params.get(name)
+    if value is not None and value not in choices:
+        raise InvalidRequest(
+            "Invalid {0}. Must be one of {1}.".format(name, ', '.join(choices))
+        )
+    return value
 
-        # NOTE(mriedem): Instance object DateTime fields are timezone-aware
-        # so we have to force UTC timezone for comparing this datetime against
-        # volume object fields and still maintain backwards compatibility
-        # in the API.
-        if value.utcoffset() is None:
-            value = value.replace(tzinfo=iso8601.iso8601.Utc())
-        return value
+
+def _limit(params):
+    value = params.get('limit')
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise InvalidRequest("Invalid limit. Must be a positive integer.")
+    return min(value, MAX_LIMIT)
 
 
-def get_datetime_range(req):
-    """Gets the datetime range from a wsgi request.
+def _timeout(params):
+    value = params.get('timeout')
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise InvalidRequest("Invalid timeout. Must be a positive number.")
+    return value
 
-    :param req: Dict
-    :param service: String - one of (nova, glance, cinder)
+
+def _json_object(params, name):
+    value = params.get(name)
+    if not value:
+        return {}
+    try:
+        value = jsonutils.loads(value)
+    except ValueError:
+        raise InvalidRequest(
+            "Invalid {0}. Must be a JSON object.".format(name)
+        )
+    return value
+
+
+def _metadata(params):
+    value = _json_object(params, 'metadata')
+    try:
+        usage_metadata.validate_filter(value)
+    except usage_metadata.InvalidMetadataFilter as e:
+        raise InvalidRequest(e.msg)
+    return value
+
+
+def _filters(params, columns, model):
+    value = _json_object(params, 'filters')
+    if value and not columns:
+        raise InvalidRequest("Column filters are not supported.")
+    try:
+        usage_metadata.validate_column_filter(value, columns, model)
+    except usage_metadata.InvalidMetadataFilter as e:
+        raise InvalidRequest(e.msg)
+    return value
+
+
+class UsageParams(object):
+    """Validated parameters of a usage request.
+
+    :param params: Dict like - the query parameters, usually req.GET
+    :param breakdowns: Tuple - accepted breakdown values
+    :param group_bys: Tuple - accepted group_by values
+    :param filter_columns: Tuple - resource columns accepted in filters
+    :param filter_model: SQLAlchemy model|None - resource model the filter
+        values are checked against
+    :param now: Datetime|None - end of the period is clamped to this. A
+        period ending before it is closed and its usage no longer grows.
     """
-    query_string = req.environ.get('QUERY_STRING', '')
-    env = urlparse.parse_qs(query_string)
-    period_start = parse_datetime(env.get('start', [None])[0])
-    period_stop = parse_datetime(env.get('end', [None])[0])
-    if not period_start < period_stop:
-        raise StartGreaterThanEnd()
-
-    detailed = env.get('detailed', ['0'])[0] == '1'
-    return (period_start, period_stop, detailed)
+
+    def __init__(self, params, breakdowns=(), group_bys=(),
+                 filter_columns=(), filter_model=None, now=None):
+        self.start = parse_datetime(params.get('start'))
+        self.end = parse_datetime(params.get('end'))
+        if not self.start < self.end:
+            raise StartGreaterThanEnd()
+        now = parse_datetime(now)
+        self.closed = self.end <= now
+        if not self.closed:
+            self.end = now
+
+        self.detailed = params.get('detailed', '0') == '1'
+        self.metadata = _metadata(params)
+        self.filters = _filters(params, filter_columns, filter_model)
+        self.group_by_metadata = params.get('group_by_metadata')
+        self.breakdown = _choice(params, 'breakdown', breakdowns)
+        self.group_by = _choice(params, 'group_by', group_bys)
+        self.host = params.get('host')
+        self.limit = _limit(params)
+        self.marker = params.get('marker')
+        # Seconds the report may take, capped by the service configuration.
+        self.timeout = _timeout(params)
+
+    @classmethod
+    def from_request(cls, req, **kwargs):
+        """Validate the query parameters of a webob request.
+
+        :param req: webob.Request
+        :returns: UsageParams
+        """
+        return cls(req.GET, **kwargs)
+
+
+def paginate(summaries, key, params):
+    """Page through summaries by key.
+
+    Summaries sharing a key, such as the grouped rows of one tenant, are
+    kept on the same page. A page holds up to params.limit keys that sort
+    after params.marker.
+
+    :param summaries: List of dicts
+    :param key: String - summary field to page by
+    :param params: UsageParams
+    :returns: List
+    """
+    if params.limit is None and params.marker is None:
+        return summaries
+    summaries = sorted(summaries, key=lambda summary: summary[key])
+    if params.marker is not None:
+        summaries = [s for s in summaries if s[key] > params.marker]
+    if params.limit is None:
+        return summaries
+    page = []
+    last = None
+    count = 0
+    for summary in summaries:
+        if summary[key] != last:
+            count += 1
+            if count > params.limit:
+                break
+            last = summary[key]
+        page.append(summary)
+    return page
@@ -0,0 +1,171 @@
+"""
+Provides a compact columnar container for per resource usage rows.
+
+Detailed reports hold one row per server, volume or image. Rows are stored
+by column instead of as one dict per row. Numeric columns use typed arrays
+and strings are interned in a pool shared by every tenant of a report.
+"""
+import numbers
+
+from array import array
+
+import six
+
+
+def _new_column(value, strings):
+    """Create a column holding a single value.
+
+    :param value: First value of the column
+    :param strings: Dict - string intern pool
+    :returns: array|list
+    """
+    if isinstance(value, float):
+        return array('d', [value])
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        try:
+            return array('l', [value])
+        except OverflowError:
+            pass
+    if isinstance(value, six.string_types):
+        value = strings.setdefault(value, value)
+    return [value]
+
+
+class _Segment(object):
+    """Columns for rows sharing the same set of keys."""
+
+    __slots__ = ('fields', 'columns', 'length')
+
+    def __init__(self, fields):
+        """
+        :param fields: Tuple of String|None - None for rows that are not
+            dicts and are kept as is
+        """
+        self.fields = fields
+        self.columns = None
+        self.length = 0
+
+    def append(self, values, strings):
+        """Append one row of values in field order.
+
+        :param values: List
+        :param strings: Dict - string intern pool
+        """
+        if self.columns is None:
+            self.columns = [_new_column(value, strings) for value in values]
+            self.length = 1
+            return
+
+        columns = self.columns
+        for i, value in enumerate(values):
+            column = columns[i]
+            if isinstance(value, six.string_types):
+                value = strings.setdefault(value, value)
+            if isinstance(column, array):
+                try:
+                    if column.typecode == 'l' and \
+                            (not isinstance(value, numbers.Integral) or
+                             isinstance(value, bool)):
+                        raise TypeError()
+                    column.append(value)
+                    continue
+                except (TypeError, OverflowError):
+                    column = columns[i] = list(column)
+            column.append(value)
+        self.length += 1
+
+    def row(self, index):
+        """Rebuild the row at index.
+
+        :param index: Integer
+        :returns: Dict|Object
+        """
+        values = [column[index] for column in self.columns]
+        if self.fields is None:
+            return values[0]
+        return dict(zip(self.fields, values))
+
+
+class ResourceUsages(object):
+    """List like container of resource usage rows.
+
+    Supports append, extend, len, indexing and iteration. Iteration yields
+    a new dict per row in the order rows were added.
+    """
+
+    __slots__ = ('_strings', '_segments', '_segment_index', '_order',
+                 '_positions')
+
+    def __init__(self, resource_usages=None, strings=None):
+        """
+        :param resource_usages: Iterable|None - initial rows
+        :param strings: Dict|None - string intern pool to share
+        """
+        self._strings = strings if strings is not None else {}
+        self._segments = []
+        self._segment_index = {}
+        self._order = array('H')
+        self._positions = array('l')
+        if resource_usages:
+            self.extend(resource_usages)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        """
+        :yields: Dict - one per resource usage row
+        """
+        segments = self._segments
+        for segment_index, position in zip(self._order, self._positions):
+            yield segments[segment_index].row(position)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._segments[self._order[index]].row(self._positions[index])
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "<ResourceUsages: {0} rows>".format(len(self))
+
+    def append(self, resource_usage):
+        """Add one resource usage row.
+
+        :param resource_usage: Dict
+        """
+        if isinstance(resource_usage, dict):
+            fields = tuple(sorted(resource_usage))
+            values = [resource_usage[field] for field in fields]
+        else:
+            fields = None
+            values = [resource_usage]
+
+        segment_index = self._segment_index.get(fields)
+        if segment_index is None:
+            segment_index = len(self._segments)
+            self._segments.append(_Segment(fields))
+            self._segment_index[fields] = segment_index
+        segment = self._segments[segment_index]
+        self._order.append(segment_index)
+        self._positions.append(segment.length)
+        segment.append(values, self._strings)
+
+    def extend(self, resource_usages):
+        """Add resource usage rows.
+
+        :param resource_usages: Iterable
+        """
+        for resource_usage in resource_usages:
+            self.append(resource_usage)
@@ -0,0 +1,141 @@
+"""
+Provides a local SQLite store of usage fetched for closed time windows.
+
+Usage for a window that has ended cannot change, so it only needs to be
+fetched from the API once. Usage is stored per scope, the endpoint it was
+read from and the project and user it was read as, so a store file shared
+by runs against other clouds or with other credentials never answers for
+them.
+"""
+import datetime
+import json
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS windows (
+    service TEXT NOT NULL,
+    query TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    fetched_at TEXT NOT NULL,
+    PRIMARY KEY (service, query, start, end)
+);
+CREATE TABLE IF NOT EXISTS tenant_usages (
+    service TEXT NOT NULL,
+    query TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    tenant_id TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tenant_usages_window
+    ON tenant_usages (service, query, start, end);
+"""
+
+
+def client_scope(http_client):
+    """Get the scope usage is read in through a keystone session client.
+
+    :param http_client: keystoneauth1.adapter.Adapter of a service client
+    :returns: Dict - endpoint url, project id and user id
+    """
+    return {
+        'endpoint': http_client.get_endpoint(),
+        'project_id': http_client.get_project_id(),
+        'user_id': http_client.get_user_id()
+    }
+
+
+def query_key(metadata=None, detailed=False, scope=None):
+    """Build the key identifying the parameters of a usage query.
+
+    :param metadata: Dict|None
+    :param detailed: Boolean
+    :param scope: Dict|None - see client_scope
+    :returns: String
+    """
+    return json.dumps(
+        {'metadata': metadata or {}, 'detailed': bool(detailed),
+         'scope': scope or {}},
+        sort_keys=True
+    )
+
+
+class UsageStore(object):
+    """Stores per tenant usage dicts for closed windows."""
+
+    def __init__(self, path):
+        """Inits the store.
+
+        :param path: String path to the SQLite database. ':memory:' is
+            accepted for a store that lasts as long as the object.
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        # Services are fetched in parallel and share the connection.
+        self.lock = threading.Lock()
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
+
+    def get(self, service, query, start, end):
+        """Get the usage dict stored for a window.
+
+        :param service: String - one of (nova, glance, cinder)
+        :param query: String - see query_key
+        :param start: Datetime
+        :param end: Datetime
+        :returns: Dict|None - None if the window has not been stored
+        """
+        key = (service, query, start.isoformat(), end.isoformat())
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        cursor = self.conn.execute(
+            "SELECT 1 FROM windows WHERE service = ? AND query = ? "
+            "AND start = ? AND end = ?",
+            key
+        )
+        if cursor.fetchone() is None:
+            return None
+
+        usage_dict = {}
+        cursor = self.conn.execute(
+            "SELECT tenant_id, payload FROM tenant_usages WHERE "
+            "service = ? AND query = ? AND start = ? AND end = ?",
+            key
+        )
+        for tenant_id, payload in cursor:
+            usage_dict[tenant_id] = json.loads(payload)
+        return usage_dict
+
+    def put(self, service, query, start, end, usage_dict):
+        """Store the usage dict for a window.
+
+        :param service: String - one of (nova, glance, cinder)
+        :param query: String - see query_key
+        :param start: Datetime
+        :param end: Datetime
+        :param usage_dict: Dict
+        """
+        key = (service, query, start.isoformat(), end.isoformat())
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM tenant_usages WHERE service = ? AND query = ? "
+                "AND start = ? AND end = ?",
+                key
+            )
+            self.conn.executemany(
+                "INSERT INTO tenant_usages VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (tenant_id, json.dumps(tenant_dict, default=str))
+                 for tenant_id, tenant_dict in usage_dict.items()]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?)",
+                key + (datetime.datetime.utcnow().isoformat(),)
+            )
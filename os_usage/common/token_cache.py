@@ -0,0 +1,86 @@
+"""
+Provides an on disk cache of keystone auth state.
+
+Short lived processes such as cron driven collectors can reuse a token and
+service catalog from a previous run instead of authenticating every time.
+"""
+import json
+import os
+
+
+class TokenCache(object):
+    """Persists the auth state of a keystoneauth1 identity plugin.
+
+    The cache file is written with owner only permissions and is keyed by the
+    plugin cache id so that a cache created with one set of credentials is
+    never installed into a plugin using another.
+    """
+    def __init__(self, path, margin=300):
+        """Inits the token cache.
+
+        :param path: String path to the cache file
+        :param margin: Integer - seconds before expiry a cached token is
+            considered stale
+        """
+        self.path = os.path.expanduser(path)
+        self.margin = margin
+
+    def load(self, auth):
+        """Install cached auth state into an auth plugin.
+
+        :param auth: keystoneauth1 identity plugin
+        :returns: Boolean - True if a usable token was installed
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            cache_id = data['cache_id']
+            state = data['state']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+
+        if cache_id != auth.get_cache_id():
+            return False
+
+        try:
+            auth.set_auth_state(state)
+        except (ValueError, KeyError, TypeError):
+            auth.set_auth_state(None)
+            return False
+
+        auth_ref = auth.auth_ref
+        if auth_ref is None or auth_ref.will_expire_soon(self.margin):
+            auth.set_auth_state(None)
+            return False
+        return True
+
+    def save(self, auth):
+        """Persist the auth state of an auth plugin.
+
+        The state is written to a temporary file that is renamed over the
+        cache file so readers never see a partial write.
+
+        :param auth: keystoneauth1 identity plugin
+        """
+        state = auth.get_auth_state()
+        if not state:
+            return
+        data = json.dumps({'cache_id': auth.get_cache_id(), 'state': state})
+
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def clear(self):
+        """Remove the cache file if present."""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,192 @@
+"""
+Helpers for the usage dict structure produced by the usage clients.
+
+A usage dict maps tenant ids to a dict with 'metrics' and 'resource_usages'
+keys as returned by the to_dict methods of the usage clients.
+"""
+import collections
+import numbers
+
+from os_usage.common.json_stream import RawList
+
+# Keys identifying a resource usage row for nova, cinder and glance.
+RESOURCE_ID_KEYS = ('instance_id', 'volume_id', 'id')
+RESOURCE_SERVICES = {
+    'instance_id': 'nova',
+    'volume_id': 'cinder',
+    'id': 'glance'
+}
+
+# Fields of a grouped usage response row that identify its group. The
+# metadata fields come from group_by_metadata, the others from breakdown.
+GROUP_FIELDS = (
+    'metadata_key',
+    'metadata_value',
+    'flavor',
+    'volume_type',
+    'disk_format',
+    'container_format'
+)
+
+_MISSING = object()
+
+# Describes the rows of a usage response for translate.
+# tenant_key: field holding the tenant id
+# metrics: fields summed into the tenant metrics, 0 when missing
+# resources_key: field holding the list of detailed resource usages
+Schema = collections.namedtuple(
+    'Schema', ('tenant_key', 'metrics', 'resources_key')
+)
+
+
+def get_group(get):
+    """Get the group fields of a usage response row.
+
+    :param get: Callable accepting (name, default) that reads a field of
+        the response row
+    :returns: Dict|None - None if the row is not grouped
+    """
+    group = {}
+    for field in GROUP_FIELDS:
+        value = get(field, _MISSING)
+        if value is not _MISSING:
+            group[field] = value
+    return group or None
+
+
+def _group_key(group):
+    return tuple(sorted(
+        (field, value) for field, value in group.items() if field != 'metrics'
+    ))
+
+
+def _add_metrics(target, metrics):
+    for name, value in metrics.items():
+        current = target.get(name)
+        if isinstance(current, numbers.Number) and \
+                isinstance(value, numbers.Number):
+            value = current + value
+        target[name] = value
+
+
+def add_tenant_usage(usage, tenant_id, metrics, resource_usages=(),
+                     group=None):
+    """Add one usage response row for a tenant to a usage dict.
+
+    Grouped responses have several rows per tenant. Their metrics are
+    summed into the tenant metrics and also kept per group in a 'groups'
+    list.
+
+    :param usage: Dict - usage dict to add to
+    :param tenant_id: String
+    :param metrics: Dict
+    :param resource_usages: List|os_usage.common.json_stream.RawList - a
+        RawList is kept undecoded when it is the tenant's only one
+    :param group: Dict|None - see get_group
+    """
+    if tenant_id not in usage:
+        usage[tenant_id] = {'metrics': {}, 'resource_usages': []}
+    tenant_dict = usage[tenant_id]
+    _add_metrics(tenant_dict['metrics'], metrics)
+    current = tenant_dict['resource_usages']
+    if isinstance(resource_usages, RawList) and not current:
+        tenant_dict['resource_usages'] = resource_usages
+    elif resource_usages:
+        if isinstance(current, RawList):
+            current = tenant_dict['resource_usages'] = current.decode()
+        current.extend(resource_usages)
+    if group is not None:
+        tenant_dict.setdefault('groups', []).append(
+            dict(group, metrics=dict(metrics))
+        )
+
+
+def translate(rows, schema):
+    """Translate raw usage response rows into a usage dict.
+
+    Rows are read as plain dicts, without building a client Resource per
+    row and reading its attributes back out.
+
+    :param rows: Iterable of dicts - decoded response rows
+    :param schema: Schema
+    :returns: Dict
+    """
+    tenant_key, metrics, resources_key = schema
+    usage = {}
+    for row in rows:
+        if not row:
+            continue
+        get = row.get
+        add_tenant_usage(
+            usage,
+            get(tenant_key),
+            dict((metric, get(metric, 0)) for metric in metrics),
+            get(resources_key, ()),
+            get_group(get)
+        )
+    return usage
+
+
+def resource_id(resource_usage):
+    """Get the identifier of a resource usage row.
+
+    :param resource_usage: Dict
+    :returns: Tuple|None - (key, value)
+    """
+    for key in RESOURCE_ID_KEYS:
+        if key in resource_usage:
+            return (key, resource_usage[key])
+    return None
+
+
+def merge_usage_dicts(usage_dicts):
+    """Merge usage dicts for disjoint time windows of the same query.
+
+    Metrics are summed per tenant and per group. Resource usages spanning
+    more than one window are collapsed into one row whose hours are the sum
+    of the hours in each window. All other resource fields are taken from
+    the latest window.
+
+    :param usage_dicts: Iterable of Dicts
+    :returns: Dict
+    """
+    merged = {}
+    rows_by_id = {}
+    groups_by_key = {}
+    for usage_dict in usage_dicts:
+        for tenant_id, tenant_dict in usage_dict.items():
+            if tenant_id not in merged:
+                merged[tenant_id] = {'metrics': {}, 'resource_usages': []}
+                rows_by_id[tenant_id] = {}
+                groups_by_key[tenant_id] = {}
+            tenant_merged = merged[tenant_id]
+            _add_metrics(tenant_merged['metrics'],
+                         tenant_dict.get('metrics', {}))
+
+            tenant_groups = groups_by_key[tenant_id]
+            for group in tenant_dict.get('groups', []):
+                key = _group_key(group)
+                if key not in tenant_groups:
+                    tenant_groups[key] = dict(group, metrics={})
+                    tenant_merged.setdefault('groups', []).append(
+                        tenant_groups[key]
+                    )
+                _add_metrics(tenant_groups[key]['metrics'],
+                             group.get('metrics', {}))
+
+            tenant_rows = rows_by_id[tenant_id]
+            for row in tenant_dict.get('resource_usages', []):
+                key = resource_id(row)
+                if key is None:
+                    tenant_merged['resource_usages'].append(row)
+                    continue
+                if key not in tenant_rows:
+                    row = dict(row)
+                    tenant_rows[key] = row
+                    tenant_merged['resource_usages'].append(row)
+                    continue
+                existing = tenant_rows[key]
+                hours = existing.get('hours', 0) + row.get('hours', 0)
+                existing.update(row)
+                existing['hours'] = hours
+    return merged
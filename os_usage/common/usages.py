@@ -1,30 +1,101 @@
+import numbers
+import sys
+import threading
+import time
+
+import six
+
+from array import array
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
 from os_usage.nova.client import UsageClient as NovaUsage
 from os_usage.glance.client import UsageClient as GlanceUsage
 from os_usage.cinder.client import UsageClient as CinderUsage
+from os_usage.common import store as usage_store
+from os_usage.common import usage_dict as usage_dicts
+from os_usage.common import windows
+from os_usage.common.resource_usages import ResourceUsages
 
 
 class DuplicateMetricError(Exception):
     pass
 
 
-class TenantUsage():
+SERVICES = ('nova', 'glance', 'cinder')
+
+# Streamed usage dicts waiting to be added before fetch threads block.
+STREAM_QUEUE_SIZE = 64
+
+# Seconds a fetch thread blocked on a full queue waits before checking if
+# the consumer stopped.
+STREAM_PUT_TIMEOUT = 0.1
+
+# Metrics reported by the usage clients. Values for these are kept in a
+# typed array. Any other metric is kept in a dict.
+METRIC_NAMES = (
+    'nova-total_hours',
+    'nova-total_local_gb_usage',
+    'nova-total_memory_mb_usage',
+    'nova-total_vcpus_usage',
+    'glance-total_gb_hours',
+    'cinder-total_gb_usage',
+    'cinder-total_hours'
+)
+METRIC_INDEX = dict((name, i) for i, name in enumerate(METRIC_NAMES))
+
+# How detailed resource usage rows are kept.
+# eager: converted to the columnar container as they are added
+# lazy: kept as received and decoded on first access, streamed responses
+#     keep the raw JSON text of each row
+# drop: discarded, for callers only reading metrics
+RESOURCES_EAGER = 'eager'
+RESOURCES_LAZY = 'lazy'
+RESOURCES_DROP = 'drop'
+RESOURCE_MODES = (RESOURCES_EAGER, RESOURCES_LAZY, RESOURCES_DROP)
+
+
+class TenantUsage(object):
     """Models usage for a single Tenant"""
 
-    def __init__(self, tenant_id):
+    __slots__ = ('tenant_id', '_values', '_present', '_extra',
+                 '_resource_usages', '_pending', '_strings', '_resources')
+
+    def __init__(self, tenant_id, strings=None, resources=RESOURCES_EAGER):
         """
         :param tenant_id: String
+        :param strings: Dict|None - string intern pool shared with other
+            tenants for resource usages
+        :param resources: String - one of RESOURCE_MODES
         """
+        if resources not in RESOURCE_MODES:
+            raise ValueError("Unknown resources mode {0}".format(resources))
         self.tenant_id = tenant_id
-        self.metrics = {}
-        self.resource_usages = []
+        self._values = array('d', [0.0]) * len(METRIC_NAMES)
+        self._present = 0
+        self._extra = None
+        self._resource_usages = None
+        self._pending = None
+        self._strings = strings
+        self._resources = resources
 
     def __iter__(self):
         """Iterate over metric name/value pairs.
 
         :yields: tuple
         """
-        for key, value in self.metrics.iteritems():
-            yield (key, value)
+        present = self._present
+        for i, name in enumerate(METRIC_NAMES):
+            if present & (1 << i):
+                yield (name, self._values[i])
+        if self._extra:
+            for key, value in self._extra.iteritems():
+                yield (key, value)
+
+    @property
+    def metrics(self):
+        """Dict of metric name to value."""
+        return dict(self)
 
     def add_metric(self, metric_name, metric_value):
         """Add a metric name/value pair.
@@ -32,17 +103,59 @@ class TenantUsage():
         :param metric_name: String
         :param metric_value: Numeric|String|None
         """
-        if metric_name in self.metrics:
+        index = METRIC_INDEX.get(metric_name)
+        if index is not None and self._present & (1 << index) or \
+                self._extra and metric_name in self._extra:
             raise DuplicateMetricError(
                 'Metric {0} already exists.'.format(metric_name)
             )
-        self.metrics[metric_name] = metric_value
+        if index is not None and \
+                isinstance(metric_value, numbers.Real) and \
+                not isinstance(metric_value, bool):
+            self._values[index] = metric_value
+            self._present |= 1 << index
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[metric_name] = metric_value
+
+    @property
+    def resource_usages(self):
+        """ResourceUsages of the tenant, decoding pending rows first."""
+        if self._resource_usages is None:
+            self._resource_usages = ResourceUsages(strings=self._strings)
+        if self._pending:
+            pending, self._pending = self._pending, None
+            for rows in pending:
+                self._resource_usages.extend(rows)
+        return self._resource_usages
+
+    def _resource_segments(self):
+        """Get the added resource rows without decoding them.
+
+        :returns: List of iterables
+        """
+        segments = []
+        if self._resource_usages:
+            segments.append(self._resource_usages)
+        if self._pending:
+            segments.extend(self._pending)
+        return segments
 
     def add_resource_usages(self, resource_usages):
         """Add resource usages.
 
-        :param resource_usages: List
+        In lazy mode a json_stream.RawList is kept undecoded.
+
+        :param resource_usages: List|os_usage.common.json_stream.RawList
         """
+        if self._resources == RESOURCES_DROP or not resource_usages:
+            return
+        if self._resources == RESOURCES_LAZY:
+            if self._pending is None:
+                self._pending = []
+            self._pending.append(resource_usages)
+            return
         self.resource_usages.extend(resource_usages)
 
     def __iadd__(self, other):
@@ -54,29 +167,48 @@ class TenantUsage():
         """
         # Add metrics
         for metric_name, metric_value in other:
-            print "Adding metric {0}".format(metric_name)
             self.add_metric(metric_name, metric_value)
 
         # Add resource usages
-        self.add_resource_usages(other.resource_usages)
+        for resource_usages in other._resource_segments():
+            self.add_resource_usages(resource_usages)
+        return self
 
 
 class Usages():
     """Class for obtaining a collection of TenantUsages"""
 
-    def __init__(self, clients, nova=True, glance=True, cinder=True):
+    def __init__(self, clients, nova=True, glance=True, cinder=True,
+                 store=None, stream=False, resources=RESOURCES_EAGER):
         """Inits the objects
 
         :param clients: os_usage.clients.ClientManager instance
         :param nova: Boolean - obtain usage from nova
         :param glance: Boolean - obtain usage from glance
         :param cinder: Boolean - obtain usage from cinder
+        :param store: os_usage.common.store.UsageStore|None - reuse usage
+            of closed day windows fetched by earlier runs
+        :param stream: Boolean - decode responses incrementally and add
+            each tenant as it arrives. Ignored with a store or split windows
+            which need whole responses.
+        :param resources: String - one of RESOURCE_MODES. lazy keeps
+            detailed rows as received until a tenant's resource_usages is
+            read, as raw JSON text when streaming. drop discards them.
         """
+        if resources not in RESOURCE_MODES:
+            raise ValueError("Unknown resources mode {0}".format(resources))
         self.clients = clients
         self.use_nova = nova
         self.use_glance = glance
         self.use_cinder = cinder
+        self.store = store
+        self.stream = stream
+        self.resources = resources
         self.tenant_usages = {}
+        self.strings = {}
+        # Response body bytes received per service by the last
+        # iter_service_usages.
+        self.received_bytes = {}
 
     def __iter__(self):
         """
@@ -85,6 +217,20 @@ class Usages():
         for tenant_id, tenant_usage in self.tenant_usages.iteritems():
             yield(tenant_id, tenant_usage)
 
+    def to_frame(self, kind='metrics'):
+        """Convert to a pandas DataFrame.
+
+        :param kind: String - 'metrics' for one row per tenant or
+            'resources' for one row per resource usage
+        :returns: pandas.DataFrame
+        """
+        from os_usage.common import analytics
+        if kind == 'metrics':
+            return analytics.metrics_frame(self)
+        if kind == 'resources':
+            return analytics.resources_frame(self)
+        raise ValueError("Unknown frame kind {0}".format(kind))
+
     def get_tenant_usage(self, tenant_id):
         """Gets a tenant usage by tenant id.
 
@@ -93,7 +239,9 @@ class Usages():
         :param tenant_id:
         """
         if tenant_id not in self.tenant_usages:
-            self.tenant_usages[tenant_id] = TenantUsage(tenant_id)
+            self.tenant_usages[tenant_id] = TenantUsage(
+                tenant_id, strings=self.strings, resources=self.resources
+            )
         return self.tenant_usages[tenant_id]
 
     def add_usage_dict(self, usage_dict, metric_prefix=None):
@@ -112,54 +260,272 @@ class Usages():
             resource_usages = tenant_dict.get('resource_usages', [])
             tenant_usage.add_resource_usages(resource_usages)
 
-    def get_nova_usages(self, start, end, metadata):
+    def list_usages(self, service, usage_client, start, end, metadata,
+                    detailed=False, split=1, concurrency=None):
+        """List usages from a usage client.
+
+        With a store, the range is split into day windows. Windows ending
+        on a midnight that has passed are read from the store when present
+        and stored after fetching. The remaining windows are fetched,
+        concurrency at a time.
+
+        Without a store, the range is split into split sub windows that are
+        fetched in parallel by the usage client.
+
+        :param service: String - one of (nova, glance, cinder)
+        :param usage_client: UsageClient instance
+        :param start: Datetime
+        :param end: Datetime
+        :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of sub windows when not using a store
+        :param concurrency: Integer|None - max windows fetched at once
+        :returns: Dict
+        """
+        if self.store is None:
+            return usage_client.list(start, end, detailed=detailed,
+                                     metadata=metadata, split=split,
+                                     concurrency=concurrency)
+
+        query = usage_store.query_key(metadata, detailed,
+                                      usage_client.scope())
+        now = windows.utcnow_like(end)
+        window_list = list(windows.day_windows(start, end))
+        window_dicts = {}
+        missing = []
+        for window in window_list:
+            usage_dict = None
+            if windows.is_closed_day(window[1], now):
+                usage_dict = self.store.get(service, query, *window)
+            if usage_dict is None:
+                missing.append(window)
+            else:
+                window_dicts[window] = usage_dict
+
+        fetched = windows.map_windows(
+            lambda s, e: usage_client.list(s, e, detailed=detailed,
+                                           metadata=metadata),
+            missing,
+            concurrency
+        )
+        for window, usage_dict in zip(missing, fetched):
+            if windows.is_closed_day(window[1], now):
+                self.store.put(service, query, window[0], window[1],
+                               usage_dict)
+            window_dicts[window] = usage_dict
+        return usage_dicts.merge_usage_dicts(
+            [window_dicts[window] for window in window_list]
+        )
+
+    def iter_list_usages(self, service, usage_client, start, end, metadata,
+                         detailed=False, split=1, concurrency=None):
+        """List usages from a usage client, streaming when enabled.
+
+        Streamed responses yield one usage dict per tenant as it arrives.
+        Otherwise the single usage dict of list_usages is yielded. In lazy
+        mode streamed resource usages are kept as json_stream.RawList.
+
+        :param service: String - one of (nova, glance, cinder)
+        :param usage_client: UsageClient instance
+        :param start: Datetime
+        :param end: Datetime
+        :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of sub windows when not using a store
+        :param concurrency: Integer|None - max windows fetched at once
+        :yields: Dict
+        """
+        if self.stream and self.store is None and split <= 1:
+            for usage_dict in usage_client.iter_list(
+                    start, end, detailed=detailed, metadata=metadata,
+                    raw_resources=self.resources == RESOURCES_LAZY):
+                yield usage_dict
+            return
+        yield self.list_usages(service, usage_client, start, end, metadata,
+                               detailed, split, concurrency)
+
+    def usage_client(self, service):
+        """Get the usage client of a service.
+
+        :param service: String - one of SERVICES
+        :returns: UsageClient instance
+        """
+        cache = self.clients.response_cache
+        if service == 'nova':
+            return NovaUsage(self.clients.get_nova(), cache=cache)
+        if service == 'glance':
+            return GlanceUsage(self.clients.get_glance(), cache=cache)
+        if service == 'cinder':
+            return CinderUsage(self.clients.get_cinder(), cache=cache)
+        raise ValueError("Unknown service {0}".format(service))
+
+    def services(self):
+        """Get the services usage is obtained from.
+
+        :returns: List
+        """
+        enabled = {
+            'nova': self.use_nova,
+            'glance': self.use_glance,
+            'cinder': self.use_cinder
+        }
+        return [service for service in SERVICES if enabled[service]]
+
+    def get_service_usages(self, service, start, end, metadata,
+                           detailed=False, split=1, concurrency=None):
+        """Get the usages of one service.
+
+        :param service: String - one of SERVICES
+        :param start: Datetime
+        :param end: Datetime
+        :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of parallel sub windows
+        :param concurrency: Integer|None - max windows fetched at once
+        """
+        for usage_dict in self.iter_list_usages(
+                service, self.usage_client(service), start, end, metadata,
+                detailed, split, concurrency):
+            self.add_usage_dict(usage_dict, service)
+
+    def get_nova_usages(self, start, end, metadata, detailed=False, split=1,
+                        concurrency=None):
         """Get nova usages
 
         :param start: Datetime
         :param end: Datetime
         :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of parallel sub windows
+        :param concurrency: Integer|None - max windows fetched at once
         """
-        nova = self.clients.get_nova()
-        nova_usage = NovaUsage(nova)
-        usage_dict = nova_usage.list(start, end, metadata)
-        self.add_usage_dict(usage_dict, 'nova')
+        self.get_service_usages('nova', start, end, metadata, detailed,
+                                split, concurrency)
 
-    def get_cinder_usages(self, start, end, metadata):
+    def get_cinder_usages(self, start, end, metadata, detailed=False,
+                          split=1, concurrency=None):
         """Get cinder usages
 
         :param start: Datetime
         :param end: Datetime
         :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of parallel sub windows
+        :param concurrency: Integer|None - max windows fetched at once
         """
-        cinder = self.clients.get_cinder()
-        cinder_usage = CinderUsage(cinder)
-        usage_dict = cinder_usage.list(start, end, metadata)
-        self.add_usage_dict(usage_dict, 'cinder')
+        self.get_service_usages('cinder', start, end, metadata, detailed,
+                                split, concurrency)
 
-    def get_glance_usages(self, start, end, metadata):
+    def get_glance_usages(self, start, end, metadata, detailed=False,
+                          split=1, concurrency=None):
         """Get glance usages
 
         :param start: Datetime
         :param end: Datetime
         :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of parallel sub windows
+        :param concurrency: Integer|None - max windows fetched at once
         """
-        glance = self.clients.get_glance()
-        glance_usage = GlanceUsage(glance)
-        usage_dict = glance_usage.list(start, end, metadata)
-        self.add_usage_dict(usage_dict, 'glance')
+        self.get_service_usages('glance', start, end, metadata, detailed,
+                                split, concurrency)
 
-    def get_usages(self, start, end, metadata=None):
-        """Get all optioned usages.
+    def iter_service_usages(self, start, end, metadata=None, detailed=False,
+                            split=1, concurrency=None):
+        """Get the usages of all optioned services in parallel.
+
+        Each service is fetched in its own thread. Usage dicts are added
+        and yielded in the order services complete. When streaming a
+        service yields one usage dict per tenant as its response arrives.
 
         :param start: Datetime
-        :param stop: Datetime
+        :param end: Datetime
         :param metadata: Dict|None
+        :param detailed: Boolean
+        :param split: Integer - number of parallel sub windows per service
+        :param concurrency: Integer|None - max windows fetched at once per
+            service
+        :yields: tuple - (service, usage_dict, seconds taken)
         """
-        if self.use_nova:
-            self.get_nova_usages(start, end, metadata)
+        # Create the clients up front so the keystone session is created
+        # once rather than raced for by the threads.
+        usage_clients = [(service, self.usage_client(service))
+                         for service in self.services()]
+        self.received_bytes = {}
+        if not usage_clients:
+            return
+        counters = dict((service, usage_client.received)
+                        for service, usage_client in usage_clients)
+
+        # Fetch threads hand usage dicts to this thread through a bounded
+        # queue, so a slow consumer holds back streamed responses instead
+        # of buffering them. Once this thread stops, on an error or when
+        # the caller stops iterating, the fetch threads give up and close
+        # their responses.
+        results = queue.Queue(STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        def put(result):
+            while not stopped.is_set():
+                try:
+                    results.put(result, timeout=STREAM_PUT_TIMEOUT)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(item):
+            service, usage_client = item
+            started = time.time()
+            service_usage_dicts = self.iter_list_usages(
+                service, usage_client, start, end, metadata, detailed,
+                split, concurrency
+            )
+            try:
+                for usage_dict in service_usage_dicts:
+                    if not put((service, usage_dict,
+                                time.time() - started, None)):
+                        return
+            except Exception:
+                put((service, None, None, sys.exc_info()))
+                return
+            finally:
+                service_usage_dicts.close()
+            put((service, None, time.time() - started, None))
+
+        pool = ThreadPool(len(usage_clients))
+        try:
+            pool.map_async(fetch, usage_clients)
+            remaining = len(usage_clients)
+            while remaining:
+                service, usage_dict, seconds, exc_info = results.get()
+                if exc_info is not None:
+                    six.reraise(*exc_info)
+                self.received_bytes[service] = counters[service].total
+                if usage_dict is None:
+                    remaining -= 1
+                    continue
+                self.add_usage_dict(usage_dict, service)
+                yield (service, usage_dict, seconds)
+        finally:
+            stopped.set()
+            pool.terminate()
+
+    def get_usages(self, start, end, metadata=None, detailed=False, split=1,
+                   concurrency=None):
+        """Get all optioned usages.
 
-        if self.use_glance:
-            self.get_glance_usages(start, end, metadata)
+        Services are fetched in parallel.
 
-        if self.use_cinder:
-            self.get_cinder_usages(start, end, metadata)
+        :param start: Datetime
+        :param stop: Datetime
+        :param metadata: Dict|None
+        :param detailed: Boolean - include per resource usages
+        :param split: Integer - split each service's range into this many
+            sub windows fetched in parallel
+        :param concurrency: Integer|None - max windows fetched at once per
+            service
+        """
+        for _ in self.iter_service_usages(start, end, metadata, detailed,
+                                          split, concurrency):
+            pass
@@ -0,0 +1,104 @@
+"""
+Provides helpers for splitting usage time windows.
+"""
+import datetime
+
+from multiprocessing.pool import ThreadPool
+
+from os_usage.common.usage_dict import merge_usage_dicts
+
+
+def utcnow_like(value):
+    """Get the current UTC time matching the awareness of value.
+
+    :param value: Datetime
+    :returns: Datetime
+    """
+    now = datetime.datetime.utcnow()
+    if value.tzinfo is not None:
+        now = now.replace(tzinfo=value.tzinfo) + value.utcoffset()
+    return now
+
+
+def is_closed_day(window_end, now):
+    """Determine if a window ends on a midnight that has already passed.
+
+    :param window_end: Datetime
+    :param now: Datetime
+    :returns: Boolean
+    """
+    return window_end <= now and window_end.time() == datetime.time(0)
+
+
+def day_windows(start, end):
+    """Split start to end into windows bounded by midnight.
+
+    The first and last windows may be partial days.
+
+    :param start: Datetime
+    :param end: Datetime
+    :yields: tuple - (Datetime, Datetime)
+    """
+    window_start = start
+    while window_start < end:
+        midnight = window_start.replace(
+            hour=0, minute=0, second=0, microsecond=0
+        ) + datetime.timedelta(days=1)
+        window_end = min(midnight, end)
+        yield (window_start, window_end)
+        window_start = window_end
+
+
+def split_window(start, end, count):
+    """Split start to end into count windows of equal length.
+
+    Inner bounds fall on whole seconds so that the hours the services
+    compute for each window add up to the hours of the whole range.
+
+    :param start: Datetime
+    :param end: Datetime
+    :param count: Integer
+    :returns: List of tuples - (Datetime, Datetime)
+    """
+    step = datetime.timedelta(
+        seconds=int((end - start).total_seconds()) // count
+    )
+    bounds = [start + step * i for i in range(count)] + [end]
+    return [(bounds[i], bounds[i + 1]) for i in range(count)
+            if bounds[i] < bounds[i + 1]]
+
+
+def map_windows(fetch, window_list, concurrency=None):
+    """Call fetch for each window, optionally in parallel.
+
+    :param fetch: Callable accepting (start, end)
+    :param window_list: List of tuples - (Datetime, Datetime)
+    :param concurrency: Integer|None - number of windows fetched at once.
+        None or 1 fetches sequentially.
+    :returns: List - fetch results in window order
+    """
+    if not concurrency or concurrency < 2 or len(window_list) < 2:
+        return [fetch(start, end) for start, end in window_list]
+
+    pool = ThreadPool(min(concurrency, len(window_list)))
+    try:
+        return pool.map(lambda window: fetch(*window), window_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def fetch_windows(fetch, start, end, count, concurrency=None):
+    """Fetch a usage dict for start to end as count merged sub windows.
+
+    :param fetch: Callable accepting (start, end) returning a usage dict
+    :param start: Datetime
+    :param end: Datetime
+    :param count: Integer - number of sub windows
+    :param concurrency: Integer|None - defaults to count
+    :returns: Dict
+    """
+    if concurrency is None:
+        concurrency = count
+    window_list = split_window(start, end, count)
+    return merge_usage_dicts(map_windows(fetch, window_list, concurrency))
@@ -6,33 +6,162 @@ import six
 
 from six.moves.urllib import parse
 
+from os_usage.common import job_client
+from os_usage.common import json_stream
+from os_usage.common import store as usage_store
+from os_usage.common.http_cache import ByteCounter
+from os_usage.common.http_cache import cached_get
+from os_usage.common.usage_dict import Schema
+from os_usage.common.usage_dict import translate
+from os_usage.common.windows import fetch_windows
+
+SCHEMA = Schema(
+    tenant_key='project_id',
+    metrics=('total_gb_hours',),
+    resources_key='image_usages'
+)
+
+USAGE_PATH = '/v2/usages'
+JOBS_PATH = '/v2/usage_jobs'
+
 
 class UsageClient(object):
     """Provides client to list glance images by property(metadata)
 
     """
-    def __init__(self, glance_client):
+    def __init__(self, glance_client, cache=None):
         """Init
 
         :param glance_client: Instance of glance client
+        :param cache: os_usage.common.http_cache.ResponseCache|None -
+            revalidate and reuse tagged responses
         """
         self.http_client = glance_client.http_client
+        self.cache = cache
+        # Body bytes of every usage response received.
+        self.received = ByteCounter()
 
-    def list(self, start, end, detailed=False, metadata=None):
+    def list(self, start, end, detailed=False, metadata=None, split=1,
+             concurrency=None, group_by_metadata=None, breakdown=None,
+             filters=None):
         """List images between start and end by metdata.
 
         :param start: Datetime
         :param end: Datetime
         :detailed: Boolean - Add volume information to query
-        :metadata: Dict|None
+        :metadata: Dict|None - filter, see os_usage.common.metadata
+        :split: Integer - split the range into this many sub windows
+            requested in parallel and merged
+        :concurrency: Integer|None - max sub windows requested at once
+        :group_by_metadata: String|None - also report usage per value of
+            this image property under 'groups'
+        :breakdown: String|None - also report usage per disk_format or
+            container_format under 'groups'
+        :filters: Dict|None - filter on image columns such as status or
+            disk_format, same syntax as metadata
         :returns: Dict
         """
+        if split > 1:
+            return fetch_windows(
+                lambda s, e: self.list(s, e, detailed=detailed,
+                                       metadata=metadata,
+                                       group_by_metadata=group_by_metadata,
+                                       breakdown=breakdown,
+                                       filters=filters),
+                start, end, split, concurrency
+            )
+
+        return cached_get(
+            self.cache, self.http_client,
+            self._url(start, end, detailed, metadata, group_by_metadata,
+                      breakdown, filters),
+            lambda resp, body: self.to_dict(
+                resp.json().get('tenant_usages', [])
+            ),
+            self.received
+        )
+
+    def iter_list(self, start, end, detailed=False, metadata=None,
+                  group_by_metadata=None, breakdown=None, filters=None,
+                  chunk_size=json_stream.CHUNK_SIZE,
+                  raw_resources=False):
+        """Stream image usages between start and end.
+
+        Rows are decoded as the response arrives instead of after the whole
+        body is read. Grouped rows of a tenant are yielded separately.
+
+        :param start: Datetime
+        :param end: Datetime
+        :detailed: Boolean - Add image information to query
+        :metadata: Dict|None - filter, see os_usage.common.metadata
+        :group_by_metadata: String|None
+        :breakdown: String|None
+        :filters: Dict|None - filter on image columns
+        :chunk_size: Integer - bytes read at a time
+        :raw_resources: Boolean - keep the resource usages of each row as a
+            json_stream.RawList instead of decoding them
+        :yields: Dict - usage dict of one response row
+        """
+        url = self._url(start, end, detailed, metadata, group_by_metadata,
+                        breakdown, filters)
+        raw_key = SCHEMA.resources_key if raw_resources else None
+        for row in json_stream.stream_items(self.http_client, url,
+                                            'tenant_usages', chunk_size,
+                                            raw_key, self.received):
+            yield self.to_dict([row])
+
+    def submit_job(self, start, end, detailed=False, metadata=None,
+                   group_by_metadata=None, breakdown=None, filters=None):
+        """Submit a report job computing image usages in the background.
+
+        Takes the same arguments as list without splitting.
+
+        :returns: String - job id
+        """
+        url = self._url(start, end, detailed, metadata, group_by_metadata,
+                        breakdown, filters, path=JOBS_PATH)
+        return job_client.submit_job(self.http_client, url)['id']
+
+    def get_job(self, job_id):
+        """Get a report job.
+
+        :param job_id: String
+        :returns: Dict - the job, with its result once done
+        """
+        return job_client.get_job(self.http_client, self._job_url(job_id))
+
+    def wait_for_job(self, job_id, interval=job_client.POLL_INTERVAL,
+                     timeout=None):
+        """Wait for a report job and get its result.
+
+        :param job_id: String
+        :param interval: Float - seconds between polls
+        :param timeout: Float|None - seconds to wait, None waits forever
+        :returns: Dict - usage dict of the report
+        :raises: os_usage.common.job_client.JobFailed,
+            os_usage.common.job_client.JobTimeout
+        """
+        job = job_client.wait_for_job(self.http_client, self._job_url(job_id),
+                                      interval, timeout)
+        return self.to_dict(job['result']['tenant_usages'])
+
+    def _job_url(self, job_id):
+        return '{0}/{1}'.format(JOBS_PATH, parse.quote(job_id))
+
+    def _url(self, start, end, detailed, metadata, group_by_metadata,
+             breakdown, filters, path=USAGE_PATH):
+        """Build the url of an image usage request.
+
+        :returns: String
+        """
         if metadata is None:
             metadata = {}
         opts = {
             'start': start.isoformat(),
             'end': end.isoformat(),
-            'detailed': int(bool(detailed))
+            'detailed': int(bool(detailed)),
+            'group_by_metadata': group_by_metadata,
+            'breakdown': breakdown
         }
 
         if isinstance(metadata, dict):
@@ -41,6 +170,9 @@ class UsageClient(object):
         if metadata:
             opts['metadata'] = metadata
 
+        if filters:
+            opts['filters'] = json.dumps(filters)
+
         qparams = {}
         for opt, val in opts.items():
             if val:
@@ -49,10 +181,14 @@ class UsageClient(object):
                 qparams[opt] = val
 
         query_string = '?%s' % parse.urlencode(qparams)
-        url = '/v2/usages%s' % query_string
-        resp, _ = self.http_client.get(url)
-        resp = resp.json().get('tenant_usages', [])
-        return self.to_dict(resp)
+        return '%s%s' % (path, query_string)
+
+    def scope(self):
+        """Get the endpoint, project and user usage is read with.
+
+        :returns: Dict - see os_usage.common.store.client_scope
+        """
+        return usage_store.client_scope(self.http_client)
 
     def to_dict(self, resp):
         """Translate resp to dict that is usable by usages.
@@ -60,19 +196,4 @@ class UsageClient(object):
         :param resp: List
         :returns: Dict
         """
-        attrs = [
-            'total_gb_hours'
-        ]
-        usage = {}
-        for tenant_usage in resp:
-            tenant_id = tenant_usage.get('project_id')
-            usage[tenant_id] = {
-                'metrics': {},
-                'resource_usages': []
-            }
-            for attr in attrs:
-                usage[tenant_id]['metrics'][attr] = tenant_usage.get(attr, 0)
-            usage[tenant_id]['resource_usages'].extend(
-                tenant_usage.get('image_usages', [])
-            )
-        return usage
+        return translate(resp, SCHEMA)
@@ -4,14 +4,14 @@ from magic_the_decorating.decorator import Base as BaseDecorator
 class _RouterDecorator(BaseDecorator):
     """Callable that alters glance's v2 router.
 
-    Adds the usage endpoint.
+    Adds the usage and usage job endpoints.
     """
     def __init__(self):
         """Calls parent class init and sets signature."""
         super(_RouterDecorator, self).__init__('__glance_router_decorator__')
 
     def setup_init(self, module, config):
-        """Adds the usage api endpoint to routes.
+        """Adds the usage api endpoints to routes.
 
         :param module: Python module containing API class
         :param config: Dict - unused at this point.
@@ -35,6 +35,9 @@ class _RouterDecorator(BaseDecorator):
             mapper.resource("usage", "usages",
                             controller=usage_resource)
 
+            mapper.resource("usage_job", "usage_jobs",
+                            controller=usage.create_job_resource())
+
         setattr(klass, method_name, new_init)
         return module
 
@@ -24,25 +24,54 @@ from glance import i18n
 from glance.db.sqlalchemy import models
 from glance.db.sqlalchemy.api import get_session
 from glance.api import policy
-from glance.common import exception
 from glance.common import wsgi
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
 from oslo_utils import timeutils
-from sqlalchemy.orm import aliased
 from sqlalchemy.sql import null
 from sqlalchemy import or_
 from webob import exc
 
+from os_usage.common import admission as usage_admission
+from os_usage.common import config as usage_config
+from os_usage.common import deadline as usage_deadline
+from os_usage.common import etag as usage_etag
+from os_usage.common import interval_index
+from os_usage.common import jobs as usage_jobs
+from os_usage.common import metadata as usage_metadata
 from os_usage.common import request
+from os_usage.ledger import ledger as usage_ledger
+from os_usage.ledger import notifications as ledger_notifications
 
 LOG = logging.getLogger(__name__)
+CONF = usage_config.register_opts(cfg.CONF)
 _ = i18n._
 _LW = i18n._LW
 
-
-class InvalidStrTime(exception.Invalid):
-    msg_fmt = _("Invalid datetime string: %(reason)s")
+IMAGE_PROPERTIES = usage_metadata.MetadataTable(
+    models.ImageProperty, models.Image,
+    key_column='name', foreign_key='image_id'
+)
+
+# Server side breakdown dimensions. Each is a column of the image.
+BREAKDOWNS = ('disk_format', 'container_format')
+
+# Image columns accepted in filters. Depending on the glance release images
+# have either is_public or visibility.
+FILTER_COLUMNS = (
+    'status',
+    'disk_format',
+    'container_format',
+    'name',
+    'owner',
+    'protected',
+    'is_public',
+    'visibility'
+)
+IMAGE_FILTER_COLUMNS = tuple(
+    column for column in FILTER_COLUMNS if hasattr(models.Image, column)
+)
 
 
 class UsagesController(object):
@@ -58,25 +87,143 @@ class UsagesController(object):
     def index(self, req):
         """Returns dictionary of tenant usages"""
         context = req.context
-        metadata = req.GET.get('metadata', '{}')
-        metadata = jsonutils.loads(metadata)
+        params = self._params(req)
+        etag = self._etag(req, params)
+        if usage_etag.not_modified(req, etag):
+            raise exc.HTTPNotModified()
+        req.environ[usage_etag.ENVIRON_KEY] = etag
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is None:
+            deadline = usage_deadline.from_params(CONF.os_usage, params)
+            with usage_deadline.enforce(deadline), \
+                    usage_admission.admit(CONF.os_usage, params):
+                usages = self._get_usages(
+                    context,
+                    params.start,
+                    params.end,
+                    detailed=params.detailed,
+                    metadata=params.metadata,
+                    group_by_metadata=params.group_by_metadata,
+                    breakdown=params.breakdown,
+                    filters=params.filters,
+                    deadline=deadline
+                )
+        usages = request.paginate(usages, 'project_id', params)
+        return {'tenant_usages': usages}
+
+    def _params(self, req):
+        """Validate the query parameters of a request.
+
+        :param req: webob.Request
+        :returns: os_usage.common.request.UsageParams
+        :raises: webob.exc.HTTPBadRequest
+        """
         try:
-            (period_start, period_stop, detailed) = \
-                request.get_datetime_range(req)
-        except request.InvalidStrTime as e:
-            msg = _(e.msg)
-            raise exc.HTTPBadRequest(explanation=msg)
-        except request.StartGreaterThanEnd as e:
-            msg = _(e.msg)
-            raise exc.HTTPBadRequest(explanation=msg)
-        usages = self._get_usages(
-            context,
-            period_start,
-            period_stop,
-            detailed=detailed,
-            metadata=metadata
+            return request.UsageParams.from_request(
+                req, breakdowns=BREAKDOWNS,
+                filter_columns=IMAGE_FILTER_COLUMNS,
+                filter_model=models.Image
+            )
+        except request.InvalidRequest as e:
+            raise exc.HTTPBadRequest(explanation=_(e.msg))
+
+    def _ledger_usages(self, context, params):
+        """Get image usages from the notification ledger if configured.
+
+        :param context: Context
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
+        """
+        return ledger_notifications.ledger_summaries(
+            usage_ledger.get_ledger(CONF.os_usage.ledger_path), 'glance',
+            params, lambda at: self._ledger_resources(context, at)
         )
-        return {'tenant_usages': usages}
+
+    def _index_usages(self, params):
+        """Get image usages from the interval index if enabled.
+
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
+        """
+        return interval_index.index_summaries(
+            CONF.os_usage, 'glance', params, self._image_lifetimes
+        )
+
+    def _image_lifetimes(self, since=None):
+        """Get the lifetimes of images for the interval index.
+
+        :param since: Datetime|None - only images changed from then on
+        :returns: List of tuples, see interval_index.load_lifetimes
+        """
+        return interval_index.load_lifetimes(
+            get_session(), models.Image, 'glance', 'id', 'owner',
+            'created_at', 'deleted_at', ('size',), since
+        )
+
+    def _job_report(self, context, params):
+        """Compute the whole report of a report job.
+
+        :param context: Context
+        :param params: os_usage.common.request.UsageParams
+        :returns: Dict - response body
+        """
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is None:
+            usages = self._get_usages(
+                context,
+                params.start,
+                params.end,
+                detailed=params.detailed,
+                metadata=params.metadata,
+                group_by_metadata=params.group_by_metadata,
+                breakdown=params.breakdown,
+                filters=params.filters,
+                deadline=usage_deadline.Deadline(
+                    CONF.os_usage.job_timeout or None
+                )
+            )
+        return {'tenant_usages': list(usages)}
+
+    def _etag(self, req, params):
+        """Get the ETag of a report, None unless the window is closed.
+
+        :param req: webob.Request
+        :param params: os_usage.common.request.UsageParams
+        :returns: String|None
+        """
+        if not params.closed:
+            return None
+        session = get_session()
+        criteria = []
+        if params.filters:
+            criteria.append(usage_metadata.column_filter(
+                models.Image, params.filters, IMAGE_FILTER_COLUMNS
+            ))
+        states = [usage_etag.window_state(
+            session, models.Image, 'created_at', 'deleted_at',
+            params.start, params.end, criteria
+        )]
+        if params.metadata or params.group_by_metadata:
+            states.append(
+                usage_etag.table_state(session, models.ImageProperty)
+            )
+        return usage_etag.make_etag(req.GET, states)
+
+    def _ledger_resources(self, context, at):
+        """Get the images active at a time to seed the ledger with.
+
+        :param context: Context
+        :param at: Datetime
+        :returns: List of tuples - (owner, image id, rates)
+        """
+        images = self._images_by_windowed_meta(context, at, at)
+        return [(image['owner'], image['id'],
+                 ledger_notifications.glance_rates(image))
+                for image in images]
 
     def _hours_for(self, image, period_start, period_stop):
         """Determine number of active hours in period.
@@ -122,7 +269,11 @@ class UsagesController(object):
         period_stop,
         project_id=None,
         detailed=False,
-        metadata=None
+        metadata=None,
+        group_by_metadata=None,
+        breakdown=None,
+        filters=None,
+        deadline=None
     ):
         """Get usages
 
@@ -132,13 +283,23 @@ class UsagesController(object):
         :param project_id: String|None
         :param detailed: Boolean
         :param metadata: Dict|None
+        :param group_by_metadata: String|None - report one summary per
+            (tenant, value of this image property). Images without the
+            property are reported with a metadata_value of None.
+        :param breakdown: String|None - one of BREAKDOWNS. Report one
+            summary per (tenant, value of this image column).
+        :param filters: Dict|None - filter on IMAGE_FILTER_COLUMNS
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
         images = self._images_by_windowed_meta(
             context,
             period_start,
             period_stop,
             project_id,
-            metadata
+            metadata,
+            group_by_metadata,
+            filters,
+            deadline
         )
         rval = {}
         for image in images:
@@ -156,8 +317,17 @@ class UsagesController(object):
                 timeutils.normalize_time(image['deleted_at']) if
                 image['deleted_at'] else None
             )
-            if info['project_id'] not in rval:
-                summary = {}
+            group = {}
+            if group_by_metadata:
+                group['metadata_key'] = group_by_metadata
+                group['metadata_value'] = \
+                    image[usage_metadata.GROUP_VALUE_KEY]
+            if breakdown:
+                group[breakdown] = image[breakdown]
+            key = (info['project_id'],) + tuple(sorted(group.items()))
+
+            if key not in rval:
+                summary = dict(group)
                 summary['project_id'] = info['project_id']
                 if detailed:
                     summary['image_usages'] = []
@@ -165,9 +335,9 @@ class UsagesController(object):
                 summary['total_hours'] = 0
                 summary['start'] = timeutils.normalize_time(period_start)
                 summary['stop'] = timeutils.normalize_time(period_stop)
-                rval[info['project_id']] = summary
+                rval[key] = summary
 
-            summary = rval[info['project_id']]
+            summary = rval[key]
 
             # Its possible that image has been created without any uploaded
             # data. Assume 0 if this is the case.
@@ -192,7 +362,10 @@ class UsagesController(object):
         period_start,
         period_stop,
         project_id=None,
-        metadata=None
+        metadata=None,
+        group_by_metadata=None,
+        filters=None,
+        deadline=None
     ):
         """Simulates first level in database layer.
 
@@ -201,6 +374,9 @@ class UsagesController(object):
         :param period_stop: Datetime
         :param project_id: String|None
         :param metadata: Dict|None
+        :param group_by_metadata: String|None
+        :param filters: Dict|None
+        :param deadline: Deadline|None
         """
         # Convert the datetime objects to strings
         period_start = timeutils.isotime(period_start)
@@ -210,7 +386,10 @@ class UsagesController(object):
             period_start,
             period_stop,
             project_id,
-            metadata
+            metadata,
+            group_by_metadata,
+            filters,
+            deadline
         )
 
     def __images_by_windowed_meta(
@@ -219,7 +398,10 @@ class UsagesController(object):
         period_start,
         period_stop,
         project_id,
-        metadata
+        metadata,
+        group_by_metadata=None,
+        filters=None,
+        deadline=None
     ):
         """Simulate second the bottomost layer.
 
@@ -228,6 +410,9 @@ class UsagesController(object):
         :param period_stop: String
         :param project_id: String
         :param metadata: Dict
+        :param group_by_metadata: String|None
+        :param filters: Dict|None
+        :param deadline: Deadline|None
         """
         period_start = timeutils.parse_isotime(period_start)
         period_stop = timeutils.parse_isotime(period_stop)
@@ -236,7 +421,10 @@ class UsagesController(object):
             period_start,
             period_stop,
             project_id,
-            metadata
+            metadata,
+            group_by_metadata,
+            filters,
+            deadline
         )
         return image_list
 
@@ -246,7 +434,10 @@ class UsagesController(object):
         period_start,
         period_stop,
         project_id,
-        metadata
+        metadata,
+        group_by_metadata=None,
+        filters=None,
+        deadline=None
     ):
         """Simulated bottom most layer
 
@@ -255,17 +446,13 @@ class UsagesController(object):
         :param period_stop: Datetime
         :param project_id: String
         :param metadata:
+        :param group_by_metadata: String|None - property name whose value
+            is stored in each image dict under GROUP_VALUE_KEY
+        :param filters: Dict|None - filter on IMAGE_FILTER_COLUMNS
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
-        if metadata:
-            aliases = [aliased(models.ImageProperty) for i in metadata]
-        else:
-            aliases = []
-
         session = get_session()
-        query = session.query(
-            models.Image,
-            *aliases
-        )
+        query = session.query(models.Image)
         query = query.filter(or_(models.Image.deleted_at == null(),
                                  models.Image.deleted_at > period_start))
 
@@ -275,25 +462,31 @@ class UsagesController(object):
         if project_id:
             query = query.filter_by(project_id=project_id)
 
+        if filters:
+            query = query.filter(usage_metadata.column_filter(
+                models.Image, filters, IMAGE_FILTER_COLUMNS
+            ))
+
         if metadata:
-            for keypair, alias in zip(metadata.items(), aliases):
-                query = query.filter(alias.name == keypair[0])
-                query = query.filter(alias.value == keypair[1])
-                query = query.filter(alias.image_id == models.Image.id)
-                query = query.filter(or_(
-                    alias.deleted_at == null(),
-                    alias.deleted_at == models.Image.deleted_at
-                ))
+            query = query.filter(
+                usage_metadata.metadata_filter(IMAGE_PROPERTIES, metadata)
+            )
+
+        if group_by_metadata:
+            query = usage_metadata.add_group_value(
+                query, IMAGE_PROPERTIES, group_by_metadata
+            )
 
         images = []
-        for tup in query.all():
-            if aliases:
-                image = tup[0]
-                # props = tup[1:]
+        for tup in usage_deadline.iter_rows(session, query, deadline):
+            # Rows are tuples only when the group value column is added.
+            if group_by_metadata:
+                image = dict(tup[0])
             else:
-                image = tup
-                # props = None
-            images.append(dict(image))
+                image = dict(tup)
+            if group_by_metadata:
+                image[usage_metadata.GROUP_VALUE_KEY] = tup[-1]
+            images.append(image)
         return images
 
 
@@ -301,13 +494,48 @@ class ResponseSerializer(wsgi.JSONResponseSerializer):
     def index(self, response, result):
         response.status_int = 200
         response.content_type = 'application/json'
+        etag = None
+        if response.request is not None:
+            etag = response.request.environ.get(usage_etag.ENVIRON_KEY)
+        if etag is not None:
+            response.headers['ETag'] = usage_etag.header(etag)
         response.unicode_body = six.text_type(
             jsonutils.dumps(result, ensure_ascii=False)
         )
 
 
+class UsageJobsController(object):
+    def __init__(self, usages=None):
+        self.usages = usages or UsagesController()
+
+    def create(self, req):
+        """Submits a report job with the query parameters of a report"""
+        params = self.usages._params(req)
+        job = usage_jobs.submit(
+            CONF.os_usage, req.context.owner, req.GET,
+            lambda: self.usages._job_report(req.context, params)
+        )
+        return {'job': job}
+
+    def show(self, req, id):
+        """Returns the status of a report job, and its result once done"""
+        return {'job': usage_jobs.show(CONF.os_usage, req.context.owner, id)}
+
+
+class JobResponseSerializer(wsgi.JSONResponseSerializer):
+    def create(self, response, result):
+        self.default(response, result)
+        response.status_int = 202
+
+
 def create_resource(custom_properties=None):
     """Images resource factory method"""
     serializer = ResponseSerializer()
     controller = UsagesController()
     return wsgi.Resource(controller, serializer=serializer)
+
+
+def create_job_resource():
+    """Usage jobs resource factory method"""
+    return wsgi.Resource(UsageJobsController(),
+                         serializer=JobResponseSerializer())
@@ -0,0 +1,382 @@
+"""
+Provides a SQLite ledger of running usage per tenant.
+
+For each (service, tenant) the ledger keeps the usage accumulated up to
+the last event and the current rate of each metric, the summed size of
+the tenant's active resources. An event adds rate * elapsed time to the
+accumulated usage and then changes the rate by the difference the event
+makes, so applying one costs the same however long the ledger has run.
+
+The state after every event is kept in a history table. Usage between two
+times is the accumulated usage at the end less the accumulated usage at the
+start, each read from the latest history row before that time. A report is
+one index probe per tenant. History older than the windows still asked for
+can be compacted to the one row per tenant those windows need.
+"""
+import calendar
+import datetime
+import sqlite3
+import threading
+
+# Metrics the ledger accumulates per service, in rate vector order.
+METRICS = {
+    'nova': (
+        'total_hours',
+        'total_vcpus_usage',
+        'total_memory_mb_usage',
+        'total_local_gb_usage'
+    ),
+    'cinder': (
+        'total_hours',
+        'total_gb_usage'
+    ),
+    'glance': (
+        'total_hours',
+        'total_gb_hours'
+    )
+}
+WIDTH = 4
+
+# Summary key holding the tenant id in each service's response.
+TENANT_KEYS = {
+    'nova': 'tenant_id',
+    'cinder': 'project_id',
+    'glance': 'project_id'
+}
+
+_ACC = ', '.join('acc{0}'.format(i) for i in range(WIDTH))
+_RATE = ', '.join('rate{0}'.format(i) for i in range(WIDTH))
+
+
+def _real_columns(name):
+    return ',\n'.join(
+        '    {0}{1} REAL NOT NULL'.format(name, i) for i in range(WIDTH)
+    )
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seeds (
+    service TEXT PRIMARY KEY,
+    seeded_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tenants (
+    service TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    at REAL NOT NULL,
+{acc},
+{rate},
+    PRIMARY KEY (service, tenant_id)
+);
+CREATE TABLE IF NOT EXISTS history (
+    service TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    at REAL NOT NULL,
+{acc},
+{rate}
+);
+CREATE INDEX IF NOT EXISTS history_at ON history (service, at, tenant_id);
+CREATE INDEX IF NOT EXISTS history_tenant
+    ON history (service, tenant_id, at);
+CREATE TABLE IF NOT EXISTS resources (
+    service TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+{rate},
+    PRIMARY KEY (service, resource_id)
+);
+""".format(acc=_real_columns('acc'), rate=_real_columns('rate'))
+
+# Rowid of the latest history row of a tenant of the tenants table aliased t
+# at or before a time, found by one probe of the history_tenant index.
+_LATEST = (
+    "SELECT rowid FROM history WHERE service = t.service AND "
+    "tenant_id = t.tenant_id AND at <= ? ORDER BY at DESC, rowid DESC "
+    "LIMIT 1"
+)
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def to_naive(value):
+    """Convert a datetime to a naive UTC datetime.
+
+    :param value: Datetime - naive datetimes are UTC
+    :returns: Datetime
+    """
+    if value.utcoffset() is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def to_timestamp(value):
+    """Convert a datetime to seconds since the epoch.
+
+    :param value: Datetime - naive datetimes are UTC
+    :returns: Float
+    """
+    value = to_naive(value)
+    return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+
+
+def from_timestamp(value):
+    """Convert seconds since the epoch to a naive UTC datetime.
+
+    :param value: Float
+    :returns: Datetime
+    """
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+def _pad(rates):
+    rates = list(rates)
+    return rates + [0.0] * (WIDTH - len(rates))
+
+
+class Ledger(object):
+    """Running usage per tenant kept up to date by lifecycle events."""
+
+    def __init__(self, path):
+        """Inits the ledger.
+
+        :param path: String path to the SQLite database. ':memory:' is
+            accepted for a ledger that lasts as long as the object.
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def close(self):
+        """Close the underlying database connection."""
+        self.conn.close()
+
+    def _tenant(self, service, tenant_id):
+        row = self.conn.execute(
+            "SELECT at, {0}, {1} FROM tenants WHERE service = ? AND "
+            "tenant_id = ?".format(_ACC, _RATE),
+            (service, tenant_id)
+        ).fetchone()
+        if row is None:
+            return None, [0.0] * WIDTH, [0.0] * WIDTH
+        return row[0], list(row[1:1 + WIDTH]), list(row[1 + WIDTH:])
+
+    def _apply(self, service, tenant_id, resource_id, at, rates):
+        row = self.conn.execute(
+            "SELECT tenant_id, {0} FROM resources WHERE service = ? AND "
+            "resource_id = ?".format(_RATE),
+            (service, resource_id)
+        ).fetchone()
+        if row is None and rates is None:
+            # Deleting a resource the ledger never saw changes nothing.
+            return
+        if row is not None and row[0] != tenant_id:
+            # The resource moved tenants, remove it from the old one first.
+            self._apply(service, row[0], resource_id, at, None)
+            row = None
+        old = list(row[1:]) if row is not None else [0.0] * WIDTH
+        new = _pad(rates) if rates is not None else [0.0] * WIDTH
+
+        last, acc, rate = self._tenant(service, tenant_id)
+        if last is not None:
+            # Events arriving out of order are applied at the last time
+            # seen so accumulated usage never decreases.
+            at = max(at, last)
+            hours = (at - last) / 3600.0
+            acc = [a + r * hours for a, r in zip(acc, rate)]
+        rate = [r + n - o for r, n, o in zip(rate, new, old)]
+
+        values = (service, tenant_id, at) + tuple(acc) + tuple(rate)
+        placeholders = ', '.join('?' * len(values))
+        self.conn.execute(
+            "INSERT OR REPLACE INTO tenants VALUES ({0})".format(
+                placeholders
+            ),
+            values
+        )
+        self.conn.execute(
+            "INSERT INTO history VALUES ({0})".format(placeholders),
+            values
+        )
+        if rates is None:
+            self.conn.execute(
+                "DELETE FROM resources WHERE service = ? AND "
+                "resource_id = ?",
+                (service, resource_id)
+            )
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO resources VALUES ({0})".format(
+                    ', '.join('?' * (3 + WIDTH))
+                ),
+                (service, resource_id, tenant_id) + tuple(new)
+            )
+
+    def apply(self, service, tenant_id, resource_id, at, rates):
+        """Apply a lifecycle event.
+
+        :param service: String - one of METRICS
+        :param tenant_id: String
+        :param resource_id: String
+        :param at: Datetime - time of the event
+        :param rates: List|None - new metric rates of the resource in
+            METRICS order, None when the resource is deleted
+        """
+        with self.lock, self.conn:
+            self._apply(service, tenant_id, resource_id, to_timestamp(at),
+                        rates)
+
+    def seed(self, service, resources, at):
+        """Replace the state of a service with its active resources.
+
+        The ledger can answer for windows starting at or after at.
+
+        :param service: String - one of METRICS
+        :param resources: Iterable of tuples - (tenant_id, resource_id,
+            rates)
+        :param at: Datetime
+        """
+        with self.lock, self.conn:
+            self._seed(service, resources, to_timestamp(at))
+
+    def _seed(self, service, resources, at):
+        for table in ('tenants', 'history', 'resources'):
+            self.conn.execute(
+                "DELETE FROM {0} WHERE service = ?".format(table),
+                (service,)
+            )
+        for tenant_id, resource_id, rates in resources:
+            self._apply(service, tenant_id, resource_id, at, rates)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO seeds VALUES (?, ?)", (service, at)
+        )
+
+    def seed_once(self, service, resources, at):
+        """Seed a service unless it already was.
+
+        The seeds table is checked again within an immediate transaction,
+        so of the processes sharing the ledger file that race to seed a
+        service only the first replaces its state.
+
+        :param service: String - one of METRICS
+        :param resources: Iterable of tuples, see seed
+        :param at: Datetime
+        :returns: Datetime - the time the service was seeded
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT seeded_at FROM seeds WHERE service = ?", (service,)
+            ).fetchone()
+            if row is not None:
+                return from_timestamp(row[0])
+            self._seed(service, resources, to_timestamp(at))
+        return to_naive(at)
+
+    def seeded_at(self, service):
+        """Get the time a service was seeded.
+
+        :param service: String
+        :returns: Datetime|None - None if the service was never seeded
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT seeded_at FROM seeds WHERE service = ?", (service,)
+            ).fetchone()
+        return from_timestamp(row[0]) if row is not None else None
+
+    def compact(self, service, before):
+        """Remove history no longer needed for windows starting at before.
+
+        The latest row of each tenant at or before the time is kept. The
+        ledger no longer answers for windows starting earlier.
+
+        :param service: String - one of METRICS
+        :param before: Datetime
+        """
+        before = to_timestamp(before)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM history WHERE service = ? AND at < ? AND "
+                "rowid NOT IN (SELECT latest FROM (SELECT ({0}) AS latest "
+                "FROM tenants t WHERE t.service = ?) WHERE latest IS NOT "
+                "NULL)".format(_LATEST),
+                (service, before, before, service)
+            )
+            self.conn.execute(
+                "UPDATE seeds SET seeded_at = ? WHERE service = ? AND "
+                "seeded_at < ?",
+                (before, service, before)
+            )
+
+    def _accumulated(self, service, at):
+        """Get the usage accumulated by each tenant up to a time."""
+        rows = self.conn.execute(
+            "SELECT h.tenant_id, h.at, {0}, {1} FROM tenants t JOIN history "
+            "h ON h.rowid = ({2}) WHERE t.service = ?".format(
+                ', '.join('h.acc{0}'.format(i) for i in range(WIDTH)),
+                ', '.join('h.rate{0}'.format(i) for i in range(WIDTH)),
+                _LATEST
+            ),
+            (at, service)
+        )
+        accumulated = {}
+        for row in rows:
+            hours = (at - row[1]) / 3600.0
+            acc = row[2:2 + WIDTH]
+            rate = row[2 + WIDTH:]
+            accumulated[row[0]] = [a + r * hours for a, r in zip(acc, rate)]
+        return accumulated
+
+    def usage(self, service, start, end):
+        """Get the usage of each tenant between two times.
+
+        :param service: String - one of METRICS
+        :param start: Datetime
+        :param end: Datetime
+        :returns: Dict - tenant id to dict of metric name to value
+        """
+        start = to_timestamp(start)
+        end = to_timestamp(end)
+        with self.lock:
+            before = self._accumulated(service, start)
+            after = self._accumulated(service, end)
+        names = METRICS[service]
+        usage = {}
+        for tenant_id, acc in after.items():
+            prior = before.get(tenant_id, [0.0] * WIDTH)
+            values = [a - p for a, p in zip(acc, prior)]
+            if any(values):
+                usage[tenant_id] = dict(zip(names, values))
+        return usage
+
+    def summaries(self, service, start, end):
+        """Get usage summaries shaped like the service's usage response.
+
+        :param service: String - one of METRICS
+        :param start: Datetime
+        :param end: Datetime
+        :returns: List of dicts
+        """
+        summaries = []
+        for tenant_id, metrics in self.usage(service, start, end).items():
+            summary = dict(metrics)
+            summary[TENANT_KEYS[service]] = tenant_id
+            summary['start'] = to_naive(start)
+            summary['stop'] = to_naive(end)
+            summaries.append(summary)
+        return summaries
+
+
+def get_ledger(path):
+    """Get the shared ledger of a path.
+
+    :param path: String|None
+    :returns: Ledger|None - None when no path is configured
+    """
+    if not path:
+        return None
+    with _ledgers_lock:
+        if path not in _ledgers:
+            _ledgers[path] = Ledger(path)
+        return _ledgers[path]
@@ -0,0 +1,197 @@
+"""
+Provides the notification endpoint that keeps the ledger up to date.
+
+Lifecycle notifications of nova instances, cinder volumes and glance images
+are turned into ledger events. A create or resize sets the rates of the
+resource and a delete removes them. Images are counted from creation like
+the glance report, an upload sets their size.
+"""
+import datetime
+
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+LOG = logging.getLogger(__name__)
+
+BYTES_PER_GB = 1024.0 * 1024 * 1024
+
+# Notification event types and the service and action they map to.
+EVENTS = {
+    'compute.instance.create.end': ('nova', 'create'),
+    'compute.instance.finish_resize.end': ('nova', 'resize'),
+    'compute.instance.delete.end': ('nova', 'delete'),
+    'volume.create.end': ('cinder', 'create'),
+    'volume.resize.end': ('cinder', 'resize'),
+    'volume.delete.end': ('cinder', 'delete'),
+    'image.create': ('glance', 'create'),
+    'image.upload': ('glance', 'resize'),
+    'image.delete': ('glance', 'delete')
+}
+
+# Payload keys holding the event time, tried in order before falling back
+# to the time the notification was sent.
+TIME_KEYS = {
+    'create': ('launched_at', 'created_at'),
+    'resize': (),
+    'delete': ('terminated_at', 'deleted_at')
+}
+
+
+def _number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def nova_rates(instance):
+    """Ledger rates of an instance payload or database row.
+
+    :param instance: Dict
+    :returns: List
+    """
+    return [
+        1.0,
+        _number(instance.get('vcpus')),
+        _number(instance.get('memory_mb')),
+        _number(instance.get('root_gb')) +
+        _number(instance.get('ephemeral_gb'))
+    ]
+
+
+def cinder_rates(volume):
+    """Ledger rates of a volume payload or database row.
+
+    :param volume: Dict
+    :returns: List
+    """
+    return [1.0, _number(volume.get('size'))]
+
+
+def glance_rates(image):
+    """Ledger rates of an image payload or database row.
+
+    :param image: Dict
+    :returns: List
+    """
+    return [1.0, _number(image.get('size')) / BYTES_PER_GB]
+
+
+RATES = {
+    'nova': nova_rates,
+    'cinder': cinder_rates,
+    'glance': glance_rates
+}
+
+
+def resource_keys(service, payload):
+    """Get the tenant and resource ids of a payload.
+
+    :param service: String
+    :param payload: Dict
+    :returns: tuple - (tenant_id, resource_id)
+    """
+    if service == 'nova':
+        return (payload.get('tenant_id'), payload.get('instance_id'))
+    if service == 'cinder':
+        return (payload.get('tenant_id'), payload.get('volume_id'))
+    return (payload.get('owner'), payload.get('id'))
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return timeutils.parse_isotime(value)
+    except ValueError:
+        return timeutils.parse_strtime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+
+def event_time(action, payload, metadata):
+    """Get the time of an event.
+
+    :param action: String - create, resize or delete
+    :param payload: Dict
+    :param metadata: Dict - notification metadata
+    :returns: Datetime
+    """
+    for key in TIME_KEYS[action]:
+        if payload.get(key):
+            try:
+                return _parse_time(payload[key])
+            except ValueError:
+                pass
+    if metadata and metadata.get('timestamp'):
+        return _parse_time(metadata['timestamp'])
+    return timeutils.utcnow()
+
+
+class NotificationEndpoint(object):
+    """oslo.messaging notification endpoint applying events to a ledger."""
+
+    def __init__(self, ledger):
+        """
+        :param ledger: os_usage.ledger.ledger.Ledger
+        """
+        self.ledger = ledger
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        """Handle an info level notification.
+
+        :param ctxt: Dict - request context
+        :param publisher_id: String
+        :param event_type: String
+        :param payload: Dict
+        :param metadata: Dict - message_id and timestamp
+        """
+        if event_type not in EVENTS:
+            return
+        service, action = EVENTS[event_type]
+        tenant_id, resource_id = resource_keys(service, payload)
+        if not tenant_id or not resource_id:
+            LOG.warning("Ignoring %s without tenant or resource id.",
+                        event_type)
+            return
+        rates = None
+        if action != 'delete':
+            rates = RATES[service](payload)
+        self.ledger.apply(service, tenant_id, resource_id,
+                          event_time(action, payload, metadata), rates)
+
+
+def can_answer(params):
+    """Determine if a usage request can be answered from a ledger.
+
+    The ledger keeps tenant totals only, so detailed, filtered and grouped
+    requests go to the database.
+
+    :param params: os_usage.common.request.UsageParams
+    :returns: Boolean
+    """
+    return not (params.detailed or params.metadata or params.filters or
+                params.group_by_metadata or params.breakdown or
+                params.group_by or params.host)
+
+
+def ledger_summaries(ledger, service, params, load_resources):
+    """Answer a usage request from a ledger when possible.
+
+    A service is seeded with its active resources the first time it is
+    asked for. Windows starting before the seed go to the database.
+
+    :param ledger: os_usage.ledger.ledger.Ledger|None
+    :param service: String
+    :param params: os_usage.common.request.UsageParams
+    :param load_resources: Callable accepting a Datetime and returning the
+        resources active then as (tenant_id, resource_id, rates) tuples
+    :returns: List|None - summaries, None when the database must be used
+    """
+    if ledger is None or not can_answer(params):
+        return None
+    seeded_at = ledger.seeded_at(service)
+    if seeded_at is None:
+        now = timeutils.utcnow()
+        seeded_at = ledger.seed_once(service, load_resources(now), now)
+    if timeutils.normalize_time(params.start) < seeded_at:
+        return None
+    return ledger.summaries(service, params.start, params.end)
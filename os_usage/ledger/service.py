@@ -0,0 +1,118 @@
+"""
+Console entry point of the notification listener keeping the ledger.
+
+Run on a host sharing the notification bus of nova, cinder and glance:
+
+    os-usage-ledger --config-file /etc/os_usage/os_usage.conf
+
+The ledger_path option must point at the same file the API extensions are
+configured with. With ledger_history_days set, history older than that is
+compacted at start and then hourly.
+"""
+import datetime
+import sys
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from os_usage.common import config as usage_config
+from os_usage.ledger.ledger import METRICS
+from os_usage.ledger.ledger import get_ledger
+from os_usage.ledger.notifications import NotificationEndpoint
+
+try:
+    import oslo_messaging
+except ImportError:
+    oslo_messaging = None
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between compactions of the ledger history.
+COMPACT_INTERVAL = 3600
+
+
+def get_listener(conf, ledger, transport=None):
+    """Get a notification listener applying events to a ledger.
+
+    :param conf: oslo_config.cfg.ConfigOpts
+    :param ledger: os_usage.ledger.ledger.Ledger
+    :param transport: oslo_messaging.Transport|None - defaults to the
+        configured notification transport
+    :returns: oslo_messaging.MessageHandlingServer
+    """
+    if transport is None:
+        transport = oslo_messaging.get_notification_transport(conf)
+    targets = [oslo_messaging.Target(topic=topic)
+               for topic in conf[usage_config.GROUP].ledger_topics]
+    return oslo_messaging.get_notification_listener(
+        transport, targets, [NotificationEndpoint(ledger)],
+        executor='threading'
+    )
+
+
+def compact(ledger, days):
+    """Remove ledger history older than a number of days.
+
+    :param ledger: os_usage.ledger.ledger.Ledger
+    :param days: Integer
+    """
+    before = timeutils.utcnow() - datetime.timedelta(days=days)
+    for service in sorted(METRICS):
+        ledger.compact(service, before)
+
+
+def _compact_until(ledger, days, stopped):
+    while True:
+        try:
+            compact(ledger, days)
+        except Exception:
+            LOG.exception("Ledger compaction failed.")
+        if stopped.wait(COMPACT_INTERVAL):
+            return
+
+
+def main(argv=None):
+    """Console entry point.
+
+    :param argv: List|None - arguments, defaults to sys.argv
+    :returns: Integer - exit status
+    """
+    if oslo_messaging is None:
+        sys.stderr.write("oslo.messaging is required by os-usage-ledger.\n")
+        return 1
+    conf = usage_config.register_opts(cfg.ConfigOpts())
+    logging.register_options(conf)
+    conf(sys.argv[1:] if argv is None else argv, project='os_usage')
+    logging.setup(conf, 'os_usage')
+    ledger = get_ledger(conf[usage_config.GROUP].ledger_path)
+    if ledger is None:
+        sys.stderr.write("ledger_path must be configured.\n")
+        return 1
+    stopped = threading.Event()
+    compactor = None
+    days = conf[usage_config.GROUP].ledger_history_days
+    if days:
+        compactor = threading.Thread(target=_compact_until,
+                                     args=(ledger, days, stopped))
+        compactor.daemon = True
+        compactor.start()
+    listener = get_listener(conf, ledger)
+    listener.start()
+    LOG.info("Listening for usage notifications.")
+    try:
+        listener.wait()
+    except KeyboardInterrupt:
+        listener.stop()
+        listener.wait()
+    finally:
+        stopped.set()
+        if compactor is not None:
+            compactor.join()
+        ledger.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
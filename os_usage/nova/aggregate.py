@@ -0,0 +1,558 @@
+"""
+Aggregation of nova instance rows into usage summaries.
+
+Nothing here imports nova, so the functions can run in worker processes.
+Large reports are sharded by project id and aggregated in a pool of worker
+processes forked once per API worker and reused for every report.
+
+Rows cross the worker pipes packed as tuples, pickled without the memo.
+Under eventlet the packing and the pipe I/O run in a tpool thread, so the
+hub keeps serving requests while the workers aggregate. Detailed reports
+stay in process, reading back a dict per instance costs the API worker more
+than aggregating the rows, see benchmark-aggregate.py.
+"""
+import atexit
+import datetime
+import io
+import operator
+import os
+import threading
+import traceback
+import zlib
+
+from multiprocessing import Pipe
+from multiprocessing import Process
+from oslo_utils import timeutils
+from six.moves import cPickle as pickle
+
+try:
+    from eventlet import patcher
+    from eventlet import tpool
+except ImportError:
+    patcher = None
+
+
+# Instance columns used by the aggregation. Rows sent to worker processes
+# only carry these.
+INSTANCE_FIELDS = (
+    'uuid',
+    'display_name',
+    'memory_mb',
+    'root_gb',
+    'ephemeral_gb',
+    'vcpus',
+    'project_id',
+    'host',
+    'launched_at',
+    'terminated_at',
+    'vm_state'
+)
+
+# Row key of the grouped metadata value.
+GROUP_VALUE = 'group_value'
+
+TOTALS = (
+    'total_local_gb_usage',
+    'total_vcpus_usage',
+    'total_memory_mb_usage',
+    'total_hours'
+)
+
+# Row keys holding times, packed for the workers as seconds since EPOCH. A
+# float keeps them to the microsecond through the year 2100.
+ROW_TIMES = ('launched_at', 'terminated_at')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Other row keys in the order they are packed.
+ROW_FIELDS = tuple(field for field in INSTANCE_FIELDS + ('flavor', GROUP_VALUE)
+                   if field not in ROW_TIMES)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def slim_row(instance, flavor, group_value_key=None):
+    """Build an aggregation row from an instance and its flavor.
+
+    :param instance: Dict
+    :param flavor: Dict|None
+    :param group_value_key: String|None - instance key holding the grouped
+        metadata value
+    :returns: Dict
+    """
+    row = dict((field, instance[field]) for field in INSTANCE_FIELDS)
+    row['flavor'] = flavor['name'] if flavor else ''
+    row[GROUP_VALUE] = instance[group_value_key] if group_value_key else None
+    return row
+
+
+def hours_for(row, period_start, period_stop):
+    """Determine number of active hours in period.
+
+    :param row: Dict
+    :param period_start: Datetime - timezone naive
+    :param period_stop: Datetime - timezone naive
+    :returns: Float
+    """
+    launched_at = row['launched_at']
+    terminated_at = row['terminated_at']
+    if terminated_at is not None:
+        if not isinstance(terminated_at, datetime.datetime):
+            # NOTE(mriedem): Instance object DateTime fields are
+            # timezone-aware so convert using isotime.
+            terminated_at = timeutils.parse_isotime(terminated_at)
+
+    if launched_at is not None:
+        if not isinstance(launched_at, datetime.datetime):
+            launched_at = timeutils.parse_isotime(launched_at)
+
+    if terminated_at and terminated_at < period_start:
+        return 0
+    # nothing if it started after the usage report ended
+    if launched_at and launched_at > period_stop:
+        return 0
+    if not launched_at:
+        # instance hasn't launched, so no charge
+        return 0
+
+    # if instance launched after period_started, don't charge for first
+    start = max(launched_at, period_start)
+    if terminated_at:
+        # if instance stopped before period_stop, don't charge after
+        stop = min(period_stop, terminated_at)
+    else:
+        # instance is still running, so charge them up to current time
+        stop = period_stop
+    dt = stop - start
+    seconds = (dt.days * 3600 * 24 + dt.seconds +
+               dt.microseconds / 100000.0)
+    return seconds / 3600.0
+
+
+def instance_info(row, period_start, period_stop, now):
+    """Build the usage info of one instance for a period.
+
+    :param row: Dict - see slim_row
+    :param period_start: Datetime - timezone naive
+    :param period_stop: Datetime - timezone naive
+    :param now: Datetime - timezone naive
+    :returns: Dict
+    """
+    info = {}
+    info['hours'] = hours_for(row, period_start, period_stop)
+    info['flavor'] = row['flavor']
+
+    info['instance_id'] = row['uuid']
+    info['name'] = row['display_name']
+
+    info['memory_mb'] = row['memory_mb']
+    info['local_gb'] = row['root_gb'] + row['ephemeral_gb']
+    info['vcpus'] = row['vcpus']
+
+    info['tenant_id'] = row['project_id']
+    info['host'] = row['host']
+
+    # NOTE(mriedem): We need to normalize the start/end times back
+    # to timezone-naive so the response doesn't change after the
+    # conversion to objects.
+    info['started_at'] = timeutils.normalize_time(row['launched_at'])
+
+    info['ended_at'] = (
+        timeutils.normalize_time(row['terminated_at']) if
+        row['terminated_at'] else None
+    )
+
+    if info['ended_at']:
+        info['state'] = 'terminated'
+        delta = info['ended_at'] - info['started_at']
+    else:
+        info['state'] = row['vm_state']
+        delta = now - info['started_at']
+
+    info['uptime'] = delta.days * 24 * 3600 + delta.seconds
+    return info
+
+
+def _new_summary(period_start, period_stop):
+    summary = dict((total, 0) for total in TOTALS)
+    summary['start'] = period_start
+    summary['stop'] = period_stop
+    return summary
+
+
+def _add_info(summary, info):
+    summary['total_local_gb_usage'] += info['local_gb'] * info['hours']
+    summary['total_vcpus_usage'] += info['vcpus'] * info['hours']
+    summary['total_memory_mb_usage'] += info['memory_mb'] * info['hours']
+    summary['total_hours'] += info['hours']
+
+
+def tenant_usages(rows, period_start, period_stop, now, detailed=True,
+                  group_by_metadata=None, breakdown=None):
+    """Aggregate rows into per tenant summaries.
+
+    :param rows: List of dicts - see slim_row
+    :param period_start: Datetime - timezone naive
+    :param period_stop: Datetime - timezone naive
+    :param now: Datetime - timezone naive
+    :param detailed: Boolean - include server_usages
+    :param group_by_metadata: String|None - one summary per (tenant, value
+        of this metadata key)
+    :param breakdown: String|None - one summary per (tenant, value of this
+        info key)
+    :returns: Dict - summaries keyed by group
+    """
+    rval = {}
+    for row in rows:
+        info = instance_info(row, period_start, period_stop, now)
+        group = {}
+        if group_by_metadata:
+            group['metadata_key'] = group_by_metadata
+            group['metadata_value'] = row[GROUP_VALUE]
+        if breakdown:
+            group[breakdown] = info[breakdown]
+        key = (info['tenant_id'],) + tuple(sorted(group.items()))
+
+        summary = rval.get(key)
+        if summary is None:
+            summary = _new_summary(period_start, period_stop)
+            summary.update(group)
+            summary['tenant_id'] = info['tenant_id']
+            if detailed:
+                summary['server_usages'] = []
+            rval[key] = summary
+
+        _add_info(summary, info)
+        if detailed:
+            summary['server_usages'].append(info)
+    return rval
+
+
+def host_usages(rows, period_start, period_stop, now, per_tenant=False):
+    """Aggregate rows into per compute host summaries.
+
+    :param rows: List of dicts - see slim_row
+    :param period_start: Datetime - timezone naive
+    :param period_stop: Datetime - timezone naive
+    :param now: Datetime - timezone naive
+    :param per_tenant: Boolean - group by (host, tenant) instead of host
+    :returns: Dict - summaries keyed by group
+    """
+    rval = {}
+    for row in rows:
+        info = instance_info(row, period_start, period_stop, now)
+        if per_tenant:
+            key = (info['host'], info['tenant_id'])
+        else:
+            key = info['host']
+
+        summary = rval.get(key)
+        if summary is None:
+            summary = _new_summary(period_start, period_stop)
+            summary['host'] = info['host']
+            if per_tenant:
+                summary['tenant_id'] = info['tenant_id']
+            summary['instance_count'] = 0
+            rval[key] = summary
+
+        summary['instance_count'] += 1
+        _add_info(summary, info)
+    return rval
+
+
+def merge(partials):
+    """Merge partial summaries aggregated from different shards.
+
+    :param partials: Iterable of dicts - summaries keyed by group
+    :returns: Dict
+    """
+    rval = {}
+    for partial in partials:
+        for key, summary in partial.items():
+            current = rval.get(key)
+            if current is None:
+                rval[key] = summary
+                continue
+            for total in TOTALS + ('instance_count',):
+                if total in summary:
+                    current[total] += summary[total]
+            if 'server_usages' in summary:
+                current['server_usages'].extend(summary['server_usages'])
+    return rval
+
+
+def shard(rows, count, field='project_id'):
+    """Split rows into count shards by a stable hash of a field.
+
+    All rows of one tenant land in the same shard.
+
+    :param rows: List of dicts
+    :param count: Integer
+    :param field: String
+    :returns: List of lists
+    """
+    shards = [[] for _ in range(count)]
+    for row in rows:
+        value = row[field] or ''
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        shards[(zlib.crc32(value) & 0xffffffff) % count].append(row)
+    return shards
+
+
+def _pack_time(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = timeutils.normalize_time(value)
+        return (value - EPOCH).total_seconds()
+    return value
+
+
+def _unpack_time(value):
+    if isinstance(value, float):
+        return EPOCH + datetime.timedelta(seconds=value)
+    return value
+
+
+def pack(rows):
+    """Pack rows into tuples of their values and columns of their times.
+
+    Datetimes are most of the cost of pickling a row, times are packed as
+    seconds since EPOCH.
+
+    :param rows: List of dicts - see slim_row
+    :returns: Tuple - (list of tuples, list of time columns)
+    """
+    values = list(map(operator.itemgetter(*ROW_FIELDS), rows))
+    columns = [[_pack_time(row[time]) for row in rows] for time in ROW_TIMES]
+    return values, columns
+
+
+def unpack(packed):
+    """Rebuild the rows packed by pack.
+
+    :param packed: Tuple - (list of tuples, list of time columns)
+    :returns: List of dicts
+    """
+    values, columns = packed
+    columns = [[_unpack_time(value) for value in column]
+               for column in columns]
+    keys = ROW_FIELDS + ROW_TIMES
+    return [dict(zip(keys, row + row_times))
+            for row, row_times in zip(values, zip(*columns))]
+
+
+def dumps(obj):
+    """Pickle obj without the memo.
+
+    Packed rows share no objects, keeping a memo of every value pickled
+    costs several times the pickling itself.
+
+    :param obj: Object
+    :returns: Bytes
+    """
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.fast = True
+    pickler.dump(obj)
+    return buf.getvalue()
+
+
+def _serve(tasks, replies):
+    """Aggregate the tasks received until the pool closes the pipe.
+
+    :param tasks: multiprocessing Connection - read end of the tasks
+    :param replies: multiprocessing Connection - write end of the replies
+    """
+    while True:
+        try:
+            func, packed, args, kwargs = pickle.loads(tasks.recv_bytes())
+        except EOFError:
+            return
+        try:
+            rows = unpack(packed)
+            reply = (True, func(rows, *args, **kwargs))
+        except Exception:
+            reply = (False, traceback.format_exc())
+        replies.send_bytes(dumps(reply))
+
+
+def _exchange(workers, func, rows, args, kwargs):
+    """Send a shard of rows to each worker, then read every reply.
+
+    Every sent task is read back, even after a failure, so no stale reply
+    is left in a pipe for the next report.
+
+    :param workers: List of _Worker - locked by the caller
+    :param func: Callable - tenant_usages or host_usages
+    :param rows: List of dicts - see slim_row
+    :param args: Tuple - positional arguments of func after the rows
+    :param kwargs: Dict - keyword arguments of func
+    :returns: List - results of func
+    """
+    exited = False
+    sent = []
+    for worker, shard_rows in zip(workers, shard(rows, len(workers))):
+        if not shard_rows:
+            continue
+        task = dumps((func, pack(shard_rows), args, kwargs))
+        try:
+            worker.tasks.send_bytes(task)
+        except (IOError, OSError):
+            exited = True
+            continue
+        sent.append(worker)
+    replies = []
+    for worker in sent:
+        try:
+            replies.append(pickle.loads(worker.replies.recv_bytes()))
+        except (EOFError, IOError, OSError):
+            exited = True
+    if exited:
+        raise RuntimeError("A usage aggregation worker exited.")
+    for ok, result in replies:
+        if not ok:
+            raise RuntimeError("Usage aggregation failed: {0}".format(result))
+    return [result for _, result in replies]
+
+
+class _Worker(object):
+    """A forked worker process and the parent ends of its pipes."""
+
+    def __init__(self):
+        # Simplex pipes are os pipes, eventlet would make the sockets of a
+        # duplex pipe non blocking.
+        tasks, self.tasks = Pipe(duplex=False)
+        self.replies, replies = Pipe(duplex=False)
+        self.process = Process(target=_serve, args=(tasks, replies))
+        self.process.daemon = True
+        self.process.start()
+        tasks.close()
+        replies.close()
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.tasks.close()
+        self.replies.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class WorkerPool(object):
+    """Worker processes aggregating the shards of large reports.
+
+    Each worker handles one report at a time, concurrent reports wait for
+    the workers they need.
+    """
+
+    def __init__(self, processes):
+        """Fork the workers.
+
+        :param processes: Integer
+        """
+        self.pid = os.getpid()
+        self.processes = processes
+        self.workers = [_Worker() for _ in range(processes)]
+        self._lock = threading.Lock()
+
+    def map(self, func, rows, args, kwargs):
+        """Aggregate a shard of rows in each worker.
+
+        Under eventlet the sharding, packing and pipe I/O run in a tpool
+        thread, the calling green thread waits without blocking the hub.
+
+        :param func: Callable - tenant_usages or host_usages
+        :param rows: List of dicts - see slim_row
+        :param args: Tuple - positional arguments of func after the rows
+        :param kwargs: Dict - keyword arguments of func
+        :returns: List - results of func
+        """
+        with self._lock:
+            # Replace workers that died since the last report.
+            for i, worker in enumerate(self.workers):
+                if not worker.process.is_alive():
+                    self.workers[i] = _Worker()
+            workers = list(self.workers)
+        for worker in workers:
+            worker.lock.acquire()
+        try:
+            if _green():
+                return tpool.execute(_exchange, workers, func, rows, args,
+                                     kwargs)
+            return _exchange(workers, func, rows, args, kwargs)
+        finally:
+            for worker in workers:
+                worker.lock.release()
+
+    def close(self):
+        """Stop the workers."""
+        with self._lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+
+
+def _get_pool(processes):
+    """Get the worker pool of this process, forked on first use.
+
+    A pool inherited from a parent process, like the master of a forking
+    wsgi server, belongs to the parent and is replaced.
+
+    :param processes: Integer
+    :returns: WorkerPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _pool = None
+        if _pool is not None and _pool.processes != processes:
+            _pool.close()
+            _pool = None
+        if _pool is None:
+            _pool = WorkerPool(processes)
+        return _pool
+
+
+def close_pool():
+    """Stop the worker pool of this process, if it was started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+def _green():
+    """Whether this process runs under eventlet's monkey patching."""
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+
+def aggregate(func, rows, period_start, period_stop, processes=0,
+              threshold=1, **kwargs):
+    """Aggregate rows with func, in worker processes for large reports.
+
+    The current time is taken once for the whole report. Detailed tenant
+    reports are always aggregated in process.
+
+    :param func: Callable - tenant_usages or host_usages
+    :param rows: List of dicts - see slim_row
+    :param period_start: Datetime
+    :param period_stop: Datetime
+    :param processes: Integer - worker processes, 0 or 1 for none
+    :param threshold: Integer - minimum rows to use the worker processes
+    :returns: List - summaries
+    """
+    args = (
+        timeutils.normalize_time(period_start),
+        timeutils.normalize_time(period_stop),
+        timeutils.utcnow()
+    )
+    detailed = func is tenant_usages and kwargs.get('detailed', True)
+    if processes < 2 or len(rows) < threshold or detailed:
+        return list(func(rows, *args, **kwargs).values())
+
+    partials = _get_pool(processes).map(func, rows, args, kwargs)
+    return list(merge(partials).values())
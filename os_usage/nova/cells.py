@@ -0,0 +1,101 @@
+"""
+Concurrent queries across nova cell databases.
+
+Instances of a multi cell deployment live in one database per cell. The
+same query is run against every cell database at once and the results are
+returned in the order the connections were given.
+
+Only SQLAlchemy is used here so the fan out can be tested against local
+SQLite databases.
+"""
+import threading
+
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+_cells = {}
+_cells_lock = threading.Lock()
+
+
+class CellDatabases(object):
+    """Engines and sessions of a set of cell databases."""
+
+    def __init__(self, connections, concurrency=None):
+        """Inits the cell databases. Engines are created on first use.
+
+        :param connections: List of String - SQLAlchemy connection urls
+        :param concurrency: Integer|None - max cells queried at once,
+            defaults to all of them
+        """
+        self.connections = list(connections)
+        self.concurrency = concurrency
+        self._sessionmakers = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, connection):
+        """Get a new session for a cell database.
+
+        :param connection: String - SQLAlchemy connection url
+        :returns: sqlalchemy.orm.Session
+        """
+        with self._lock:
+            if connection not in self._sessionmakers:
+                engine = create_engine(connection)
+                self._sessionmakers[connection] = sessionmaker(bind=engine)
+            return self._sessionmakers[connection]()
+
+    def query(self, connection, func, *args, **kwargs):
+        """Run func with a session of one cell database.
+
+        :param connection: String - SQLAlchemy connection url
+        :param func: Callable accepting a session and args
+        :returns: The result of func
+        """
+        session = self.get_session(connection)
+        try:
+            return func(session, *args, **kwargs)
+        finally:
+            session.close()
+
+    def map(self, func, *args, **kwargs):
+        """Run func against every cell database concurrently.
+
+        :param func: Callable accepting a session and args
+        :returns: List - results of func in connection order
+        """
+        if len(self.connections) < 2:
+            return [self.query(connection, func, *args, **kwargs)
+                    for connection in self.connections]
+        pool = ThreadPool(self.concurrency or len(self.connections))
+        try:
+            return pool.map(
+                lambda connection: self.query(connection, func, *args,
+                                              **kwargs),
+                self.connections
+            )
+        finally:
+            pool.terminate()
+
+    def dispose(self):
+        """Dispose of the engines of all cell databases."""
+        with self._lock:
+            for maker in self._sessionmakers.values():
+                maker.kw['bind'].dispose()
+            self._sessionmakers = {}
+
+
+def get_cells(connections, concurrency=None):
+    """Get the shared CellDatabases of a list of connections.
+
+    Engines and their connection pools are reused between requests.
+
+    :param connections: List of String - SQLAlchemy connection urls
+    :param concurrency: Integer|None - max cells queried at once
+    :returns: CellDatabases
+    """
+    key = (tuple(connections), concurrency)
+    with _cells_lock:
+        if key not in _cells:
+            _cells[key] = CellDatabases(connections, concurrency)
+        return _cells[key]
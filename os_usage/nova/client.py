@@ -1,10 +1,37 @@
 """This module adds nova usage functionality to the nova pythonclient."""
 
+import json
 import six
 from six.moves.urllib import parse
 
 from novaclient import base
 
+from os_usage.common import job_client
+from os_usage.common import json_stream
+from os_usage.common import store as usage_store
+from os_usage.common.http_cache import ByteCounter
+from os_usage.common.http_cache import cached_get
+from os_usage.common.usage_dict import Schema
+from os_usage.common.usage_dict import add_tenant_usage
+from os_usage.common.usage_dict import get_group
+from os_usage.common.usage_dict import translate
+from os_usage.common.windows import fetch_windows
+
+
+SCHEMA = Schema(
+    tenant_key='tenant_id',
+    metrics=(
+        'total_hours',
+        'total_local_gb_usage',
+        'total_memory_mb_usage',
+        'total_vcpus_usage'
+    ),
+    resources_key='server_usages'
+)
+
+USAGE_PATH = '/os-complex-tenant-usage'
+JOBS_PATH = '/os-complex-tenant-usage-jobs'
+
 
 class Usage(base.Resource):
     def __repr__(self):
@@ -14,16 +41,155 @@ class Usage(base.Resource):
 class UsageClient(base.ManagerWithFind):
     resource_class = Usage
 
-    def list(self, start, end, detailed=False, metadata=None):
+    def __init__(self, api, cache=None):
+        """Inits the usage client.
+
+        :param api: novaclient.client.Client
+        :param cache: os_usage.common.http_cache.ResponseCache|None -
+            revalidate and reuse tagged responses
+        """
+        super(UsageClient, self).__init__(api)
+        self.cache = cache
+        # Body bytes of every usage response received.
+        self.received = ByteCounter()
+
+    def _get(self, url, response_key, rows_to_dict):
+        """GET a usage url through the response cache.
+
+        :param url: String
+        :param response_key: String - key of the list in the response body
+        :param rows_to_dict: Callable converting the list of raw rows
+        :returns: Dict
+        """
+        return cached_get(
+            self.cache, self.api.client, url,
+            lambda resp, body: rows_to_dict(body[response_key]),
+            self.received
+        )
+
+    def list(self, start, end, detailed=False, metadata=None, split=1,
+             concurrency=None, group_by_metadata=None, breakdown=None):
+        """List server usages between start and end by metadata.
+
+        :param start: Datetime
+        :param end: Datetime
+        :param detailed: Boolean - Add server information to query
+        :param metadata: Dict|None - filter, see os_usage.common.metadata
+        :param split: Integer - split the range into this many sub windows
+            requested in parallel and merged
+        :param concurrency: Integer|None - max sub windows requested at once
+        :param group_by_metadata: String|None - also report usage per value
+            of this metadata key under 'groups'
+        :param breakdown: String|None - also report usage per flavor under
+            'groups'
+        :returns: Dict
+        """
+        if split > 1:
+            return fetch_windows(
+                lambda s, e: self.list(s, e, detailed=detailed,
+                                       metadata=metadata,
+                                       group_by_metadata=group_by_metadata,
+                                       breakdown=breakdown),
+                start, end, split, concurrency
+            )
+
+        return self._get(
+            self._url(start, end, detailed, metadata, group_by_metadata,
+                      breakdown),
+            "tenant_usages",
+            self.rows_to_dict
+        )
+
+    def iter_list(self, start, end, detailed=False, metadata=None,
+                  group_by_metadata=None, breakdown=None,
+                  chunk_size=json_stream.CHUNK_SIZE,
+                  raw_resources=False):
+        """Stream server usages between start and end.
+
+        Rows are decoded as the response arrives instead of after the whole
+        body is read. Grouped rows of a tenant are yielded separately.
+
+        :param start: Datetime
+        :param end: Datetime
+        :param detailed: Boolean - Add server information to query
+        :param metadata: Dict|None - filter, see os_usage.common.metadata
+        :param group_by_metadata: String|None
+        :param breakdown: String|None
+        :param chunk_size: Integer - bytes read at a time
+        :param raw_resources: Boolean - keep the resource usages of each
+            row as a json_stream.RawList instead of decoding them
+        :yields: Dict - usage dict of one response row
+        """
+        url = self._url(start, end, detailed, metadata, group_by_metadata,
+                        breakdown)
+        raw_key = SCHEMA.resources_key if raw_resources else None
+        for row in json_stream.stream_items(self.api.client, url,
+                                            'tenant_usages', chunk_size,
+                                            raw_key, self.received):
+            yield self.rows_to_dict([row])
+
+    def submit_job(self, start, end, detailed=False, metadata=None,
+                   group_by_metadata=None, breakdown=None):
+        """Submit a report job computing server usages in the background.
+
+        Takes the same arguments as list without splitting.
+
+        :returns: String - job id
+        """
+        url = self._url(start, end, detailed, metadata, group_by_metadata,
+                        breakdown, path=JOBS_PATH)
+        return job_client.submit_job(self.api.client, url)['id']
+
+    def get_job(self, job_id):
+        """Get a report job.
+
+        :param job_id: String
+        :returns: Dict - the job, with its result once done
+        """
+        return job_client.get_job(self.api.client, self._job_url(job_id))
+
+    def wait_for_job(self, job_id, interval=job_client.POLL_INTERVAL,
+                     timeout=None):
+        """Wait for a report job and get its result.
+
+        :param job_id: String
+        :param interval: Float - seconds between polls
+        :param timeout: Float|None - seconds to wait, None waits forever
+        :returns: Dict - usage dict of the report
+        :raises: os_usage.common.job_client.JobFailed,
+            os_usage.common.job_client.JobTimeout
+        """
+        job = job_client.wait_for_job(self.api.client, self._job_url(job_id),
+                                      interval, timeout)
+        return self.rows_to_dict(job['result']['tenant_usages'])
+
+    def _job_url(self, job_id):
+        return '{0}/{1}'.format(JOBS_PATH, parse.quote(job_id))
+
+    def _url(self, start, end, detailed, metadata, group_by_metadata,
+             breakdown, path=USAGE_PATH, group_by=None, host=None):
+        """Build the url of a tenant or host usage request.
+
+        :param group_by: String|None - host or host_tenant for host usages
+        :param host: String|None - only include this compute host
+        :returns: String
+        """
         if metadata is None:
             metadata = {}
 
         opts = {
             'start': start.isoformat(),
             'end': end.isoformat(),
-            'detailed': int(bool(detailed))
+            'detailed': int(bool(detailed)),
+            'group_by_metadata': group_by_metadata,
+            'breakdown': breakdown,
+            'group_by': group_by,
+            'host': host
         }
 
+        if isinstance(metadata, dict):
+            metadata = json.dumps(metadata)
+
         if metadata:
             opts['metadata'] = metadata
 
@@ -35,10 +201,22 @@ class UsageClient(base.ManagerWithFind):
                 qparams[opt] = val
 
         query_string = '?%s' % parse.urlencode(qparams)
-        return self.to_dict(self._list(
-            "/os-complex-tenant-usage%s" % (query_string),
-            "tenant_usages"
-        ))
+        return "%s%s" % (path, query_string)
+
+    def scope(self):
+        """Get the endpoint, project and user usage is read with.
+
+        :returns: Dict - see os_usage.common.store.client_scope
+        """
+        return usage_store.client_scope(self.api.client)
+
+    def rows_to_dict(self, rows):
+        """Converts raw tenant usage rows to a usage dict.
+
+        :param rows: List of dicts - decoded tenant_usages
+        :returns: Dict
+        """
+        return translate(rows, SCHEMA)
 
     def to_dict(self, resp):
         """
@@ -48,23 +226,65 @@ class UsageClient(base.ManagerWithFind):
         :param tenant_usage: ?
         :returns: os_usage.TenantUsage
         """
+        attrs = SCHEMA.metrics
+        usage = {}
+        for tenant_usage in resp:
+            get = lambda name, default: getattr(tenant_usage, name, default)
+            add_tenant_usage(
+                usage,
+                tenant_usage.tenant_id,
+                dict((attr, get(attr, 0)) for attr in attrs),
+                get('server_usages', []),
+                get_group(get)
+            )
+        return usage
+
+    def list_hosts(self, start, end, host=None, per_tenant=False,
+                   metadata=None):
+        """List server usages between start and end grouped by host.
+
+        :param start: Datetime
+        :param end: Datetime
+        :param host: String|None - only include this compute host
+        :param per_tenant: Boolean - also break each host down by tenant
+        :param metadata: Dict|None
+        :returns: Dict
+        """
+        url = self._url(start, end, False, metadata, None, None,
+                        group_by='host_tenant' if per_tenant else 'host',
+                        host=host)
+        return self._get(url, "host_usages", self.hosts_to_dict)
+
+    def hosts_to_dict(self, rows):
+        """Converts raw host usage rows to a dict keyed by host.
+
+        Each host has 'metrics' and, when grouped per tenant, 'tenants'
+        mapping tenant id to that tenant's metrics on the host.
+
+        :param rows: List of dicts - decoded host_usages
+        :returns: Dict
+        """
         attrs = [
+            'instance_count',
             'total_hours',
             'total_local_gb_usage',
             'total_memory_mb_usage',
             'total_vcpus_usage'
         ]
         usage = {}
-        for tenant_usage in resp:
-            project_id = tenant_usage.tenant_id
-            usage[project_id] = {
-                'metrics': {},
-                'resource_usages': []
-            }
+        for row in rows:
+            if not row:
+                continue
+            host = row['host']
+            if host not in usage:
+                usage[host] = {
+                    'metrics': dict((attr, 0) for attr in attrs),
+                    'tenants': {}
+                }
+            metrics = dict((attr, row.get(attr, 0)) for attr in attrs)
             for attr in attrs:
-                usage[project_id]['metrics'][attr] = \
-                    getattr(tenant_usage, attr, 0)
-            usage[project_id]['resource_usages'].extend(
-                getattr(tenant_usage, 'server_usages', [])
-            )
+                usage[host]['metrics'][attr] += metrics[attr]
+            tenant_id = row.get('tenant_id')
+            if tenant_id is not None:
+                usage[host]['tenants'][tenant_id] = metrics
         return usage
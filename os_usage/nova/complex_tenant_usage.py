@@ -13,15 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import datetime
-
+from oslo_config import cfg
 from oslo_log import log as logging
-from oslo_serialization import jsonutils
 from oslo_utils import timeutils
 from webob import exc
 
 from nova.api.openstack import extensions
-from nova import exception
+from nova.api.openstack import wsgi
 from nova.api.openstack.compute.simple_tenant_usage \
     import SimpleTenantUsageController
 
@@ -31,13 +29,30 @@ from nova.db.sqlalchemy.api import get_session
 from nova.db.sqlalchemy.api import _manual_join_columns
 from nova.db.sqlalchemy.api import require_context
 from nova.objects.instance import _expected_cols
+from os_usage.common import admission as usage_admission
+from os_usage.common import config as usage_config
+from os_usage.common import deadline as usage_deadline
+from os_usage.common import etag as usage_etag
+from os_usage.common import interval_index
+from os_usage.common import jobs as usage_jobs
+from os_usage.common import metadata as usage_metadata
+from os_usage.common import request
+from os_usage.ledger import ledger as usage_ledger
+from os_usage.ledger import notifications as ledger_notifications
+from os_usage.nova import aggregate
+from os_usage.nova import cells as nova_cells
 from sqlalchemy import or_
-from sqlalchemy.orm import aliased
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import undefer
 from sqlalchemy.sql import null
 
 LOG = logging.getLogger(__name__)
+CONF = usage_config.register_opts(cfg.CONF)
+
+INSTANCE_METADATA = usage_metadata.MetadataTable(
+    models.InstanceMetadata, models.Instance,
+    foreign_key='instance_uuid', parent_key='uuid'
+)
 
 
 @require_context
@@ -48,7 +63,9 @@ def instance_get_active_by_window_joined(
     host=None,
     use_slave=False,
     columns_to_join=None,
-    metadata=None
+    metadata=None,
+    group_by_metadata=None,
+    deadline=None
 ):
     """Simulate bottom most layer.
 
@@ -60,16 +77,50 @@ def instance_get_active_by_window_joined(
     :param use_slave: Boolean
     :param columns_to_join: List|None
     :param metadata: Dict|None
+    :param group_by_metadata: String|None - metadata key whose value is
+        stored in each instance dict under GROUP_VALUE_KEY
+    :param deadline: os_usage.common.deadline.Deadline|None
     """
-    if metadata:
-        aliases = [aliased(models.InstanceMetadata) for i in metadata]
+    if CONF.os_usage.cell_connections:
+        cells = nova_cells.get_cells(CONF.os_usage.cell_connections,
+                                     CONF.os_usage.cell_concurrency)
+        results = cells.map(
+            _active_by_window_joined, begin, end, project_id, host,
+            columns_to_join, metadata, group_by_metadata, deadline
+        )
     else:
-        aliases = []
-    session = get_session(use_slave=use_slave)
+        session = get_session(use_slave=use_slave)
+        results = [_active_by_window_joined(
+            session, begin, end, project_id, host, columns_to_join,
+            metadata, group_by_metadata, deadline
+        )]
+
+    instances = []
+    flavors = []
+    for cell_instances, cell_flavors in results:
+        instances.extend(cell_instances)
+        flavors.extend(cell_flavors)
+    return (instances, flavors)
+
+
+def _active_by_window_joined(
+    session,
+    begin, end,
+    project_id,
+    host,
+    columns_to_join,
+    metadata,
+    group_by_metadata,
+    deadline=None
+):
+    """Query the instances of one database active during a window.
+
+    :param session: SQLAlchemy session of a nova or cell database
+    :returns: Tuple - (instances, flavors)
+    """
     query = session.query(
         models.Instance,
-        models.InstanceTypes,
-        *aliases
+        models.InstanceTypes
     )
 
     if columns_to_join is None:
@@ -95,99 +146,295 @@ def instance_get_active_by_window_joined(
         query = query.filter_by(host=host)
 
     if metadata:
-        for keypair, alias in zip(metadata.items(), aliases):
-            query = query.filter(alias.key == keypair[0])
-            query = query.filter(alias.value == keypair[1])
-            query = query.filter(alias.instance_uuid == models.Instance.uuid)
-            query = query.filter(or_(
-                alias.deleted_at == null(),
-                alias.deleted_at == models.Instance.deleted_at
-            ))
+        query = query.filter(
+            usage_metadata.metadata_filter(INSTANCE_METADATA, metadata)
+        )
 
     query = query.filter(
         models.Instance.instance_type_id == models.InstanceTypes.id
     )
 
+    if group_by_metadata:
+        query = usage_metadata.add_group_value(
+            query, INSTANCE_METADATA, group_by_metadata
+        )
+
     flavors = []
     instances = []
-    for tup in query.all():
-        # Query results are in tuple form (Instance, Flavor, Meta 1, Meta 2..)
-        instance = tup[0]
-        instances.append(dict(instance))
+    for tup in usage_deadline.iter_rows(session, query, deadline):
+        # Query results are in tuple form (Instance, Flavor) followed by the
+        # grouped metadata value when grouping.
+        instance = dict(tup[0])
+        if group_by_metadata:
+            instance[usage_metadata.GROUP_VALUE_KEY] = tup[-1]
+        instances.append(instance)
         flavor = tup[1]
         flavors.append(dict(flavor))
 
     return (instances, flavors)
 
 
+def instance_window_states(begin, end, host=None, metadata=False,
+                           use_slave=False):
+    """Get the states validating a report of a closed window.
+
+    :param begin: Datetime
+    :param end: Datetime
+    :param host: String|None
+    :param metadata: Boolean - include the instance metadata table
+    :param use_slave: Boolean
+    :returns: List - states of every cell database
+    """
+    if CONF.os_usage.cell_connections:
+        cells = nova_cells.get_cells(CONF.os_usage.cell_connections,
+                                     CONF.os_usage.cell_concurrency)
+        return cells.map(_window_states, begin, end, host, metadata)
+    session = get_session(use_slave=use_slave)
+    return [_window_states(session, begin, end, host, metadata)]
+
+
+def _window_states(session, begin, end, host, metadata):
+    """Get the window states of one database.
+
+    :param session: SQLAlchemy session of a nova or cell database
+    :returns: List of tuples
+    """
+    criteria = []
+    if host:
+        criteria.append(models.Instance.host == host)
+    states = [usage_etag.window_state(
+        session, models.Instance, 'launched_at', 'terminated_at',
+        begin, end, criteria
+    )]
+    if metadata:
+        states.append(
+            usage_etag.table_state(session, models.InstanceMetadata)
+        )
+    return states
+
+
+def instance_lifetimes(since=None, use_slave=False):
+    """Get the lifetimes of instances for the interval index.
+
+    :param since: Datetime|None - only instances changed from then on
+    :param use_slave: Boolean
+    :returns: List of tuples, see interval_index.load_lifetimes
+    """
+    if CONF.os_usage.cell_connections:
+        cells = nova_cells.get_cells(CONF.os_usage.cell_connections,
+                                     CONF.os_usage.cell_concurrency)
+        results = cells.map(_instance_lifetimes, since)
+    else:
+        session = get_session(use_slave=use_slave)
+        results = [_instance_lifetimes(session, since)]
+    return [lifetime for result in results for lifetime in result]
+
+
+def _instance_lifetimes(session, since):
+    """Get the instance lifetimes of one database.
+
+    :param session: SQLAlchemy session of a nova or cell database
+    :returns: List of tuples
+    """
+    return interval_index.load_lifetimes(
+        session, models.Instance, 'nova', 'uuid', 'project_id',
+        'launched_at', 'terminated_at',
+        ('vcpus', 'memory_mb', 'root_gb', 'ephemeral_gb'), since
+    )
+
+
 ALIAS = "os-complex-tenant-usage"
+JOBS_ALIAS = ALIAS + "-jobs"
 authorize = extensions.os_compute_authorizer(ALIAS)
 
+# Server side breakdown dimensions. Each is a key of the instance info.
+BREAKDOWNS = ('flavor',)
+GROUP_BYS = ('host', 'host_tenant')
+
+# Key summaries of each response list are paginated on.
+PAGE_KEYS = {'tenant_usages': 'tenant_id', 'host_usages': 'host'}
+
 
 class ComplexTenantUsageController(SimpleTenantUsageController):
-    @extensions.expected_errors(400)
+    @extensions.expected_errors((304, 400, 429, 504))
     def index(self, req):
         """Retrieve tenant_usage for all tenants."""
         context = req.environ['nova.context']
         authorize(context, action="list")
+        params = self._params(req)
+
+        etag = self._etag(req, params)
+        if usage_etag.not_modified(req, etag):
+            raise exc.HTTPNotModified()
+
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is not None:
+            usages = request.paginate(usages, 'tenant_id', params)
+            return self._response({'tenant_usages': usages}, etag)
+
+        deadline = usage_deadline.from_params(CONF.os_usage, params)
+        with usage_deadline.enforce(deadline), \
+                usage_admission.admit(CONF.os_usage, params):
+            key, usages = self._report(context, params, deadline)
+        usages = request.paginate(usages, PAGE_KEYS[key], params)
+        return self._response({key: usages}, etag)
+
+    def _params(self, req):
+        """Validate the query parameters of a request.
+
+        :param req: webob.Request
+        :returns: os_usage.common.request.UsageParams
+        :raises: webob.exc.HTTPBadRequest
+        """
+        try:
+            return request.UsageParams.from_request(
+                req, breakdowns=BREAKDOWNS, group_bys=GROUP_BYS
+            )
+        except request.InvalidRequest as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
 
-        metadata = req.GET.get('metadata', '{}')
-        metadata = jsonutils.loads(metadata)
+    def _report(self, context, params, deadline=None):
+        """Compute a report from the database.
 
-        try:
-            (period_start, period_stop, detailed) = \
-                self._get_datetime_range(req)
-        except exception.InvalidStrTime as e:
-            raise exc.HTTPBadRequest(explanation=e.format_message())
-
-        now = timeutils.parse_isotime(timeutils.strtime())
-        if period_stop > now:
-            period_stop = now
-
-        usages = self._tenant_usages_for_period(context,
-                                                period_start,
-                                                period_stop,
-                                                detailed=detailed,
-                                                metadata=metadata)
-        return {'tenant_usages': usages}
-
-    def _hours_for(self, instance, period_start, period_stop):
-        launched_at = instance['launched_at']
-        terminated_at = instance['terminated_at']
-        period_start = timeutils.normalize_time(period_start)
-        period_stop = timeutils.normalize_time(period_stop)
-        if terminated_at is not None:
-            if not isinstance(terminated_at, datetime.datetime):
-                # NOTE(mriedem): Instance object DateTime fields are
-                # timezone-aware so convert using isotime.
-                terminated_at = timeutils.parse_isotime(terminated_at)
-
-        if launched_at is not None:
-            if not isinstance(launched_at, datetime.datetime):
-                launched_at = timeutils.parse_isotime(launched_at)
-
-        if terminated_at and terminated_at < period_start:
-            return 0
-        # nothing if it started after the usage report ended
-        if launched_at and launched_at > period_stop:
-            return 0
-        if launched_at:
-            # if instance launched after period_started, don't charge for first
-            start = max(launched_at, period_start)
-            if terminated_at:
-                # if instance stopped before period_stop, don't charge after
-                stop = min(period_stop, terminated_at)
-            else:
-                # instance is still running, so charge them up to current time
-                stop = period_stop
-            dt = stop - start
-            seconds = (dt.days * 3600 * 24 + dt.seconds +
-                       dt.microseconds / 100000.0)
-
-            return seconds / 3600.0
-        else:
-            # instance hasn't launched, so no charge
-            return 0
+        :param context: wsgi context
+        :param params: os_usage.common.request.UsageParams
+        :param deadline: os_usage.common.deadline.Deadline|None
+        :returns: Tuple - (response key, summaries)
+        """
+        if params.group_by:
+            return 'host_usages', self._host_usages_for_period(
+                context,
+                params.start,
+                params.end,
+                host=params.host,
+                per_tenant=params.group_by == 'host_tenant',
+                metadata=params.metadata,
+                deadline=deadline
+            )
+        return 'tenant_usages', self._tenant_usages_for_period(
+            context,
+            params.start,
+            params.end,
+            detailed=params.detailed,
+            metadata=params.metadata,
+            host=params.host,
+            group_by_metadata=params.group_by_metadata,
+            breakdown=params.breakdown,
+            deadline=deadline
+        )
+
+    def _job_report(self, context, params):
+        """Compute the whole report of a report job.
+
+        :param context: wsgi context
+        :param params: os_usage.common.request.UsageParams
+        :returns: Dict - response body
+        """
+        usages = self._ledger_usages(context, params)
+        if usages is None:
+            usages = self._index_usages(params)
+        if usages is not None:
+            return {'tenant_usages': usages}
+        deadline = usage_deadline.Deadline(CONF.os_usage.job_timeout or None)
+        key, usages = self._report(context, params, deadline)
+        return {key: usages}
+
+    def _etag(self, req, params):
+        """Get the ETag of a report, None unless the window is closed.
+
+        :param req: webob.Request
+        :param params: os_usage.common.request.UsageParams
+        :returns: String|None
+        """
+        if not params.closed:
+            return None
+        states = instance_window_states(
+            params.start, params.end, host=params.host,
+            metadata=bool(params.metadata or params.group_by_metadata)
+        )
+        return usage_etag.make_etag(req.GET, states)
+
+    def _response(self, body, etag):
+        """Wrap a response body, adding the ETag header if tagged.
+
+        :param body: Dict
+        :param etag: String|None
+        :returns: nova.api.openstack.wsgi.ResponseObject
+        """
+        response = wsgi.ResponseObject(body)
+        if etag is not None:
+            response['ETag'] = usage_etag.header(etag)
+        return response
+
+    def _ledger_usages(self, context, params):
+        """Get tenant usages from the notification ledger if configured.
+
+        :param context: wsgi context
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
+        """
+        return ledger_notifications.ledger_summaries(
+            usage_ledger.get_ledger(CONF.os_usage.ledger_path), 'nova',
+            params, lambda at: self._ledger_resources(context, at)
+        )
+
+    def _index_usages(self, params):
+        """Get tenant usages from the interval index if enabled.
+
+        :param params: os_usage.common.request.UsageParams
+        :returns: List|None - None when the database must be used
+        """
+        return interval_index.index_summaries(
+            CONF.os_usage, 'nova', params, instance_lifetimes
+        )
+
+    def _ledger_resources(self, context, at):
+        """Get the instances active at a time to seed the ledger with.
+
+        :param context: wsgi context
+        :param at: Datetime
+        :returns: List of tuples - (tenant_id, instance uuid, rates)
+        """
+        instances, _flavors = self._get_active_by_window_joined(
+            context, at, at, expected_attrs=['flavor']
+        )
+        return [(instance['project_id'], instance['uuid'],
+                 ledger_notifications.nova_rates(instance))
+                for instance in instances]
+
+    def _host_usages_for_period(
+        self,
+        context,
+        period_start, period_stop,
+        host=None,
+        per_tenant=False,
+        metadata=None,
+        deadline=None
+    ):
+        """Gets instance usages for period grouped by compute host
+
+        All groups are accumulated in a single pass over the instances.
+
+        :param context: wsgi context
+        :param period_start: Datetime
+        :param period_stop: Datetime
+        :param host: String|None - only include this compute host
+        :param per_tenant: Boolean - group by (host, tenant) instead of host
+        :param metadata: Dict|None
+        :param deadline: os_usage.common.deadline.Deadline|None
+        """
+        instances, flavors = self._get_active_by_window_joined(
+            context, period_start, period_stop, host=host,
+            expected_attrs=['flavor'], metadata=metadata, deadline=deadline
+        )
+        rows = [aggregate.slim_row(instance, flavor)
+                for instance, flavor in zip(instances, flavors)]
+        if deadline is not None:
+            deadline.check()
+        return self._aggregate(aggregate.host_usages, rows, period_start,
+                               period_stop, per_tenant=per_tenant)
 
     def _tenant_usages_for_period(
         self,
@@ -195,7 +442,11 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         period_start, period_stop,
         tenant_id=None,
         detailed=True,
-        metadata=None
+        metadata=None,
+        host=None,
+        group_by_metadata=None,
+        breakdown=None,
+        deadline=None
     ):
         """Gets instance usages for period by metadata
 
@@ -205,81 +456,46 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         :param tenant_id: String|None
         :param detailed: Boolean
         :param metadata: Dict|None
+        :param host: String|None - only include this compute host
+        :param group_by_metadata: String|None - report one summary per
+            (tenant, value of this metadata key). Instances without the key
+            are reported with a metadata_value of None.
+        :param breakdown: String|None - one of BREAKDOWNS. Report one
+            summary per (tenant, value of this dimension).
+        :param deadline: os_usage.common.deadline.Deadline|None
         """
         instances, flavors = self._get_active_by_window_joined(
-            context, period_start, period_stop, tenant_id,
-            expected_attrs=['flavor'], metadata=metadata
+            context, period_start, period_stop, tenant_id, host=host,
+            expected_attrs=['flavor'], metadata=metadata,
+            group_by_metadata=group_by_metadata, deadline=deadline
+        )
+        group_value_key = None
+        if group_by_metadata:
+            group_value_key = usage_metadata.GROUP_VALUE_KEY
+        rows = [aggregate.slim_row(instance, flavor, group_value_key)
+                for instance, flavor in zip(instances, flavors)]
+        if deadline is not None:
+            deadline.check()
+        return self._aggregate(aggregate.tenant_usages, rows, period_start,
+                               period_stop, detailed=detailed,
+                               group_by_metadata=group_by_metadata,
+                               breakdown=breakdown)
+
+    def _aggregate(self, func, rows, period_start, period_stop, **kwargs):
+        """Aggregate rows, in worker processes when the report is large.
+
+        :param func: Callable - aggregation function of aggregate
+        :param rows: List - see aggregate.slim_row
+        :param period_start: Datetime
+        :param period_stop: Datetime
+        :returns: List - summaries
+        """
+        return aggregate.aggregate(
+            func, rows, period_start, period_stop,
+            processes=CONF.os_usage.aggregate_processes,
+            threshold=CONF.os_usage.aggregate_process_threshold,
+            **kwargs
         )
-        rval = {}
-
-        for instance, flavor in zip(instances, flavors):
-            info = {}
-            info['hours'] = self._hours_for(instance,
-                                            period_start,
-                                            period_stop)
-            if not flavor:
-                info['flavor'] = ''
-            else:
-                info['flavor'] = flavor['name']
-
-            info['instance_id'] = instance['uuid']
-            info['name'] = instance['display_name']
-
-            info['memory_mb'] = instance['memory_mb']
-            info['local_gb'] = instance['root_gb'] + instance['ephemeral_gb']
-            info['vcpus'] = instance['vcpus']
-
-            info['tenant_id'] = instance['project_id']
-
-            # NOTE(mriedem): We need to normalize the start/end times back
-            # to timezone-naive so the response doesn't change after the
-            # conversion to objects.
-            info['started_at'] = \
-                timeutils.normalize_time(instance['launched_at'])
-
-            info['ended_at'] = (
-                timeutils.normalize_time(instance['terminated_at']) if
-                instance['terminated_at'] else None
-            )
-
-            if info['ended_at']:
-                info['state'] = 'terminated'
-            else:
-                info['state'] = instance['vm_state']
-
-            now = timeutils.utcnow()
-
-            if info['state'] == 'terminated':
-                delta = info['ended_at'] - info['started_at']
-            else:
-                delta = now - info['started_at']
-
-            info['uptime'] = delta.days * 24 * 3600 + delta.seconds
-
-            if info['tenant_id'] not in rval:
-                summary = {}
-                summary['tenant_id'] = info['tenant_id']
-                if detailed:
-                    summary['server_usages'] = []
-                summary['total_local_gb_usage'] = 0
-                summary['total_vcpus_usage'] = 0
-                summary['total_memory_mb_usage'] = 0
-                summary['total_hours'] = 0
-                summary['start'] = timeutils.normalize_time(period_start)
-                summary['stop'] = timeutils.normalize_time(period_stop)
-                rval[info['tenant_id']] = summary
-
-            summary = rval[info['tenant_id']]
-            summary['total_local_gb_usage'] += info['local_gb'] * info['hours']
-            summary['total_vcpus_usage'] += info['vcpus'] * info['hours']
-            summary['total_memory_mb_usage'] += (info['memory_mb'] *
-                                                 info['hours'])
-
-            summary['total_hours'] += info['hours']
-            if detailed:
-                summary['server_usages'].append(info)
-
-        return rval.values()
 
     def _get_active_by_window_joined(
         self,
@@ -289,7 +505,9 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         host=None,
         expected_attrs=None,
         use_slave=False,
-        metadata=None
+        metadata=None,
+        group_by_metadata=None,
+        deadline=None
     ):
         """Get instances and joins active during a certain time window.
 
@@ -304,17 +522,23 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         in the database layer when querying for instances
         :param use_slave if True, ship this query off to a DB slave
         :param metadata: Optional dictionary of metadata
+        :param group_by_metadata: Optional metadata key to group by
+        :param deadline: Optional deadline of the query
         :returns: InstanceList
         """
         # NOTE(mriedem): We have to convert the datetime objects to string
         # primitives for the remote call.
         begin = timeutils.isotime(begin)
         end = timeutils.isotime(end) if end else None
-        return self.__get_active_by_window_joined(context, begin, end,
-                                                  project_id, host,
-                                                  expected_attrs,
-                                                  use_slave=use_slave,
-                                                  metadata=metadata)
+        return self.__get_active_by_window_joined(
+            context, begin, end,
+            project_id, host,
+            expected_attrs,
+            use_slave=use_slave,
+            metadata=metadata,
+            group_by_metadata=group_by_metadata,
+            deadline=deadline
+        )
 
     def __get_active_by_window_joined(
         self,
@@ -324,7 +548,9 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         host=None,
         expected_attrs=None,
         use_slave=False,
-        metadata=None
+        metadata=None,
+        group_by_metadata=None,
+        deadline=None
     ):
         """Second to bottom most database layer"""
         # NOTE(mriedem): We need to convert the begin/end timestamp strings
@@ -333,10 +559,40 @@ class ComplexTenantUsageController(SimpleTenantUsageController):
         end = timeutils.parse_isotime(end) if end else None
         db_inst_list = instance_get_active_by_window_joined(
             context, begin, end, project_id, host,
-            columns_to_join=_expected_cols(expected_attrs), metadata=metadata)
+            columns_to_join=_expected_cols(expected_attrs), metadata=metadata,
+            group_by_metadata=group_by_metadata, deadline=deadline)
         return db_inst_list
 
 
+class ComplexTenantUsageJobsController(wsgi.Controller):
+    """Report jobs of the complex tenant usage reports."""
+
+    def __init__(self):
+        super(ComplexTenantUsageJobsController, self).__init__()
+        self.usage = ComplexTenantUsageController()
+
+    @wsgi.response(202)
+    @extensions.expected_errors((400, 404))
+    def create(self, req, body=None):
+        """Submit a report job with the query parameters of a report."""
+        context = req.environ['nova.context']
+        authorize(context, action="list")
+        params = self.usage._params(req)
+        job = usage_jobs.submit(
+            CONF.os_usage, context.project_id, req.GET,
+            lambda: self.usage._job_report(context, params)
+        )
+        return {'job': job}
+
+    @extensions.expected_errors(404)
+    def show(self, req, id):
+        """Get the status of a report job, and its result once done."""
+        context = req.environ['nova.context']
+        authorize(context, action="list")
+        return {'job': usage_jobs.show(CONF.os_usage, context.project_id,
+                                       id)}
+
+
 class ComplexTenantUsage(extensions.V21APIExtensionBase):
     """Complex tenant usage extension."""
 
@@ -351,6 +607,10 @@ class ComplexTenantUsage(extensions.V21APIExtensionBase):
                                            ComplexTenantUsageController())
         resources.append(res)
 
+        res = extensions.ResourceExtension(JOBS_ALIAS,
+                                           ComplexTenantUsageJobsController())
+        resources.append(res)
+
         return resources
 
     def get_controller_extensions(self):
@@ -1,6 +1,7 @@
 import datetime
 
 from clients import ClientManager
+from common.store import UsageStore
 from common.usages import Usages
 
 
@@ -14,10 +15,11 @@ kwargs = {
 }
 
 clients = ClientManager(**kwargs)
-end = datetime.datetime.now()
+end = datetime.datetime.utcnow()
 start = end - datetime.timedelta(days=21)
 
-usages = Usages(clients, glance=True, cinder=True, nova=True)
+store = UsageStore('usage-store.sqlite')
+usages = Usages(clients, glance=True, cinder=True, nova=True, store=store)
 usages.get_usages(start, end)
 
 for tenant_id, tenant_usage in usages:
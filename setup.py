@@ -15,13 +15,27 @@ setup(
         'os_usage.common',
         'os_usage.glance',
         'os_usage.cinder',
+        'os_usage.ledger',
         'os_usage.nova'
     ],
     package_data={'os_usage': ['os_usage/*']},
+    extras_require={
+        'arrow': ['pyarrow'],
+        'analytics': ['pandas'],
+        'cli': ['PyYAML'],
+        'ledger': ['oslo.messaging']
+    },
     long_description=("Set of plugins for reporting on openstack "
                       "resource usage."),
     entry_points="""
     [nova.api.v21.extensions]
     {0} = {1}
+
+    [console_scripts]
+    os-usage = os_usage.cli:main
+    os-usage-ledger = os_usage.ledger.service:main
+
+    [oslo.config.opts]
+    os_usage = os_usage.common.config:list_opts
     """.format(nova_usage_alias, nova_usage_class)
 )
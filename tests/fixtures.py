@@ -0,0 +1,58 @@
+"""
+Models and helpers shared by the tests querying a small volume database.
+"""
+import datetime
+
+from sqlalchemy import Boolean
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+Base = declarative_base()
+
+T0 = datetime.datetime(2016, 1, 1)
+
+
+def at(hours):
+    return T0 + datetime.timedelta(hours=hours)
+
+
+class Volume(Base):
+    __tablename__ = 'volumes'
+    id = Column(String(36), primary_key=True)
+    project_id = Column(String(255))
+    size = Column(Integer)
+    status = Column(String(255))
+    bootable = Column(Boolean)
+    launched_at = Column(DateTime)
+    terminated_at = Column(DateTime)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    deleted_at = Column(DateTime)
+
+
+class VolumeMetadata(Base):
+    __tablename__ = 'volume_metadata'
+    id = Column(Integer, primary_key=True)
+    volume_id = Column(String(36))
+    key = Column(String(255))
+    value = Column(String(255))
+    deleted_at = Column(DateTime)
+
+
+def make_session(rows=()):
+    """Create an in memory database holding rows.
+
+    :param rows: Iterable of model instances
+    :returns: sqlalchemy.orm.Session
+    """
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(list(rows))
+    session.commit()
+    return session
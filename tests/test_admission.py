@@ -0,0 +1,81 @@
+import collections
+import datetime
+import threading
+import time
+import unittest
+
+import mock
+
+from webob import exc
+
+from os_usage.common import admission
+
+Params = collections.namedtuple('Params', ['start', 'end', 'detailed'])
+
+T0 = datetime.datetime(2016, 1, 1)
+DAY = Params(T0, T0 + datetime.timedelta(days=1), False)
+MONTH = Params(T0, T0 + datetime.timedelta(days=31), False)
+DETAILED_WEEK = Params(T0, T0 + datetime.timedelta(days=7), True)
+
+
+class TestAdmission(unittest.TestCase):
+    """Unit tests for usage query admission control"""
+
+    def test_cost_class(self):
+        """Tests window length and detail set the cost class."""
+        control = admission.Admission(heavy_cost=720, detailed_factor=5)
+        self.assertEquals(control.cost(DAY), 24)
+        self.assertEquals(control.cost_class(DAY), admission.LIGHT)
+        self.assertEquals(control.cost_class(MONTH), admission.HEAVY)
+        self.assertEquals(control.cost(DETAILED_WEEK), 840)
+        self.assertEquals(control.cost_class(DETAILED_WEEK), admission.HEAVY)
+
+    def test_reject(self):
+        """Tests queries over a limit are rejected with Retry-After."""
+        control = admission.Admission(max_queries=2, max_heavy_queries=1,
+                                      retry_after=7)
+        with control.admit(MONTH):
+            try:
+                with control.admit(MONTH):
+                    self.fail("Second heavy query admitted.")
+            except exc.HTTPTooManyRequests as e:
+                self.assertEquals(e.code, 429)
+                self.assertEquals(e.headers['Retry-After'], '7')
+            # The heavy limit leaves room for a light query
+            with control.admit(DAY):
+                self.assertRaises(exc.HTTPTooManyRequests,
+                                  control.admit(DAY).__enter__)
+        # Slots are given back on exit
+        with control.admit(MONTH):
+            pass
+        self.assertEquals(control.slots.active, 0)
+        self.assertEquals(control.class_slots[admission.HEAVY].active, 0)
+
+    def test_queue(self):
+        """Tests a queued query runs once a slot is given back."""
+        control = admission.Admission(max_queries=1, queue_timeout=5)
+        admitted = []
+
+        def run():
+            with control.admit(DAY):
+                admitted.append(time.time())
+
+        with control.admit(DAY):
+            thread = threading.Thread(target=run)
+            thread.start()
+            time.sleep(0.05)
+            self.assertEquals(admitted, [])
+        thread.join(5)
+        self.assertEquals(len(admitted), 1)
+
+    def test_get_admission(self):
+        """Tests workers share one admission control per configuration."""
+        conf = mock.Mock(max_usage_queries=3, max_heavy_usage_queries=1,
+                         heavy_usage_cost=720.0,
+                         detailed_usage_cost_factor=4.0,
+                         usage_queue_timeout=0.0, usage_retry_after=10)
+        control = admission.get_admission(conf)
+        self.assertTrue(admission.get_admission(conf) is control)
+        self.assertEquals(control.slots.limit, 3)
+        conf.max_usage_queries = 4
+        self.assertFalse(admission.get_admission(conf) is control)
@@ -0,0 +1,221 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from os_usage.nova import aggregate
+
+try:
+    import eventlet
+except ImportError:
+    eventlet = None
+
+
+START = datetime.datetime(2016, 1, 1)
+STOP = datetime.datetime(2016, 1, 2)
+
+
+def make_row(uuid, project_id, host='h1', flavor='m1.small', hours=24):
+    launched_at = STOP - datetime.timedelta(hours=hours)
+    instance = {
+        'uuid': uuid,
+        'display_name': uuid,
+        'memory_mb': 512,
+        'root_gb': 1,
+        'ephemeral_gb': 1,
+        'vcpus': 2,
+        'project_id': project_id,
+        'host': host,
+        'launched_at': launched_at,
+        'terminated_at': None,
+        'vm_state': 'active',
+        'extra': object()
+    }
+    return aggregate.slim_row(instance, {'name': flavor})
+
+
+ROWS = [
+    make_row('a', 't1', hours=12),
+    make_row('b', 't1', host='h2', flavor='m1.large'),
+    make_row('c', 't2'),
+    make_row('d', 't3', hours=6),
+    make_row('e', 't4', host='h2')
+]
+
+
+# Aggregates ROWS in worker processes after eventlet's monkey patching,
+# printing the total vcpu usage of each tenant and how often another green
+# thread ran meanwhile. The alarm ends a deadlock.
+GREEN_SCRIPT = """
+import signal
+signal.alarm(60)
+import eventlet
+eventlet.monkey_patch()
+import json
+from os_usage.nova import aggregate
+from tests import test_aggregate as t
+ticks = [0]
+def tick():
+    while True:
+        ticks[0] += 1
+        eventlet.sleep(0)
+eventlet.spawn(tick)
+summaries = aggregate.aggregate(aggregate.tenant_usages, t.ROWS, t.START,
+                                t.STOP, processes=2, threshold=1,
+                                detailed=False)
+print(json.dumps({
+    'ticks': ticks[0],
+    'usage': dict((s['tenant_id'], s['total_vcpus_usage'])
+                  for s in summaries)
+}))
+"""
+
+
+def by_key(summaries, *fields):
+    return dict((tuple(summary.get(field) for field in fields), summary)
+                for summary in summaries)
+
+
+class TestAggregate(unittest.TestCase):
+    """Unit tests for nova usage aggregation"""
+
+    def test_tenant_usages(self):
+        """Tests per tenant totals and details."""
+        summaries = by_key(
+            aggregate.aggregate(aggregate.tenant_usages, ROWS, START, STOP),
+            'tenant_id'
+        )
+        t1 = summaries[('t1',)]
+        self.assertEquals(t1['total_hours'], 36.0)
+        self.assertEquals(t1['total_vcpus_usage'], 72.0)
+        self.assertEquals(len(t1['server_usages']), 2)
+        self.assertFalse('extra' in ROWS[0])
+
+    def test_breakdown(self):
+        """Tests flavor breakdown summaries."""
+        summaries = by_key(
+            aggregate.aggregate(aggregate.tenant_usages, ROWS, START, STOP,
+                                detailed=False, breakdown='flavor'),
+            'tenant_id', 'flavor'
+        )
+        self.assertEquals(summaries[('t1', 'm1.large')]['total_hours'], 24.0)
+        self.assertFalse('server_usages' in summaries[('t1', 'm1.small')])
+
+    def test_host_usages(self):
+        """Tests per host counts."""
+        summaries = by_key(
+            aggregate.aggregate(aggregate.host_usages, ROWS, START, STOP),
+            'host'
+        )
+        self.assertEquals(summaries[('h1',)]['instance_count'], 3)
+        self.assertEquals(summaries[('h2',)]['total_hours'], 48.0)
+
+    def test_shard(self):
+        """Tests rows of one tenant land in one shard."""
+        shards = aggregate.shard(ROWS, 3)
+        self.assertEquals(sum(len(rows) for rows in shards), len(ROWS))
+        t1_shards = [i for i, rows in enumerate(shards)
+                     for row in rows if row['project_id'] == 't1']
+        self.assertEquals(len(t1_shards), 2)
+        self.assertEquals(t1_shards[0], t1_shards[1])
+
+    def test_merge(self):
+        """Tests merged partial summaries equal a single pass."""
+        args = (START, STOP, STOP)
+        partials = [aggregate.tenant_usages(rows, *args)
+                    for rows in (ROWS[:1], ROWS[1:])]
+        merged = aggregate.merge(partials)
+        single = aggregate.tenant_usages(ROWS, *args)
+        self.assertEquals(sorted(merged), sorted(single))
+        self.assertEquals(merged[('t1',)]['total_hours'],
+                          single[('t1',)]['total_hours'])
+        self.assertEquals(len(merged[('t1',)]['server_usages']), 2)
+
+    def test_pack(self):
+        """Tests packed rows are rebuilt unchanged."""
+        rows = [dict(row) for row in ROWS]
+        rows[0]['terminated_at'] = STOP - datetime.timedelta(microseconds=1)
+        self.assertEquals(aggregate.unpack(aggregate.pack(rows)), rows)
+
+    def test_processes(self):
+        """Tests aggregation in worker processes matches in process."""
+        in_process = by_key(
+            aggregate.aggregate(aggregate.tenant_usages, ROWS, START, STOP,
+                                detailed=False, breakdown='flavor'),
+            'tenant_id', 'flavor'
+        )
+        pooled = by_key(
+            aggregate.aggregate(aggregate.tenant_usages, ROWS, START, STOP,
+                                processes=2, threshold=1, detailed=False,
+                                breakdown='flavor'),
+            'tenant_id', 'flavor'
+        )
+        self.assertEquals(sorted(pooled), sorted(in_process))
+        for key, summary in in_process.items():
+            self.assertEquals(pooled[key]['total_vcpus_usage'],
+                              summary['total_vcpus_usage'])
+
+    def test_pool_reused(self):
+        """Tests reports share the workers until the pool is closed."""
+        aggregate.close_pool()
+        for _ in range(2):
+            aggregate.aggregate(aggregate.host_usages, ROWS, START, STOP,
+                                processes=2, threshold=1)
+            self.assertEquals(len(aggregate._pool.workers), 2)
+        pool = aggregate._pool
+        processes = [worker.process for worker in pool.workers]
+        aggregate.close_pool()
+        self.assertTrue(aggregate._pool is None)
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+    def test_worker_exited(self):
+        """Tests a report fails when a worker dies and the next succeeds."""
+        aggregate.close_pool()
+        aggregate.aggregate(aggregate.host_usages, ROWS, START, STOP,
+                            processes=2, threshold=1)
+        worker = aggregate._pool.workers[0]
+        worker.process.terminate()
+        worker.process.join()
+        self.assertRaises(RuntimeError, aggregate._exchange,
+                          aggregate._pool.workers, aggregate.host_usages,
+                          ROWS, (START, STOP, STOP), {})
+        summaries = by_key(
+            aggregate.aggregate(aggregate.host_usages, ROWS, START, STOP,
+                                processes=2, threshold=1),
+            'host'
+        )
+        self.assertEquals(summaries[('h1',)]['instance_count'], 3)
+        aggregate.close_pool()
+
+    def test_detailed_in_process(self):
+        """Tests detailed reports are not sent to the workers."""
+        aggregate.close_pool()
+        summaries = aggregate.aggregate(aggregate.tenant_usages, ROWS, START,
+                                        STOP, processes=2, threshold=1)
+        self.assertTrue(aggregate._pool is None)
+        self.assertEquals(sum(len(summary['server_usages'])
+                              for summary in summaries), len(ROWS))
+
+    @unittest.skipIf(eventlet is None, "eventlet is not installed")
+    def test_processes_green(self):
+        """Tests aggregation in worker processes under eventlet."""
+        in_process = dict(
+            (summary['tenant_id'], summary['total_vcpus_usage'])
+            for summary in aggregate.aggregate(aggregate.tenant_usages, ROWS,
+                                               START, STOP, detailed=False)
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p]
+        )
+        proc = subprocess.Popen([sys.executable, '-c', GREEN_SCRIPT],
+                                cwd=root, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEquals(proc.returncode, 0, err)
+        result = json.loads(out.decode('utf-8').splitlines()[-1])
+        self.assertEquals(result['usage'], in_process)
+        self.assertTrue(result['ticks'] > 0)
@@ -0,0 +1,80 @@
+import datetime
+import unittest
+
+from os_usage.common import analytics
+from os_usage.common.usages import Usages
+from tests.test_export import make_usages
+
+
+@unittest.skipIf(analytics.pandas is None, "pandas is not installed")
+class TestAnalytics(unittest.TestCase):
+    """Unit tests for the DataFrame analytics layer"""
+
+    def test_metrics_frame(self):
+        """Tests metrics become one column per metric."""
+        frame = make_usages().to_frame('metrics')
+        self.assertEquals(frame.loc['tenant', 'nova-total_hours'], 2.0)
+
+    def test_rollups(self):
+        """Tests group-bys sum the derived usage columns."""
+        frame = make_usages().to_frame('resources')
+        self.assertEquals(
+            analytics.by_flavor(frame).loc['m1.small', 'vcpu_hours'], 2.0
+        )
+        self.assertEquals(
+            analytics.by_tenant(frame).loc[('tenant', 'glance'), 'gb_hours'],
+            1.0
+        )
+        self.assertEquals(list(analytics.by_day(frame).index.names),
+                          ['service', 'day'])
+        top = analytics.top_n(frame, n=1, column='gb_hours', by=None)
+        self.assertEquals(list(top['resource_id']), ['server-id'])
+
+    def test_by_day(self):
+        """Tests usage is split across the days a resource ran on."""
+        usages = Usages(None)
+        usages.add_usage_dict({
+            'tenant': {
+                'metrics': {'total_hours': 42.0},
+                'resource_usages': [{
+                    'instance_id': 'split',
+                    'hours': 42.0,
+                    'vcpus': 2,
+                    'started_at': '2016-01-01T12:00:00',
+                    'ended_at': '2016-01-03T06:00:00'
+                }, {
+                    'instance_id': 'running',
+                    'hours': 12.0,
+                    'vcpus': 1,
+                    'started_at': '2016-01-02T12:00:00',
+                    'ended_at': None
+                }, {
+                    'instance_id': 'midnight',
+                    'hours': 0.0,
+                    'vcpus': 1,
+                    'started_at': '2016-01-03T00:00:00',
+                    'ended_at': '2016-01-03T00:00:00'
+                }]
+            }
+        }, 'nova')
+        frame = usages.to_frame('resources')
+        days = analytics.by_day(frame,
+                                end=datetime.datetime(2016, 1, 3, 12))
+        self.assertEquals(self.per_day(days, 'hours'),
+                          {1: 12.0, 2: 24.0 + 6.0, 3: 6.0 + 6.0})
+        self.assertEquals(self.per_day(days, 'vcpu_hours'),
+                          {1: 24.0, 2: 48.0 + 6.0, 3: 12.0 + 6.0})
+
+        # Clipped to 18 of its 42 hours, the split server's usage is shared
+        # out over what is left.
+        days = analytics.by_day(frame,
+                                start=datetime.datetime(2016, 1, 2, 12),
+                                end=datetime.datetime(2016, 1, 3, 12))
+        hours = self.per_day(days, 'hours')
+        self.assertEquals(sorted(hours), [2, 3])
+        self.assertAlmostEqual(hours[2], 28.0 + 6.0)
+        self.assertAlmostEqual(hours[3], 14.0 + 6.0)
+
+    def per_day(self, days, column):
+        return dict((day.day, value)
+                    for (service, day), value in days[column].items())
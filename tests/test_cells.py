@@ -0,0 +1,116 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import String
+from sqlalchemy import create_engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from os_usage.nova import aggregate
+from os_usage.nova import cells
+
+
+Base = declarative_base()
+
+START = datetime.datetime(2016, 1, 1)
+STOP = datetime.datetime(2016, 1, 2)
+
+
+class Instance(Base):
+    __tablename__ = 'instances'
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(36))
+    display_name = Column(String(255))
+    memory_mb = Column(Integer)
+    root_gb = Column(Integer)
+    ephemeral_gb = Column(Integer)
+    vcpus = Column(Integer)
+    project_id = Column(String(255))
+    host = Column(String(255))
+    launched_at = Column(DateTime)
+    terminated_at = Column(DateTime)
+    vm_state = Column(String(255))
+
+
+def query_rows(session, begin, end):
+    rows = []
+    query = session.query(Instance).filter(Instance.launched_at < end)
+    for instance in query:
+        instance = dict((column.name, getattr(instance, column.name))
+                        for column in Instance.__table__.columns)
+        rows.append(aggregate.slim_row(instance, {'name': 'm1.small'}))
+    return rows
+
+
+class TestCells(unittest.TestCase):
+    """Unit tests for the cell database fan out"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.connections = []
+        cell_rows = [
+            [('a', 't1'), ('b', 't2')],
+            [('c', 't1')],
+            [('d', 't3')]
+        ]
+        for i, rows in enumerate(cell_rows):
+            connection = 'sqlite:///' + os.path.join(self.tmp,
+                                                     'cell%d.db' % i)
+            engine = create_engine(connection)
+            Base.metadata.create_all(engine)
+            engine.execute(Instance.__table__.insert(), [
+                {'uuid': uuid, 'display_name': uuid, 'memory_mb': 512,
+                 'root_gb': 1, 'ephemeral_gb': 0, 'vcpus': 1,
+                 'project_id': project_id, 'host': 'cell%d' % i,
+                 'launched_at': START, 'terminated_at': None,
+                 'vm_state': 'active'}
+                for uuid, project_id in rows
+            ])
+            engine.dispose()
+            self.connections.append(connection)
+        self.cells = cells.CellDatabases(self.connections)
+
+    def tearDown(self):
+        self.cells.dispose()
+        shutil.rmtree(self.tmp)
+
+    def test_map(self):
+        """Tests every cell is queried concurrently and in order."""
+        threads = set()
+
+        def query(session, begin, end):
+            threads.add(threading.current_thread().ident)
+            return query_rows(session, begin, end)
+
+        results = self.cells.map(query, START, STOP)
+        self.assertEquals([[row['uuid'] for row in rows] for rows in results],
+                          [['a', 'b'], ['c'], ['d']])
+        self.assertFalse(threading.current_thread().ident in threads)
+
+    def test_merged_usages(self):
+        """Tests tenants spread across cells are merged."""
+        rows = []
+        for cell_rows in self.cells.map(query_rows, START, STOP):
+            rows.extend(cell_rows)
+        summaries = dict(
+            (summary['tenant_id'], summary) for summary in
+            aggregate.aggregate(aggregate.tenant_usages, rows, START, STOP)
+        )
+        self.assertEquals(sorted(summaries), ['t1', 't2', 't3'])
+        self.assertEquals(summaries['t1']['total_hours'], 48.0)
+        self.assertEquals(
+            sorted(info['host'] for info in summaries['t1']['server_usages']),
+            ['cell0', 'cell1']
+        )
+
+    def test_get_cells(self):
+        """Tests cell databases are shared between calls."""
+        first = cells.get_cells(self.connections)
+        self.assertTrue(cells.get_cells(list(self.connections)) is first)
+        self.assertFalse(cells.get_cells(self.connections[:1]) is first)
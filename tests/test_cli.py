@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import six
+
+from os_usage import cli
+
+
+NOVA = {'t1': {'metrics': {'total_hours': 2.0}, 'resource_usages': []}}
+CINDER = {
+    't1': {
+        'metrics': {'total_gb_usage': 5.0},
+        'resource_usages': [{'volume_id': 'v1', 'hours': 1.0, 'size': 5}]
+    }
+}
+
+
+class FakeUsages(object):
+    received_bytes = {'nova': 120, 'cinder': 80}
+
+    def iter_service_usages(self, start, end, metadata=None, detailed=False,
+                            split=1, concurrency=None):
+        self.window = (start, end)
+        yield ('nova', NOVA, 0.5)
+        yield ('cinder', CINDER, 0.25)
+
+
+class TestCli(unittest.TestCase):
+    """Unit tests for the os-usage command line interface"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_cli(self, argv):
+        args = cli.build_parser().parse_args(argv)
+        usages = FakeUsages()
+        out = six.StringIO()
+        err = six.StringIO()
+        cli.collect(args, usages, out, err)
+        return usages, out.getvalue(), err.getvalue()
+
+    def test_auth_from_env(self):
+        """Tests auth options are read from OS_* variables."""
+        args = cli.build_parser().parse_args([])
+        args.os_cloud = None
+        kwargs = cli.auth_kwargs(args, {'OS_AUTH_URL': 'http://keystone',
+                                        'OS_USERNAME': 'admin',
+                                        'OS_PASSWORD': ''})
+        self.assertEquals(kwargs, {'auth_url': 'http://keystone',
+                                   'username': 'admin'})
+        self.assertRaises(cli.CliError, cli.auth_kwargs, args, {})
+
+    def test_auth_from_clouds_yaml(self):
+        """Tests auth options are read from clouds.yaml."""
+        path = os.path.join(self.tmp, 'clouds.yaml')
+        with open(path, 'w') as f:
+            f.write("clouds:\n"
+                    "  lab:\n"
+                    "    region_name: RegionOne\n"
+                    "    auth:\n"
+                    "      auth_url: http://keystone\n"
+                    "      project_name: admin\n")
+        self.assertEquals(
+            cli.load_cloud('lab', paths=('missing.yaml', path)),
+            {'auth_url': 'http://keystone', 'project_name': 'admin'}
+        )
+        self.assertRaises(cli.CliError, cli.load_cloud, 'other',
+                          paths=(path,))
+
+    def test_jsonl(self):
+        """Tests metric rows are written per service with a profile."""
+        usages, out, err = self.run_cli(
+            ['--format', 'jsonl', '--days', '2', '--profile']
+        )
+        rows = [json.loads(line) for line in out.splitlines()]
+        self.assertEquals(rows, [
+            {'tenant_id': 't1', 'metric': 'nova-total_hours', 'value': 2.0},
+            {'tenant_id': 't1', 'metric': 'cinder-total_gb_usage',
+             'value': 5.0}
+        ])
+        self.assertEquals((usages.window[1] - usages.window[0]).days, 2)
+        self.assertEquals(err.splitlines()[0],
+                          'nova: 0.500s, 1 tenants, 0 resources, 120 bytes')
+
+    def test_csv_resources(self):
+        """Tests resource rows as csv."""
+        usages, out, err = self.run_cli(['--format', 'csv', '--resources'])
+        lines = out.splitlines()
+        self.assertEquals(lines[0].split(',')[:3],
+                          ['tenant_id', 'service', 'resource_id'])
+        self.assertEquals(lines[1].split(',')[:3], ['t1', 'cinder', 'v1'])
+        self.assertEquals(len(lines), 2)
+        self.assertEquals(err, '')
+
+    def test_table(self):
+        """Tests table columns are aligned."""
+        usages, out, err = self.run_cli(['--start', '2016-01-01'])
+        lines = out.splitlines()
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(lines[1].index('nova'), lines[0].index('metric'))
+
+    def test_invalid_window(self):
+        """Tests the start must come before the end."""
+        self.assertRaises(cli.CliError, self.run_cli,
+                          ['--start', '2016-01-02', '--end', '2016-01-01'])
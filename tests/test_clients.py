@@ -68,6 +68,41 @@ class TestClients(unittest.TestCase):
         mocked_session.assert_called_once_with(auth=FAKE_LOADER)
         self.assertEquals(clients.session, 'session')
 
+    @mock.patch(
+        'os_usage.clients.session.Session',
+        return_value='session'
+    )
+    @mock.patch(
+        'os_usage.clients.loading.get_plugin_loader',
+        return_value=FAKE_LOADER
+    )
+    def test_get_session_token_cache(self, mocked_loader, mocked_session):
+        """Tests get_session reuses a cached token."""
+        clients = self.create_manager()
+        clients.token_cache = mock.Mock()
+        clients.token_cache.load.return_value = True
+        clients.get_session()
+        clients.token_cache.load.assert_called_once_with(FAKE_LOADER)
+        self.assertFalse(clients.token_cache.save.called)
+
+    @mock.patch(
+        'os_usage.clients.session.Session',
+        return_value='session'
+    )
+    def test_get_session_token_cache_miss(self, mocked_session):
+        """Tests get_session authenticates and saves on a cache miss."""
+        auth = mock.Mock()
+        loader = mock.Mock()
+        loader.load_from_options.return_value = auth
+        clients = self.create_manager()
+        clients.token_cache = mock.Mock()
+        clients.token_cache.load.return_value = False
+        with mock.patch('os_usage.clients.loading.get_plugin_loader',
+                        return_value=loader):
+            clients.get_session()
+        auth.get_access.assert_called_once_with('session')
+        clients.token_cache.save.assert_called_once_with(auth)
+
     def test_get_session_old(self):
         """Tests get_session with an existing session"""
         clients = self.create_manager()
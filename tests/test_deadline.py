@@ -0,0 +1,123 @@
+import time
+import unittest
+
+import mock
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import text
+from webob import exc
+
+from os_usage.common import deadline
+from tests.fixtures import Volume
+from tests.fixtures import make_session
+
+# Counts far enough to run for minutes when not interrupted.
+SLOW_QUERY = text(
+    'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c '
+    'WHERE x < 1000000000) SELECT max(x) AS x FROM c'
+)
+
+
+def make_params(timeout=None):
+    return mock.Mock(timeout=timeout)
+
+
+def make_conf(usage_timeout=0.0, max_usage_timeout=0.0):
+    return mock.Mock(usage_timeout=usage_timeout,
+                     max_usage_timeout=max_usage_timeout)
+
+
+class TestDeadline(unittest.TestCase):
+    """Unit tests for usage query deadlines"""
+
+    def setUp(self):
+        self.session = make_session(
+            [Volume(id='v{0}'.format(i), size=i) for i in range(1, 6)]
+        )
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_from_params(self):
+        """Tests the request timeout overrides the service up to a cap."""
+        self.assertEquals(
+            deadline.from_params(make_conf(), make_params()).seconds, None
+        )
+        self.assertEquals(
+            deadline.from_params(make_conf(30), make_params()).seconds, 30
+        )
+        self.assertEquals(
+            deadline.from_params(make_conf(30), make_params(5)).seconds, 5
+        )
+        self.assertEquals(
+            deadline.from_params(make_conf(30, 60),
+                                 make_params(600)).seconds,
+            60
+        )
+        self.assertEquals(
+            deadline.from_params(make_conf(0, 60), make_params()).seconds, 60
+        )
+
+    def test_iter_rows(self):
+        """Tests rows are returned within the deadline."""
+        query = self.session.query(Volume.size).order_by(Volume.size)
+        for limit in (None, deadline.Deadline(), deadline.Deadline(60)):
+            self.assertEquals(
+                [row.size for row in deadline.iter_rows(self.session, query,
+                                                      limit)],
+                [1, 2, 3, 4, 5]
+            )
+
+    def test_batches(self):
+        """Tests the deadline is checked between batches of rows."""
+        limit = deadline.Deadline(60)
+        query = self.session.query(Volume.size).order_by(Volume.size)
+        rows = []
+        try:
+            for row in deadline.iter_rows(self.session, query, limit,
+                                          batch_size=2):
+                rows.append(row.size)
+                limit.expires = time.time() - 1
+            self.fail("Deadline not checked.")
+        except deadline.DeadlineExceeded as e:
+            self.assertEquals(e.seconds, 60)
+        self.assertEquals(rows, [1, 2])
+
+    def test_statement_interrupted(self):
+        """Tests a running statement is aborted at the deadline."""
+        limit = deadline.Deadline(0.2)
+        query = self.session.query(Column('x', Integer)).from_statement(
+            SLOW_QUERY
+        )
+        started = time.time()
+        self.assertRaises(deadline.DeadlineExceeded, list,
+                          deadline.iter_rows(self.session, query, limit))
+        self.assertTrue(time.time() - started < 10)
+        # The connection is usable again once the session is rolled back
+        self.session.rollback()
+        self.assertEquals(self.session.query(Volume).count(), 5)
+
+    def test_postgresql_timeout(self):
+        """Tests the PostgreSQL timeout ends with the aborted transaction."""
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+
+        def run():
+            with deadline._statement_timeout(connection,
+                                             deadline.Deadline(2)):
+                raise RuntimeError("canceling statement due to timeout")
+        self.assertRaises(RuntimeError, run)
+        self.assertEquals(connection.execute.call_count, 1)
+        statement = str(connection.execute.call_args[0][0])
+        self.assertTrue(
+            statement.startswith('SET LOCAL statement_timeout = '),
+            statement
+        )
+
+    def test_enforce(self):
+        """Tests an exceeded deadline becomes a 504."""
+        def run():
+            with deadline.enforce(deadline.Deadline(1)):
+                raise deadline.DeadlineExceeded(1)
+        self.assertRaises(exc.HTTPGatewayTimeout, run)
@@ -0,0 +1,75 @@
+import unittest
+
+import webob
+
+from os_usage.common import etag
+from tests.fixtures import Volume
+from tests.fixtures import at
+from tests.fixtures import make_session
+
+
+class TestEtag(unittest.TestCase):
+    """Unit tests for the report validators"""
+
+    def setUp(self):
+        self.session = make_session([
+            Volume(id='v1', project_id='t1', launched_at=at(0),
+                   updated_at=at(0)),
+            Volume(id='v2', project_id='t2', launched_at=at(0),
+                   terminated_at=at(2), updated_at=at(2), deleted_at=at(2)),
+            Volume(id='v3', project_id='t1', launched_at=at(5),
+                   updated_at=at(5))
+        ])
+
+    def tearDown(self):
+        self.session.close()
+
+    def state(self, begin, end, criteria=()):
+        return etag.window_state(self.session, Volume, 'launched_at',
+                                 'terminated_at', begin, end, criteria)
+
+    def test_window_state(self):
+        """Tests only rows active during the window are counted."""
+        self.assertEquals(self.state(at(1), at(3)), (2, at(2), at(2)))
+        self.assertEquals(self.state(at(3), at(4)), (1, at(0), None))
+        self.assertEquals(
+            self.state(at(0), at(9), [Volume.project_id == 't1']),
+            (2, at(5), None)
+        )
+        self.assertEquals(etag.table_state(self.session, Volume),
+                          (3, at(5), at(2)))
+
+    def test_make_etag(self):
+        """Tests tags change with the parameters and the state."""
+        state = self.state(at(1), at(3))
+        tag = etag.make_etag({'start': 'a', 'end': 'b'}, [state])
+        self.assertEquals(
+            tag, etag.make_etag({'end': 'b', 'start': 'a'}, [state])
+        )
+        self.assertNotEquals(
+            tag, etag.make_etag({'start': 'a', 'end': 'c'}, [state])
+        )
+
+        volume = self.session.query(Volume).filter_by(project_id='t2').one()
+        volume.updated_at = at(10)
+        self.session.commit()
+        self.assertNotEquals(
+            tag,
+            etag.make_etag({'start': 'a', 'end': 'b'},
+                           [self.state(at(1), at(3))])
+        )
+
+    def test_not_modified(self):
+        """Tests If-None-Match is honored."""
+        tag = etag.make_etag({}, [])
+        req = webob.Request.blank('/usages', headers={
+            'If-None-Match': '"other", ' + etag.header(tag)
+        })
+        self.assertTrue(etag.not_modified(req, tag))
+        self.assertFalse(etag.not_modified(req, None))
+        self.assertFalse(etag.not_modified(req, 'other2'))
+        self.assertFalse(
+            etag.not_modified(webob.Request.blank('/usages'), tag)
+        )
+        req = webob.Request.blank('/usages', headers={'If-None-Match': '*'})
+        self.assertTrue(etag.not_modified(req, tag))
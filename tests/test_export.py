@@ -0,0 +1,88 @@
+import csv
+import unittest
+
+from six import BytesIO
+from six import StringIO
+from six import PY2
+
+from os_usage.common import export
+from os_usage.common.usages import Usages
+
+
+def make_usages():
+    usages = Usages(None)
+    usages.add_usage_dict({
+        'tenant': {
+            'metrics': {'total_hours': 2.0},
+            'resource_usages': [{
+                'instance_id': 'server-id',
+                'name': 'server',
+                'flavor': 'm1.small',
+                'state': 'active',
+                'hours': 2.0,
+                'local_gb': 20,
+                'vcpus': 1,
+                'memory_mb': 2048,
+                'started_at': '2016-01-01T00:00:00',
+                'ended_at': None
+            }]
+        }
+    }, 'nova')
+    usages.add_usage_dict({
+        'tenant': {
+            'metrics': {'total_gb_hours': 1.0},
+            'resource_usages': [{
+                'id': 'image-id',
+                'name': 'image',
+                'status': 'active',
+                'hours': 2.0,
+                'size': 512 * 1024 * 1024,
+                'started_at': '2016-01-01T00:00:00',
+                'ended_at': None
+            }]
+        }
+    }, 'glance')
+    return usages
+
+
+class TestExport(unittest.TestCase):
+    """Unit tests for the usage exporters"""
+
+    def read_csv(self, write):
+        fileobj = BytesIO() if PY2 else StringIO()
+        write(make_usages(), fileobj)
+        fileobj.seek(0)
+        return list(csv.reader(fileobj))
+
+    def test_metrics_to_csv(self):
+        """Tests one row is written per tenant metric."""
+        rows = self.read_csv(export.metrics_to_csv)
+        self.assertEquals(rows[0], list(export.METRIC_COLUMNS))
+        self.assertEquals(sorted(rows[1:]), [
+            ['tenant', 'glance-total_gb_hours', '1.0'],
+            ['tenant', 'nova-total_hours', '2.0']
+        ])
+
+    def test_resources_to_csv(self):
+        """Tests resource rows are mapped onto the fixed columns."""
+        rows = self.read_csv(export.resources_to_csv)
+        self.assertEquals(rows[0], list(export.RESOURCE_COLUMNS))
+        by_service = dict((row[1], dict(zip(rows[0], row)))
+                          for row in rows[1:])
+        self.assertEquals(by_service['nova']['resource_id'], 'server-id')
+        self.assertEquals(by_service['nova']['size_gb'], '20.0')
+        self.assertEquals(by_service['nova']['flavor'], 'm1.small')
+        self.assertEquals(by_service['glance']['resource_id'], 'image-id')
+        self.assertEquals(by_service['glance']['size_gb'], '0.5')
+
+    def test_iter_batches(self):
+        """Tests rows are grouped into bounded batches."""
+        batches = list(export.iter_batches(range(5), batch_size=2))
+        self.assertEquals(batches, [[0, 1], [2, 3], [4]])
+
+    @unittest.skipIf(export.pyarrow is None, "pyarrow is not installed")
+    def test_resource_batches(self):
+        """Tests resource usages are converted to record batches."""
+        batches = list(export.resource_batches(make_usages()))
+        self.assertEquals(sum(batch.num_rows for batch in batches), 2)
+        self.assertEquals(batches[0].schema, export.resource_schema())
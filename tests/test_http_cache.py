@@ -0,0 +1,161 @@
+import datetime
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from os_usage.common import http_cache
+from os_usage.nova import client
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+        if body is not None:
+            self.headers['Content-Length'] = str(len(json.dumps(body)))
+        if etag is not None:
+            self.headers['ETag'] = etag
+
+    def json(self):
+        return self.body
+
+
+class FakeHttpClient(object):
+    """Serves one body tagged with an etag, honoring If-None-Match."""
+    def __init__(self, body, etag='"v1"'):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None):
+        headers = headers or {}
+        self.requests.append((url, headers))
+        if self.etag is not None and \
+                headers.get('If-None-Match') == self.etag:
+            return FakeResponse(304), None
+        return FakeResponse(200, self.body, self.etag), self.body
+
+
+class FakeApi(object):
+    def __init__(self, http_client):
+        self.client = http_client
+
+
+def decode(resp, body):
+    return dict(body)
+
+
+class TestResponseCache(unittest.TestCase):
+    """Unit tests for the usage response cache"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_cache_key(self):
+        """Tests query parameter order does not matter."""
+        self.assertEquals(http_cache.cache_key('/usages?b=2&a=1'),
+                          http_cache.cache_key('/usages?a=1&b=2'))
+        self.assertNotEquals(http_cache.cache_key('/usages?a=1'),
+                             http_cache.cache_key('/usages?a=2'))
+
+    def test_memory(self):
+        """Tests least recently used entries are evicted."""
+        cache = http_cache.ResponseCache(max_entries=2)
+        cache.put('a', '"1"', {'t': 1})
+        cache.put('b', '"2"', {'t': 2})
+        cache.get('a')
+        cache.put('c', '"3"', {'t': 3})
+        self.assertEquals(cache.get('a'), ('"1"', {'t': 1}))
+        self.assertTrue(cache.get('b') is None)
+
+    def test_disk(self):
+        """Tests entries are shared through the directory."""
+        cache = http_cache.ResponseCache(self.path)
+        cache.put('/usages?a=1', '"1"', {'t1': {'metrics': {}}})
+        files = os.listdir(self.path)
+        self.assertEquals(len(files), 1)
+        mode = os.stat(os.path.join(self.path, files[0])).st_mode
+        self.assertEquals(stat.S_IMODE(mode), 0o600)
+
+        other = http_cache.ResponseCache(self.path)
+        self.assertEquals(other.get('/usages?a=1'),
+                          ('"1"', {'t1': {'metrics': {}}}))
+        other.clear()
+        self.assertTrue(
+            http_cache.ResponseCache(self.path).get('/usages?a=1') is None
+        )
+
+    def test_cached_get(self):
+        """Tests tagged responses are revalidated and reused."""
+        cache = http_cache.ResponseCache()
+        http_client = FakeHttpClient({'t1': 1})
+        first = http_cache.cached_get(cache, http_client, '/usages?a=1',
+                                      decode)
+        second = http_cache.cached_get(cache, http_client, '/usages?a=1',
+                                       decode)
+        self.assertEquals(first, {'t1': 1})
+        self.assertTrue(second is first)
+        self.assertEquals(http_client.requests[1][1],
+                          {'If-None-Match': '"v1"'})
+
+        http_client.etag = '"v2"'
+        http_client.body = {'t1': 2}
+        self.assertEquals(
+            http_cache.cached_get(cache, http_client, '/usages?a=1', decode),
+            {'t1': 2}
+        )
+
+    def test_counter(self):
+        """Tests received body bytes are counted, none for a 304."""
+        cache = http_cache.ResponseCache()
+        http_client = FakeHttpClient({'t1': 1})
+        counter = http_cache.ByteCounter()
+        for _ in range(2):
+            http_cache.cached_get(cache, http_client, '/usages', decode,
+                                  counter)
+        self.assertEquals(counter.total, len('{"t1": 1}'))
+
+    def test_response_bytes(self):
+        """Tests the read content is measured without Content-Length."""
+        resp = FakeResponse(200)
+        self.assertEquals(http_cache.response_bytes(resp), 0)
+        resp.content = b'{"t1": 1}'
+        self.assertEquals(http_cache.response_bytes(resp), 9)
+        resp.headers['Content-Length'] = '4'
+        self.assertEquals(http_cache.response_bytes(resp), 4)
+
+    def test_untagged(self):
+        """Tests untagged responses are not stored."""
+        cache = http_cache.ResponseCache()
+        http_client = FakeHttpClient({'t1': 1}, etag=None)
+        http_cache.cached_get(cache, http_client, '/usages', decode)
+        http_cache.cached_get(cache, http_client, '/usages', decode)
+        self.assertEquals(http_client.requests[1][1], {})
+        self.assertEquals(
+            http_cache.cached_get(None, http_client, '/usages', decode),
+            {'t1': 1}
+        )
+
+    def test_nova_client(self):
+        """Tests the nova usage client revalidates through the cache."""
+        http_client = FakeHttpClient({'tenant_usages': [
+            {'tenant_id': 't1', 'total_hours': 2.0}
+        ]})
+        usage_client = client.UsageClient(FakeApi(http_client),
+                                          cache=http_cache.ResponseCache())
+        start = datetime.datetime(2016, 1, 1)
+        end = datetime.datetime(2016, 1, 2)
+        first = usage_client.list(start, end)
+        self.assertEquals(first['t1']['metrics']['total_hours'], 2.0)
+        self.assertTrue(usage_client.list(start, end) is first)
+        self.assertEquals(len(http_client.requests), 2)
+        self.assertEquals(usage_client.received.total,
+                          len(json.dumps(http_client.body)))
@@ -0,0 +1,159 @@
+import datetime
+import random
+import unittest
+
+import mock
+
+from os_usage.common import interval_index
+from os_usage.common import request
+from tests.fixtures import Volume
+from tests.fixtures import at
+from tests.fixtures import make_session
+
+
+def overlap(begin, end, start, stop):
+    """Hours a lifetime overlaps a window, computed directly."""
+    end = stop if end is None else min(end, stop)
+    return max(0.0, (end - max(begin, start)).total_seconds() / 3600.0)
+
+
+class TestIntervalIndex(unittest.TestCase):
+    """Unit tests for the in process interval index"""
+
+    def test_usage(self):
+        """Tests window usage matches summing overlaps of every lifetime."""
+        rand = random.Random(7)
+        index = interval_index.IntervalIndex('cinder')
+        lifetimes = []
+        for i in range(300):
+            begin = at(rand.randint(0, 1000))
+            end = None
+            if rand.random() < 0.7:
+                end = begin + datetime.timedelta(hours=rand.randint(0, 300))
+            lifetimes.append(('t{0}'.format(i % 7), 'v{0}'.format(i), begin,
+                              end, [1.0, float(rand.randint(1, 50))], None))
+        index.update(lifetimes)
+
+        for _ in range(50):
+            start = at(rand.randint(-100, 1100))
+            stop = start + datetime.timedelta(hours=rand.randint(1, 500))
+            expected = {}
+            for tenant_id, _id, begin, end, rates, _changed in lifetimes:
+                if begin >= stop or (end is not None and end <= start):
+                    continue
+                hours = overlap(begin, end, start, stop)
+                totals = expected.setdefault(tenant_id, [0.0, 0.0])
+                totals[0] += hours
+                totals[1] += hours * rates[1]
+            usage = index.usage(start, stop)
+            self.assertEquals(sorted(usage), sorted(expected))
+            for tenant_id, totals in expected.items():
+                self.assertAlmostEqual(usage[tenant_id]['total_hours'],
+                                       totals[0], places=4)
+                self.assertAlmostEqual(usage[tenant_id]['total_gb_usage'],
+                                       totals[1], places=3)
+
+    def test_changes(self):
+        """Tests changed lifetimes replace earlier ones."""
+        index = interval_index.IntervalIndex('cinder')
+        index.update([('t1', 'v1', at(0), None, [1.0, 10.0], at(0))])
+        self.assertEquals(index.usage(at(0), at(10))['t1']['total_hours'], 10)
+        index.update([('t1', 'v1', at(0), at(4), [1.0, 10.0], at(4))])
+        self.assertEquals(index.usage(at(0), at(10))['t1']['total_hours'], 4)
+        self.assertEquals(index.usage(at(5), at(10)), {})
+        index.update([('t2', 'v1', at(0), at(4), [1.0, 10.0], at(5))])
+        self.assertEquals(list(index.usage(at(0), at(10))), ['t2'])
+        self.assertEquals(index.since, at(5))
+
+        summary = index.summaries(at(0), at(2))[0]
+        self.assertEquals(summary['project_id'], 't2')
+        self.assertEquals(summary['total_gb_usage'], 20)
+        self.assertEquals(summary['stop'], at(2))
+
+
+class TestLoadLifetimes(unittest.TestCase):
+    """Tests lifetimes are loaded and refreshed from a table"""
+
+    def setUp(self):
+        self.session = make_session([
+            Volume(id='v1', project_id='t1', size=10, launched_at=at(0),
+                   created_at=at(0)),
+            Volume(id='v2', project_id='t2', size=5, launched_at=at(1),
+                   terminated_at=at(3), created_at=at(1), updated_at=at(1),
+                   deleted_at=at(3)),
+            Volume(id='v3', project_id='t2', size=5, created_at=at(2))
+        ])
+        self.conf = mock.Mock(interval_index=True, interval_index_refresh=0)
+
+    def tearDown(self):
+        self.session.close()
+        interval_index._indexes.clear()
+
+    def load(self, since=None):
+        return interval_index.load_lifetimes(
+            self.session, Volume, 'cinder', 'id', 'project_id',
+            'launched_at', 'terminated_at', ('size',), since
+        )
+
+    def params(self, query):
+        return request.UsageParams(dict(
+            [('start', '2016-01-01T00:00:00'),
+             ('end', '2016-01-01T10:00:00')] + query
+        ))
+
+    def test_load(self):
+        """Tests lifetimes carry rates and the latest change."""
+        lifetimes = dict((row[1], row) for row in self.load())
+        self.assertEquals(lifetimes['v1'][2:],
+                          (at(0), None, [1.0, 10.0], at(0)))
+        self.assertEquals(lifetimes['v2'][5], at(3))
+        self.assertEquals(sorted(row[1] for row in self.load(at(2))),
+                          ['v2', 'v3'])
+
+    def test_index_summaries(self):
+        """Tests requests are answered and the index kept fresh."""
+        summaries = interval_index.index_summaries(
+            self.conf, 'cinder', self.params([]), self.load
+        )
+        totals = dict((s['project_id'], s['total_gb_usage'])
+                      for s in summaries)
+        self.assertEquals(totals, {'t1': 100, 't2': 10})
+
+        volume = self.session.query(Volume).get('v1')
+        volume.terminated_at = at(5)
+        volume.updated_at = at(5)
+        self.session.commit()
+        load = mock.Mock(side_effect=self.load)
+        summaries = interval_index.index_summaries(
+            self.conf, 'cinder', self.params([]), load
+        )
+        load.assert_called_once_with(
+            at(3) - datetime.timedelta(seconds=interval_index.REFRESH_MARGIN)
+        )
+        totals = dict((s['project_id'], s['total_gb_usage'])
+                      for s in summaries)
+        self.assertEquals(totals, {'t1': 50, 't2': 10})
+
+    def test_late_rows(self):
+        """Tests rows committed late with earlier stamps are picked up."""
+        interval_index.index_summaries(self.conf, 'cinder', self.params([]),
+                                       self.load)
+        late = at(3) - datetime.timedelta(minutes=2)
+        self.session.add(Volume(id='v4', project_id='t3', size=1,
+                                launched_at=late, created_at=late))
+        self.session.commit()
+        summaries = interval_index.index_summaries(
+            self.conf, 'cinder', self.params([]), self.load
+        )
+        self.assertEquals(sorted(s['project_id'] for s in summaries),
+                          ['t1', 't2', 't3'])
+
+    def test_database_requests(self):
+        """Tests detailed requests and a disabled index use the database."""
+        self.assertTrue(interval_index.index_summaries(
+            self.conf, 'cinder', self.params([('detailed', '1')]), self.load
+        ) is None)
+        self.conf.interval_index = False
+        self.assertTrue(interval_index.index_summaries(
+            self.conf, 'cinder', self.params([]), self.load
+        ) is None)
@@ -0,0 +1,161 @@
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+import mock
+
+from webob import exc
+
+from os_usage.common import job_client
+from os_usage.common import jobs
+from os_usage.glance import client as glance_client
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class FakeHttpClient(object):
+    """Serves report jobs that finish after a number of polls."""
+    def __init__(self, result, polls=1, status=job_client.DONE):
+        self.result = result
+        self.polls = polls
+        self.status = status
+        self.requests = []
+
+    def post(self, url):
+        self.requests.append(('POST', url))
+        return FakeResponse({'job': {'id': 'abc', 'status': 'queued'}}), None
+
+    def get(self, url):
+        self.requests.append(('GET', url))
+        job = {'id': 'abc', 'status': 'running', 'error': None}
+        self.polls -= 1
+        if self.polls <= 0:
+            job['status'] = self.status
+            if self.status == job_client.DONE:
+                job['result'] = self.result
+            else:
+                job['error'] = 'boom'
+        return FakeResponse({'job': job}), None
+
+
+class FakeGlance(object):
+    def __init__(self, http_client):
+        self.http_client = http_client
+
+
+def wait(runner, job_id):
+    for _ in range(500):
+        job, _expires = runner.store.get(job_id)
+        if job['status'] in (jobs.DONE, jobs.FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("Job did not finish.")
+
+
+class TestJobs(unittest.TestCase):
+    """Unit tests for the report job store and runner"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'jobs')
+        self.conf = mock.Mock(job_path=self.path, job_workers=1,
+                              job_expiry=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_store(self):
+        """Tests jobs are kept in owner only files until they expire."""
+        store = jobs.JobStore(self.path, expiry=60)
+        job = store.create('p1', {'start': '2016-01-01T00:00:00'})
+        path = os.path.join(self.path, job['id'] + '.json')
+        self.assertEquals(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        found, expires = jobs.JobStore(self.path).get(job['id'])
+        self.assertEquals(found['status'], jobs.QUEUED)
+        self.assertEquals(found['params'], {'start': '2016-01-01T00:00:00'})
+        self.assertTrue(store.get('../' + job['id']) is None)
+
+        old = time.time() - 120
+        os.utime(path, (old, old))
+        self.assertTrue(store.get(job['id']) is None)
+        store.purge()
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_run(self):
+        """Tests submitted jobs are computed in the background."""
+        result = {'tenant_usages': [
+            {'tenant_id': 't1', 'start': datetime.datetime(2016, 1, 1)}
+        ]}
+        view = jobs.submit(self.conf, 'p1', {'detailed': '1'},
+                           lambda: result)
+        self.assertTrue(view['status'] in (jobs.QUEUED, jobs.RUNNING,
+                                           jobs.DONE))
+        wait(jobs.get_runner(self.conf), view['id'])
+
+        view = jobs.show(self.conf, 'p1', view['id'])
+        self.assertEquals(view['status'], jobs.DONE)
+        self.assertEquals(view['result'], {'tenant_usages': [
+            {'tenant_id': 't1', 'start': '2016-01-01T00:00:00.000000'}
+        ]})
+        self.assertTrue(view['finished_at'] >= view['created_at'])
+        self.assertRaises(exc.HTTPNotFound, jobs.show, self.conf, 'p2',
+                          view['id'])
+
+    def test_failed(self):
+        """Tests a failing report is recorded without its traceback."""
+        def fail():
+            raise RuntimeError("secret details")
+        view = jobs.submit(self.conf, 'p1', {}, fail)
+        job = wait(jobs.get_runner(self.conf), view['id'])
+        self.assertEquals(job['status'], jobs.FAILED)
+        self.assertEquals(job['error'], "Usage report failed.")
+        self.assertFalse('result' in jobs.show(self.conf, 'p1', view['id']))
+
+    def test_disabled(self):
+        """Tests jobs are not found without a job directory."""
+        self.conf.job_path = None
+        self.assertRaises(exc.HTTPNotFound, jobs.submit, self.conf, 'p1', {},
+                          lambda: {})
+        self.assertRaises(exc.HTTPNotFound, jobs.show, self.conf, 'p1',
+                          'a' * 32)
+
+
+class TestJobClient(unittest.TestCase):
+    """Unit tests for the report job client helpers"""
+
+    def test_wait_for_job(self):
+        """Tests jobs are polled until done and the result translated."""
+        http_client = FakeHttpClient({'tenant_usages': [
+            {'project_id': 't1', 'total_gb_hours': 2.0}
+        ]}, polls=3)
+        usage_client = glance_client.UsageClient(FakeGlance(http_client))
+        job_id = usage_client.submit_job(datetime.datetime(2016, 1, 1),
+                                         datetime.datetime(2017, 1, 1))
+        self.assertEquals(job_id, 'abc')
+        self.assertTrue(
+            http_client.requests[0][1].startswith('/v2/usage_jobs?')
+        )
+        usage = usage_client.wait_for_job(job_id, interval=0)
+        self.assertEquals(usage['t1']['metrics']['total_gb_hours'], 2.0)
+        self.assertEquals(http_client.requests[1:],
+                          [('GET', '/v2/usage_jobs/abc')] * 3)
+
+    def test_failed_and_timeout(self):
+        """Tests failed and unfinished jobs raise."""
+        http_client = FakeHttpClient({}, status=job_client.FAILED)
+        self.assertRaises(job_client.JobFailed, job_client.wait_for_job,
+                          http_client, '/jobs/abc', interval=0)
+        http_client = FakeHttpClient({}, polls=10)
+        self.assertRaises(job_client.JobTimeout, job_client.wait_for_job,
+                          http_client, '/jobs/abc', interval=0.01,
+                          timeout=0.02)
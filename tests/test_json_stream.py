@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import unittest
+
+import mock
+
+from os_usage.common import json_stream
+from os_usage.common.usages import RESOURCES_LAZY
+from os_usage.common.usages import Usages
+from os_usage.glance import client as glance_client
+
+ROWS = [
+    {'project_id': u't1', 'total_gb_hours': 1.5,
+     'image_usages': [{'id': u'i1', 'name': u'a "quoted" [name] {x}'}]},
+    {'project_id': u't2', 'total_gb_hours': 2,
+     'image_usages': [{'id': u'i2', 'name': u'caf\xe9 \\ slash'}]},
+    {'project_id': u't3', 'total_gb_hours': 0, 'image_usages': []}
+]
+BODY = json.dumps({'tenant_usages': ROWS}).encode('utf-8')
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestArrayItemDecoder(unittest.TestCase):
+    """Unit tests for the incremental row decoder"""
+
+    def test_every_split(self):
+        """Tests rows decode the same however the body is split."""
+        for size in (1, 2, 3, 7, 64, len(BODY)):
+            self.assertEquals(
+                list(json_stream.iter_items(chunks(BODY, size),
+                                            'tenant_usages')),
+                ROWS
+            )
+
+    def test_incremental(self):
+        """Tests rows are returned as soon as they are complete."""
+        decoder = json_stream.ArrayItemDecoder('tenant_usages')
+        end = BODY.index(b'"t2"')
+        self.assertEquals(decoder.feed(BODY[:end]), ROWS[:1])
+        self.assertFalse(decoder.done)
+        self.assertEquals(decoder.feed(BODY[end:]), ROWS[1:])
+        self.assertTrue(decoder.done)
+        decoder.close()
+
+    def test_scalars_and_empty(self):
+        """Tests scalar and empty lists."""
+        self.assertEquals(
+            list(json_stream.iter_items(
+                chunks(b'{"a": 1, "rows": [1, "x,]", 2.5, null]}', 3),
+                'rows'
+            )),
+            [1, 'x,]', 2.5, None]
+        )
+        self.assertEquals(
+            list(json_stream.iter_items([b'{"rows": [ ]}'], 'rows')), []
+        )
+
+    def test_raw_key(self):
+        """Tests resource lists are kept raw however the body is split."""
+        for size in (1, 2, 3, 7, 64, len(BODY)):
+            rows = list(json_stream.iter_items(chunks(BODY, size),
+                                               'tenant_usages',
+                                               'image_usages'))
+            self.assertEquals(rows, ROWS)
+            for row in rows:
+                self.assertTrue(isinstance(row['image_usages'],
+                                           json_stream.RawList))
+        self.assertFalse(rows[2]['image_usages'])
+        self.assertEquals(json.loads(rows[0]['image_usages'].text),
+                          ROWS[0]['image_usages'])
+
+    def test_raw_key_as_value(self):
+        """Tests only the list under the raw key is kept raw."""
+        body = (b'{"rows": [{"name": "image_usages", "groups": [1], '
+                b'"image_usages": [{"id": "x"}]}]}')
+        row, = json_stream.iter_items(chunks(body, 4), 'rows',
+                                      'image_usages')
+        self.assertEquals(row['groups'], [1])
+        self.assertEquals(row['name'], 'image_usages')
+        self.assertEquals(row['image_usages'].text, '[{"id": "x"}]')
+
+    def test_raw_key_nested(self):
+        """Tests a raw list holding lists and brackets in strings."""
+        body = (b'{"rows": [{"image_usages": [{"id": "[x]", "tags": '
+                b'[["a", "\\"]"]]}], "name": "y"}]}')
+        for size in (1, 5, len(body)):
+            row, = json_stream.iter_items(chunks(body, size), 'rows',
+                                          'image_usages')
+            self.assertEquals(row['name'], 'y')
+            self.assertEquals(list(row['image_usages']),
+                              [{'id': '[x]', 'tags': [['a', '"]']]}])
+
+    def test_truncated(self):
+        """Tests a truncated body raises ValueError."""
+        self.assertRaises(ValueError, list, json_stream.iter_items(
+            chunks(BODY[:-10], 16), 'tenant_usages'
+        ))
+
+
+class FakeStreamResponse(object):
+    def __init__(self, body):
+        self.body = body
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        return iter(chunks(self.body, chunk_size))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeGlance(object):
+    http_client = object()
+
+
+class TestStreaming(unittest.TestCase):
+    """Tests streamed usages are added tenant by tenant"""
+
+    def test_glance_iter_list(self):
+        """Tests the glance client yields one usage dict per row."""
+        response = FakeStreamResponse(BODY)
+        usage_client = glance_client.UsageClient(FakeGlance())
+        with mock.patch.object(json_stream, 'stream_get',
+                               return_value=response) as stream_get:
+            usage_dicts = list(usage_client.iter_list(
+                datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 2),
+                chunk_size=5
+            ))
+        self.assertEquals([list(d) for d in usage_dicts],
+                          [[u't1'], [u't2'], [u't3']])
+        self.assertEquals(
+            usage_dicts[1][u't2']['metrics']['total_gb_hours'], 2
+        )
+        self.assertTrue(response.closed)
+        self.assertTrue(stream_get.call_args[0][1].startswith('/v2/usages?'))
+        self.assertEquals(usage_client.received.total, len(BODY))
+
+    def test_usages_lazy(self):
+        """Tests lazy streamed resource usages are decoded when read."""
+        usage_client = glance_client.UsageClient(FakeGlance())
+        usages = Usages(None, stream=True, resources=RESOURCES_LAZY)
+        loads = mock.Mock(side_effect=json.loads)
+        with mock.patch.object(json_stream, 'stream_get',
+                               return_value=FakeStreamResponse(BODY)), \
+                mock.patch.object(json_stream.json, 'loads', loads):
+            for usage_dict in usages.iter_list_usages(
+                    'glance', usage_client, datetime.datetime(2016, 1, 1),
+                    datetime.datetime(2016, 1, 2), None, detailed=True):
+                usages.add_usage_dict(usage_dict, 'glance')
+            self.assertEquals(
+                usages.get_tenant_usage(u't2').metrics,
+                {'glance-total_gb_hours': 2.0}
+            )
+            # Only the tenant rows were decoded, never a resource row.
+            self.assertEquals(loads.call_count, len(ROWS))
+            for call in loads.call_args_list:
+                self.assertFalse('"id"' in call[0][0])
+            resource_usages = usages.get_tenant_usage(u't1').resource_usages
+        self.assertEquals(list(resource_usages), ROWS[0]['image_usages'])
+        self.assertEquals(loads.call_count, len(ROWS) + 1)
+
+    def test_usages_stream(self):
+        """Tests Usages streams only without a store or split."""
+        usage_client = mock.Mock()
+        usage_client.iter_list.return_value = iter([
+            {'t1': {'metrics': {'total_hours': 1.0}}},
+            {'t2': {'metrics': {'total_hours': 2.0}}}
+        ])
+        usages = Usages(None, stream=True)
+        self.assertEquals(
+            list(usages.iter_list_usages('nova', usage_client, 's', 'e',
+                                         None)),
+            [{'t1': {'metrics': {'total_hours': 1.0}}},
+             {'t2': {'metrics': {'total_hours': 2.0}}}]
+        )
+        with mock.patch.object(usages, 'list_usages',
+                               return_value={}) as list_usages:
+            self.assertEquals(
+                list(usages.iter_list_usages('nova', usage_client, 's', 'e',
+                                             None, split=2)),
+                [{}]
+            )
+        self.assertTrue(list_usages.called)
@@ -0,0 +1,289 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from os_usage.common import request
+from os_usage.ledger import ledger
+from os_usage.ledger import notifications
+from tests.fixtures import T0
+from tests.fixtures import at
+
+try:
+    import oslo_messaging
+    from oslo_config import cfg
+    from os_usage.common import config as usage_config
+    from os_usage.ledger import service
+except ImportError:
+    oslo_messaging = None
+
+
+class TestLedger(unittest.TestCase):
+    """Unit tests for the usage ledger"""
+
+    def setUp(self):
+        self.ledger = ledger.Ledger(':memory:')
+
+    def tearDown(self):
+        self.ledger.close()
+
+    def test_usage(self):
+        """Tests usage is integrated between events."""
+        self.ledger.apply('cinder', 't1', 'v1', at(0), [1, 10])
+        self.ledger.apply('cinder', 't1', 'v2', at(2), [1, 5])
+        self.ledger.apply('cinder', 't1', 'v1', at(4), None)
+        usage = self.ledger.usage('cinder', at(1), at(6))
+        self.assertEquals(usage['t1']['total_hours'], 3 + 4)
+        self.assertEquals(usage['t1']['total_gb_usage'], 30 + 20)
+
+    def test_resize(self):
+        """Tests a resize changes the rate from the time it happens."""
+        self.ledger.apply('cinder', 't1', 'v1', at(0), [1, 10])
+        self.ledger.apply('cinder', 't1', 'v1', at(1), [1, 20])
+        usage = self.ledger.usage('cinder', at(0), at(2))
+        self.assertEquals(usage['t1']['total_hours'], 2)
+        self.assertEquals(usage['t1']['total_gb_usage'], 30)
+
+    def test_out_of_order(self):
+        """Tests late events never reduce accumulated usage."""
+        self.ledger.apply('cinder', 't1', 'v1', at(0), [1, 10])
+        self.ledger.apply('cinder', 't1', 'v2', at(2), [1, 5])
+        self.ledger.apply('cinder', 't1', 'v2', at(1), None)
+        usage = self.ledger.usage('cinder', at(0), at(3))
+        self.assertEquals(usage['t1']['total_hours'], 3)
+        self.assertEquals(usage['t1']['total_gb_usage'], 30)
+
+    def test_unknown_delete(self):
+        """Tests deleting an unknown resource changes nothing."""
+        self.ledger.apply('glance', 't1', 'i1', at(0), None)
+        self.assertEquals(self.ledger.usage('glance', at(0), at(1)), {})
+
+    def test_tenant_move(self):
+        """Tests a resource moving tenants leaves the old tenant."""
+        self.ledger.apply('cinder', 't1', 'v1', at(0), [1, 10])
+        self.ledger.apply('cinder', 't2', 'v1', at(1), [1, 10])
+        usage = self.ledger.usage('cinder', at(0), at(3))
+        self.assertEquals(usage['t1']['total_hours'], 1)
+        self.assertEquals(usage['t2']['total_hours'], 2)
+
+    def test_seed(self):
+        """Tests seeding replaces the state of one service."""
+        self.ledger.apply('cinder', 't1', 'v1', at(0), [1, 10])
+        self.ledger.apply('glance', 't1', 'i1', at(0), [1, 2])
+        self.assertTrue(self.ledger.seeded_at('cinder') is None)
+        self.ledger.seed('cinder', [('t2', 'v2', [1, 1])], at(5))
+        self.assertEquals(self.ledger.seeded_at('cinder'), at(5))
+        self.assertEquals(self.ledger.usage('cinder', at(5), at(7)),
+                          {'t2': {'total_hours': 2, 'total_gb_usage': 2}})
+        self.assertEquals(
+            self.ledger.usage('glance', at(0), at(1))['t1']['total_gb_hours'],
+            2
+        )
+
+    def test_seed_once(self):
+        """Tests only the first process sharing a ledger seeds it."""
+        tmp = tempfile.mkdtemp()
+        first = ledger.Ledger(os.path.join(tmp, 'ledger.db'))
+        second = ledger.Ledger(os.path.join(tmp, 'ledger.db'))
+        try:
+            self.assertEquals(
+                first.seed_once('cinder', [('t1', 'v1', [1, 10])], at(0)),
+                at(0)
+            )
+            first.apply('cinder', 't1', 'v2', at(1), [1, 5])
+            self.assertEquals(
+                second.seed_once('cinder', [('t2', 'v3', [1, 1])], at(2)),
+                at(0)
+            )
+            self.assertEquals(second.usage('cinder', at(0), at(3)), {
+                't1': {'total_hours': 5, 'total_gb_usage': 40}
+            })
+        finally:
+            first.close()
+            second.close()
+            shutil.rmtree(tmp)
+
+    def test_compact(self):
+        """Tests compaction keeps the usage of later windows."""
+        self.ledger.seed('cinder', [], at(0))
+        for hour in range(10):
+            self.ledger.apply('cinder', 't1', 'v1', at(hour), [1, hour])
+        self.ledger.apply('cinder', 't2', 'v2', at(1), [1, 10])
+        windows = [(at(5), at(12)), (at(4.5), at(9))]
+        expected = [self.ledger.usage('cinder', start, end)
+                    for start, end in windows]
+
+        self.ledger.compact('cinder', at(4.5))
+        self.assertEquals([self.ledger.usage('cinder', start, end)
+                           for start, end in windows], expected)
+        self.assertEquals(self.ledger.seeded_at('cinder'), at(4.5))
+        kept = self.ledger.conn.execute(
+            "SELECT tenant_id, at FROM history ORDER BY tenant_id, at"
+        ).fetchall()
+        self.assertEquals(
+            kept,
+            [('t1', ledger.to_timestamp(at(hour))) for hour in range(4, 10)] +
+            [('t2', ledger.to_timestamp(at(1)))]
+        )
+
+    def test_summaries(self):
+        """Tests summaries are shaped like the service response."""
+        self.ledger.apply('nova', 't1', 'i1', at(0), [1, 2, 512, 10])
+        summaries = self.ledger.summaries('nova', at(0), at(1))
+        self.assertEquals(summaries, [{
+            'tenant_id': 't1',
+            'total_hours': 1,
+            'total_vcpus_usage': 2,
+            'total_memory_mb_usage': 512,
+            'total_local_gb_usage': 10,
+            'start': at(0),
+            'stop': at(1)
+        }])
+
+    def test_get_ledger(self):
+        """Tests ledgers are shared per path."""
+        self.assertTrue(ledger.get_ledger(None) is None)
+        first = ledger.get_ledger(':memory:')
+        self.assertTrue(ledger.get_ledger(':memory:') is first)
+
+
+class TestNotificationEndpoint(unittest.TestCase):
+    """Unit tests for the notification endpoint"""
+
+    def setUp(self):
+        self.ledger = ledger.Ledger(':memory:')
+        self.endpoint = notifications.NotificationEndpoint(self.ledger)
+
+    def tearDown(self):
+        self.ledger.close()
+
+    def info(self, event_type, payload, hours):
+        metadata = {'timestamp': str(at(hours))}
+        self.endpoint.info({}, 'publisher', event_type, payload, metadata)
+
+    def test_nova(self):
+        """Tests instance lifecycle events."""
+        payload = {'tenant_id': 't1', 'instance_id': 'i1', 'vcpus': 1,
+                   'memory_mb': 512, 'root_gb': 1, 'ephemeral_gb': 1,
+                   'launched_at': at(0).isoformat()}
+        self.info('compute.instance.create.end', payload, 0.5)
+        resized = dict(payload, vcpus=2)
+        self.info('compute.instance.finish_resize.end', resized, 1)
+        deleted = dict(resized, terminated_at=at(2).isoformat())
+        self.info('compute.instance.delete.end', deleted, 3)
+        usage = self.ledger.usage('nova', at(0), at(4))['t1']
+        self.assertEquals(usage['total_hours'], 2)
+        self.assertEquals(usage['total_vcpus_usage'], 3)
+        self.assertEquals(usage['total_memory_mb_usage'], 1024)
+        self.assertEquals(usage['total_local_gb_usage'], 4)
+
+    def test_cinder_and_glance(self):
+        """Tests volume and image events."""
+        self.info('volume.create.end',
+                  {'tenant_id': 't1', 'volume_id': 'v1', 'size': 10}, 0)
+        self.info('volume.delete.end',
+                  {'tenant_id': 't1', 'volume_id': 'v1', 'size': 10}, 1)
+        self.info('image.create', {'owner': 't1', 'id': 'i1'}, 0)
+        self.info('image.upload',
+                  {'owner': 't1', 'id': 'i1', 'size': 1024 ** 3}, 1)
+        self.assertEquals(self.ledger.usage('cinder', at(0), at(2)),
+                          {'t1': {'total_hours': 1, 'total_gb_usage': 10}})
+        self.assertEquals(self.ledger.usage('glance', at(0), at(2)),
+                          {'t1': {'total_hours': 2, 'total_gb_hours': 1}})
+
+    def test_ignored(self):
+        """Tests unrelated and incomplete notifications are ignored."""
+        self.info('compute.instance.reboot.end', {'tenant_id': 't1'}, 0)
+        self.info('volume.create.end', {'volume_id': 'v1'}, 0)
+        self.assertEquals(self.ledger.usage('cinder', at(0), at(1)), {})
+
+
+class TestLedgerSummaries(unittest.TestCase):
+    """Unit tests for answering requests from the ledger"""
+
+    def setUp(self):
+        self.ledger = ledger.Ledger(':memory:')
+
+    def tearDown(self):
+        self.ledger.close()
+
+    def params(self, **params):
+        return request.UsageParams(params,
+                                   now=datetime.datetime(2100, 1, 1))
+
+    def test_no_ledger(self):
+        """Tests the database is used without a ledger."""
+        self.assertTrue(notifications.ledger_summaries(
+            None, 'cinder', self.params(), None
+        ) is None)
+
+    def test_grouped(self):
+        """Tests grouped and detailed requests use the database."""
+        load = mock.Mock()
+        for params in ({'detailed': '1'}, {'metadata': '{"a": "b"}'}):
+            self.assertTrue(notifications.ledger_summaries(
+                self.ledger, 'cinder', self.params(**params), load
+            ) is None)
+        self.assertFalse(load.called)
+
+    def test_seed(self):
+        """Tests the ledger is seeded before answering."""
+        load = mock.Mock(return_value=[('t1', 'v1', [1, 10])])
+        before = self.params(start='2016-01-01T00:00:00',
+                             end='2016-01-02T00:00:00')
+        self.assertTrue(notifications.ledger_summaries(
+            self.ledger, 'cinder', before, load
+        ) is None)
+        self.assertEquals(load.call_count, 1)
+        self.assertEquals(
+            self.ledger.usage('cinder', self.ledger.seeded_at('cinder'),
+                              datetime.datetime(2100, 1, 1)).keys(),
+            ['t1']
+        )
+
+        after = self.params(start='2099-01-01T00:00:00',
+                            end='2099-01-02T00:00:00')
+        summaries = notifications.ledger_summaries(
+            self.ledger, 'cinder', after, load
+        )
+        self.assertEquals(load.call_count, 1)
+        self.assertEquals(summaries[0]['project_id'], 't1')
+        self.assertEquals(summaries[0]['total_hours'], 24)
+        self.assertEquals(summaries[0]['total_gb_usage'], 240)
+
+
+@unittest.skipUnless(oslo_messaging, "oslo.messaging is not installed")
+class TestListener(unittest.TestCase):
+    """Tests the listener against the fake transport"""
+
+    def test_listener(self):
+        conf = usage_config.register_opts(cfg.ConfigOpts())
+        conf([])
+        usage_ledger = ledger.Ledger(':memory:')
+        transport = oslo_messaging.get_notification_transport(
+            conf, url='fake:'
+        )
+        listener = service.get_listener(conf, usage_ledger, transport)
+        listener.start()
+        try:
+            notifier = oslo_messaging.Notifier(
+                transport, 'volume.host', driver='messaging',
+                topics=['notifications']
+            )
+            notifier.info({}, 'volume.create.end',
+                          {'tenant_id': 't1', 'volume_id': 'v1', 'size': 1})
+            end = datetime.datetime(2100, 1, 1)
+            for _ in range(100):
+                if usage_ledger.usage('cinder', T0, end):
+                    break
+                time.sleep(0.05)
+            self.assertEquals(usage_ledger.usage('cinder', T0, end).keys(),
+                              ['t1'])
+        finally:
+            listener.stop()
+            listener.wait()
+            usage_ledger.close()
@@ -0,0 +1,134 @@
+import unittest
+
+from os_usage.common import metadata
+from tests.fixtures import T0
+from tests.fixtures import Volume
+from tests.fixtures import VolumeMetadata
+from tests.fixtures import make_session
+
+VOLUME_METADATA = metadata.MetadataTable(VolumeMetadata, Volume,
+                                         foreign_key='volume_id')
+
+
+class MetadataTestCase(unittest.TestCase):
+    """Base class creating a small volume database"""
+
+    def setUp(self):
+        deleted = T0
+        self.session = make_session([
+            Volume(id='v1', project_id='p1', status='available',
+                   bootable=True),
+            Volume(id='v2', project_id='p1', status='in-use',
+                   bootable=False),
+            Volume(id='v3', project_id='p2', status='deleted',
+                   deleted_at=deleted),
+            Volume(id='v4', project_id='p2', status='in-use',
+                   bootable=True),
+            VolumeMetadata(volume_id='v1', key='env', value='prod'),
+            VolumeMetadata(volume_id='v1', key='team', value='a'),
+            VolumeMetadata(volume_id='v2', key='env', value='dev'),
+            VolumeMetadata(volume_id='v3', key='env', value='prod',
+                           deleted_at=deleted),
+            VolumeMetadata(volume_id='v4', key='env', value='prod',
+                           deleted_at=deleted),
+        ])
+
+
+class TestGroupValue(MetadataTestCase):
+    """Unit tests for grouping by a metadata value"""
+
+    def test_add_group_value(self):
+        """Tests each volume gets its value and untagged volumes None."""
+        query = metadata.add_group_value(
+            self.session.query(Volume), VOLUME_METADATA, 'env'
+        )
+        values = dict((volume.id, value) for volume, value in query)
+        self.assertEquals(values, {
+            'v1': 'prod',
+            'v2': 'dev',
+            'v3': 'prod',
+            'v4': None
+        })
+
+
+class TestMetadataFilter(MetadataTestCase):
+    """Unit tests for compiling metadata filters"""
+
+    def matching(self, metadata_filter):
+        query = self.session.query(Volume).filter(
+            metadata.metadata_filter(VOLUME_METADATA, metadata_filter)
+        )
+        return sorted(volume.id for volume in query)
+
+    def test_equals(self):
+        """Tests exact matches, including rows deleted with the volume."""
+        self.assertEquals(self.matching({'env': 'prod'}), ['v1', 'v3'])
+
+    def test_in(self):
+        """Tests list and in operator matches."""
+        self.assertEquals(self.matching({'env': ['prod', 'dev']}),
+                          ['v1', 'v2', 'v3'])
+        self.assertEquals(self.matching({'env': {'in': ['dev']}}), ['v2'])
+
+    def test_not(self):
+        """Tests negation also matches volumes without the key."""
+        self.assertEquals(self.matching({'env': {'not': 'prod'}}),
+                          ['v2', 'v4'])
+
+    def test_exists(self):
+        """Tests existence and absence of a key."""
+        self.assertEquals(self.matching({'team': {'exists': True}}), ['v1'])
+        self.assertEquals(self.matching({'team': {'exists': False}}),
+                          ['v2', 'v3', 'v4'])
+
+    def test_combined(self):
+        """Tests all key conditions must hold."""
+        self.assertEquals(
+            self.matching({'env': ['prod', 'dev'],
+                           'team': {'exists': False}}),
+            ['v2', 'v3']
+        )
+
+    def test_invalid(self):
+        """Tests malformed filters are rejected."""
+        for invalid in ([], {'env': []}, {'env': {'like': 'a'}},
+                        {'env': {'exists': 'yes'}}, {'env': None},
+                        {'env': {'in': ['a'], 'not': ['b']}}):
+            self.assertRaises(metadata.InvalidMetadataFilter,
+                              metadata.validate_filter, invalid)
+
+
+class TestColumnFilter(MetadataTestCase):
+    """Unit tests for compiling filters on resource columns"""
+
+    columns = ('status', 'bootable', 'missing')
+
+    def matching(self, column_filter):
+        query = self.session.query(Volume).filter(
+            metadata.column_filter(Volume, column_filter, self.columns)
+        )
+        return sorted(volume.id for volume in query)
+
+    def test_values(self):
+        """Tests equality, in and not on a string column."""
+        self.assertEquals(self.matching({'status': 'in-use'}), ['v2', 'v4'])
+        self.assertEquals(self.matching({'status': ['available', 'deleted']}),
+                          ['v1', 'v3'])
+        self.assertEquals(self.matching({'status': {'not': 'in-use'}}),
+                          ['v1', 'v3'])
+
+    def test_boolean(self):
+        """Tests boolean columns accept true and false strings."""
+        self.assertEquals(self.matching({'bootable': 'true'}), ['v1', 'v4'])
+        self.assertEquals(self.matching({'bootable': {'not': 'true'}}),
+                          ['v2', 'v3'])
+        self.assertEquals(self.matching({'bootable': {'exists': False}}),
+                          ['v3'])
+
+    def test_invalid(self):
+        """Tests unknown columns and bad boolean values are rejected."""
+        for invalid in ({'project_id': 'p1'}, {'missing': 'a'},
+                        {'bootable': 'maybe'}):
+            self.assertRaises(metadata.InvalidMetadataFilter,
+                              metadata.column_filter, Volume, invalid,
+                              self.columns)
@@ -0,0 +1,113 @@
+import datetime
+import unittest
+
+import mock
+
+from six.moves.urllib import parse
+
+from os_usage.nova import client
+
+RESPONSE = mock.Mock(headers={'Content-Length': '80'})
+
+
+class TestNovaUsageClient(unittest.TestCase):
+    """Unit tests for the nova usage client"""
+
+    def setUp(self):
+        self.client = client.UsageClient(None)
+
+    def make_usage(self, info):
+        return client.Usage(self.client, info, loaded=True)
+
+    def test_hosts_to_dict_per_tenant(self):
+        """Tests host metrics sum the per tenant groups."""
+        usage = self.client.hosts_to_dict([
+            {'host': 'h1', 'tenant_id': 't1', 'instance_count': 1,
+             'total_vcpus_usage': 2.0},
+            {'host': 'h1', 'tenant_id': 't2', 'instance_count': 2,
+             'total_vcpus_usage': 3.0},
+            {'host': 'h2', 'tenant_id': 't1', 'instance_count': 1,
+             'total_vcpus_usage': 1.0}
+        ])
+        self.assertEquals(usage['h1']['metrics']['instance_count'], 3)
+        self.assertEquals(usage['h1']['metrics']['total_vcpus_usage'], 5.0)
+        self.assertEquals(
+            usage['h1']['tenants']['t2']['total_vcpus_usage'], 3.0
+        )
+        self.assertEquals(list(usage['h2']['tenants']), ['t1'])
+
+    def test_hosts_to_dict(self):
+        """Tests host only groups have no tenant breakdown."""
+        usage = self.client.hosts_to_dict([{'host': 'h1',
+                                             'total_hours': 4.0}])
+        self.assertEquals(usage['h1']['metrics']['total_hours'], 4.0)
+        self.assertEquals(usage['h1']['tenants'], {})
+
+    def test_list_hosts(self):
+        """Tests host usages are requested and translated from raw rows."""
+        api = mock.Mock()
+        api.client.get.return_value = (RESPONSE, {'host_usages': [
+            {'host': 'h1', 'tenant_id': 't1', 'total_hours': 2.0}
+        ]})
+        usage_client = client.UsageClient(api)
+        usage = usage_client.list_hosts(
+            datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 2),
+            host='h1', per_tenant=True
+        )
+        self.assertEquals(usage['h1']['tenants']['t1']['total_hours'], 2.0)
+        self.assertEquals(usage_client.received.total, 80)
+        url = api.client.get.call_args[0][0]
+        self.assertTrue(url.startswith(client.USAGE_PATH + '?'))
+        self.assertEquals(
+            dict(parse.parse_qsl(url.split('?', 1)[1])),
+            {'start': '2016-01-01T00:00:00', 'end': '2016-01-02T00:00:00',
+             'group_by': 'host_tenant', 'host': 'h1', 'metadata': '{}'}
+        )
+
+    def test_to_dict_grouped(self):
+        """Tests grouped rows are summed per tenant and kept per group."""
+        usage = self.client.to_dict([
+            self.make_usage({'tenant_id': 't1', 'total_hours': 1.0,
+                             'metadata_key': 'billing_code',
+                             'metadata_value': 'a'}),
+            self.make_usage({'tenant_id': 't1', 'total_hours': 2.0,
+                             'metadata_key': 'billing_code',
+                             'metadata_value': None})
+        ])
+        self.assertEquals(usage['t1']['metrics']['total_hours'], 3.0)
+        groups = dict((group['metadata_value'], group['metrics'])
+                      for group in usage['t1']['groups'])
+        self.assertEquals(groups['a']['total_hours'], 1.0)
+        self.assertEquals(groups[None]['total_hours'], 2.0)
+
+    def test_to_dict_breakdown(self):
+        """Tests flavor breakdown rows are kept per flavor."""
+        usage = self.client.to_dict([
+            self.make_usage({'tenant_id': 't1', 'total_vcpus_usage': 2.0,
+                             'flavor': 'm1.small'}),
+            self.make_usage({'tenant_id': 't1', 'total_vcpus_usage': 8.0,
+                             'flavor': 'm1.large'})
+        ])
+        self.assertEquals(usage['t1']['metrics']['total_vcpus_usage'], 10.0)
+        groups = dict((group['flavor'], group['metrics'])
+                      for group in usage['t1']['groups'])
+        self.assertEquals(groups['m1.large']['total_vcpus_usage'], 8.0)
+        self.assertFalse('metadata_key' in usage['t1']['groups'][0])
+
+    def test_rows_to_dict(self):
+        """Tests raw rows translate like Usage resources."""
+        rows = [
+            {'tenant_id': 't1', 'total_hours': 1.0, 'flavor': 'm1.small',
+             'server_usages': [{'instance_id': 'i1', 'hours': 1.0}]},
+            {'tenant_id': 't1', 'total_hours': 2.0, 'flavor': 'm1.large',
+             'total_vcpus_usage': 4.0, 'server_usages': []},
+            {'tenant_id': 't2', 'total_memory_mb_usage': 512.0}
+        ]
+        self.assertEquals(
+            self.client.rows_to_dict(rows),
+            self.client.to_dict([self.make_usage(row) for row in rows])
+        )
+        usage = self.client.rows_to_dict(rows)
+        self.assertEquals(usage['t1']['metrics']['total_hours'], 3.0)
+        self.assertEquals(usage['t2']['metrics']['total_hours'], 0)
+        self.assertEquals(len(usage['t1']['groups']), 2)
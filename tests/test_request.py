@@ -0,0 +1,157 @@
+import datetime
+import unittest
+
+import webob
+
+from os_usage.common import request
+from tests.fixtures import Volume
+
+
+def make_params(query, **kwargs):
+    req = webob.Request.blank('/usages?' + query)
+    return request.UsageParams.from_request(req, **kwargs)
+
+
+class TestParseDatetime(unittest.TestCase):
+    """Unit tests for the iso 8601 parser"""
+
+    def test_formats(self):
+        """Tests the formats accepted by the old strptime loop."""
+        expected = datetime.datetime(2016, 1, 2, 3, 4, 5, tzinfo=request.UTC)
+        self.assertEquals(
+            request.parse_datetime('2016-01-02T03:04:05'), expected
+        )
+        self.assertEquals(
+            request.parse_datetime('2016-01-02T03:04:05.5'),
+            expected.replace(microsecond=500000)
+        )
+        self.assertEquals(
+            request.parse_datetime('2016-01-02 03:04:05.000001'),
+            expected.replace(microsecond=1)
+        )
+
+    def test_offsets(self):
+        """Tests offsets are converted to utc."""
+        expected = datetime.datetime(2016, 1, 2, 1, 4, 5, tzinfo=request.UTC)
+        self.assertEquals(
+            request.parse_datetime('2016-01-02T03:04:05+02:00'), expected
+        )
+        self.assertEquals(
+            request.parse_datetime('2016-01-01T23:04:05-0200'), expected
+        )
+        self.assertEquals(
+            request.parse_datetime('2016-01-02T01:04:05Z'), expected
+        )
+
+    def test_invalid(self):
+        """Tests malformed and out of range strings."""
+        for dtstr in ('2016-01-02', '2016-13-02T00:00:00', 'yesterday'):
+            self.assertRaises(
+                request.InvalidStrTime, request.parse_datetime, dtstr
+            )
+
+    def test_memoized(self):
+        """Tests repeated strings come from the cache."""
+        first = request.parse_datetime('2016-02-03T00:00:00')
+        self.assertTrue(request.parse_datetime('2016-02-03T00:00:00') is first)
+
+    def test_empty(self):
+        """Tests empty values are the current time."""
+        value = request.parse_datetime(None)
+        self.assertEquals(value.utcoffset(), datetime.timedelta(0))
+
+
+class TestUsageParams(unittest.TestCase):
+    """Unit tests for usage request parameters"""
+
+    def test_params(self):
+        """Tests the parameters shared by the usage controllers."""
+        params = make_params(
+            'start=2016-01-01T00:00:00&end=2016-01-02T00:00:00&detailed=1'
+            '&metadata=%7B%22a%22%3A%20%22b%22%7D&breakdown=flavor&limit=2'
+            '&timeout=2.5',
+            breakdowns=('flavor',)
+        )
+        self.assertEquals(params.start.day, 1)
+        self.assertEquals(params.end.day, 2)
+        self.assertTrue(params.detailed)
+        self.assertEquals(params.metadata, {'a': 'b'})
+        self.assertEquals(params.breakdown, 'flavor')
+        self.assertEquals(params.limit, 2)
+        self.assertEquals(params.marker, None)
+        self.assertEquals(params.timeout, 2.5)
+
+    def test_end_clamped(self):
+        """Tests the end of the period is clamped to now."""
+        params = make_params(
+            'start=2016-01-01T00:00:00&end=2999-01-01T00:00:00'
+        )
+        self.assertTrue(params.end.year < 2999)
+        self.assertFalse(params.closed)
+        params = make_params(
+            'start=2016-01-01T00:00:00&end=2016-01-02T00:00:00'
+        )
+        self.assertTrue(params.closed)
+
+    def test_invalid(self):
+        """Tests invalid parameters raise InvalidRequest."""
+        for query in ('start=2016-01-02T00:00:00&end=2016-01-01T00:00:00',
+                      'start=bad',
+                      'metadata=%5B%5D',
+                      'metadata=notjson',
+                      'breakdown=flavor',
+                      'group_by=host',
+                      'limit=0',
+                      'timeout=-1',
+                      'timeout=soon',
+                      'filters=%7B%22status%22%3A%20%22active%22%7D'):
+            self.assertRaises(request.InvalidRequest, make_params,
+                              'start=2016-01-01T00:00:00&' + query)
+
+    def test_paginate(self):
+        """Tests grouped rows of one key stay on one page."""
+        summaries = [
+            {'tenant_id': 'c'},
+            {'tenant_id': 'a', 'metadata_value': 'x'},
+            {'tenant_id': 'b'},
+            {'tenant_id': 'a', 'metadata_value': 'y'}
+        ]
+        params = make_params('start=2016-01-01T00:00:00&limit=2')
+        page = request.paginate(summaries, 'tenant_id', params)
+        self.assertEquals([s['tenant_id'] for s in page], ['a', 'a', 'b'])
+
+        params = make_params('start=2016-01-01T00:00:00&limit=2&marker=b')
+        page = request.paginate(summaries, 'tenant_id', params)
+        self.assertEquals([s['tenant_id'] for s in page], ['c'])
+
+    def test_filters(self):
+        """Tests column filters are validated against accepted columns."""
+        params = make_params(
+            'start=2016-01-01T00:00:00'
+            '&filters=%7B%22status%22%3A%20%22active%22%7D',
+            filter_columns=('status',)
+        )
+        self.assertEquals(params.filters, {'status': 'active'})
+        self.assertRaises(request.InvalidRequest, make_params,
+                          'start=2016-01-01T00:00:00'
+                          '&filters=%7B%22owner%22%3A%20%22a%22%7D',
+                          filter_columns=('status',))
+
+    def test_filter_values(self):
+        """Tests filter values are checked against the column types."""
+        def with_filters(filters):
+            return make_params(
+                'start=2016-01-01T00:00:00&filters=' + filters,
+                filter_columns=('bootable',), filter_model=Volume
+            )
+        self.assertEquals(
+            with_filters('%7B%22bootable%22%3A%20%22true%22%7D').filters,
+            {'bootable': 'true'}
+        )
+        self.assertRaises(request.InvalidRequest, with_filters,
+                          '%7B%22bootable%22%3A%20%22maybe%22%7D')
+        self.assertEquals(
+            with_filters('%7B%22bootable%22%3A%20%7B%22exists%22%3A%20'
+                         'true%7D%7D').filters,
+            {'bootable': {'exists': True}}
+        )
@@ -0,0 +1,110 @@
+import datetime
+import unittest
+
+import mock
+
+from os_usage.common import store
+from os_usage.common.usages import Usages
+
+
+class FakeUsageClient():
+    """Returns one tenant with one hour of usage per hour of window."""
+    def __init__(self, endpoint='http://nova', project_id='p1'):
+        self.calls = []
+        self.endpoint = endpoint
+        self.project_id = project_id
+
+    def scope(self):
+        return {'endpoint': self.endpoint, 'project_id': self.project_id,
+                'user_id': 'u1'}
+
+    def list(self, start, end, detailed=False, metadata=None):
+        self.calls.append((start, end))
+        hours = (end - start).total_seconds() / 3600.0
+        return {
+            'tenant': {
+                'metrics': {'total_hours': hours},
+                'resource_usages': [{'instance_id': 'a', 'hours': hours}]
+            }
+        }
+
+
+class TestUsageStore(unittest.TestCase):
+    """Unit tests for the usage store"""
+
+    def setUp(self):
+        self.store = store.UsageStore(':memory:')
+        self.start = datetime.datetime(2016, 1, 1)
+        self.end = datetime.datetime(2016, 1, 2)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_get_missing(self):
+        """Tests get for a window that was never stored."""
+        query = store.query_key()
+        self.assertIsNone(
+            self.store.get('nova', query, self.start, self.end)
+        )
+
+    def test_put_get(self):
+        """Tests a stored window round trips."""
+        query = store.query_key({'a': 'b'}, True)
+        usage = {'t': {'metrics': {'total_hours': 1.5},
+                       'resource_usages': []}}
+        self.store.put('nova', query, self.start, self.end, usage)
+        self.assertEquals(
+            self.store.get('nova', query, self.start, self.end), usage
+        )
+        self.assertIsNone(self.store.get(
+            'nova', store.query_key(), self.start, self.end
+        ))
+
+    def test_put_empty(self):
+        """Tests a window without tenants is still recorded."""
+        query = store.query_key()
+        self.store.put('nova', query, self.start, self.end, {})
+        self.assertEquals(
+            self.store.get('nova', query, self.start, self.end), {}
+        )
+
+    def test_list_usages_reuses_closed_windows(self):
+        """Tests only open windows are fetched on a repeated run."""
+        usages = Usages(None, store=self.store)
+        end = datetime.datetime.utcnow()
+        start = end - datetime.timedelta(days=3)
+
+        client = FakeUsageClient()
+        first = usages.list_usages('nova', client, start, end, None)
+        self.assertEquals(len(client.calls), 4)
+
+        client = FakeUsageClient()
+        second = usages.list_usages('nova', client, start, end, None)
+        self.assertEquals(client.calls, [
+            (end.replace(hour=0, minute=0, second=0, microsecond=0), end)
+        ])
+        self.assertAlmostEquals(first['tenant']['metrics']['total_hours'], 72)
+        self.assertAlmostEquals(second['tenant']['metrics']['total_hours'], 72)
+        self.assertEquals(len(second['tenant']['resource_usages']), 1)
+
+    def test_list_usages_scoped(self):
+        """Tests closed windows are not shared across clouds or projects."""
+        usages = Usages(None, store=self.store)
+        end = datetime.datetime.utcnow()
+        start = end - datetime.timedelta(days=2)
+        usages.list_usages('nova', FakeUsageClient(), start, end, None)
+
+        for client in (FakeUsageClient(endpoint='http://other'),
+                       FakeUsageClient(project_id='p2')):
+            usages.list_usages('nova', client, start, end, None)
+            self.assertEquals(len(client.calls), 3)
+
+    def test_client_scope(self):
+        """Tests the scope is read from the keystone session client."""
+        http_client = mock.Mock()
+        http_client.get_endpoint.return_value = 'http://nova'
+        http_client.get_project_id.return_value = 'p1'
+        http_client.get_user_id.return_value = 'u1'
+        self.assertEquals(store.client_scope(http_client), {
+            'endpoint': 'http://nova', 'project_id': 'p1', 'user_id': 'u1'
+        })
@@ -0,0 +1,103 @@
+import datetime
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from os_usage.common.token_cache import TokenCache
+
+
+class FakeAuthRef():
+    def __init__(self, expires):
+        self.expires = expires
+
+    def will_expire_soon(self, stale_duration):
+        soon = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=stale_duration)
+        return self.expires < soon
+
+
+class FakeAuth():
+    """Mimics the auth state methods of a keystoneauth1 identity plugin."""
+    def __init__(self, cache_id='cache-id', expires_in=3600):
+        self.cache_id = cache_id
+        self.auth_ref = None
+        self.expires_in = expires_in
+
+    def get_cache_id(self):
+        return self.cache_id
+
+    def get_auth_state(self):
+        if self.auth_ref:
+            return json.dumps({'expires_in': self.expires_in})
+
+    def set_auth_state(self, data):
+        if data:
+            expires_in = json.loads(data)['expires_in']
+            self.auth_ref = FakeAuthRef(
+                datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=expires_in)
+            )
+        else:
+            self.auth_ref = None
+
+    def authenticate(self):
+        self.set_auth_state(json.dumps({'expires_in': self.expires_in}))
+
+
+class TestTokenCache(unittest.TestCase):
+    """Unit tests for the token cache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'token.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_missing(self):
+        """Tests load without a cache file."""
+        auth = FakeAuth()
+        self.assertFalse(TokenCache(self.path).load(auth))
+        self.assertIsNone(auth.auth_ref)
+
+    def test_save_and_load(self):
+        """Tests a saved state is installed into a new plugin."""
+        auth = FakeAuth()
+        auth.authenticate()
+        TokenCache(self.path).save(auth)
+
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEquals(mode, 0o600)
+
+        other = FakeAuth()
+        self.assertTrue(TokenCache(self.path).load(other))
+        self.assertIsNotNone(other.auth_ref)
+
+    def test_load_other_credentials(self):
+        """Tests a state saved for other credentials is ignored."""
+        auth = FakeAuth(cache_id='one')
+        auth.authenticate()
+        TokenCache(self.path).save(auth)
+
+        other = FakeAuth(cache_id='two')
+        self.assertFalse(TokenCache(self.path).load(other))
+        self.assertIsNone(other.auth_ref)
+
+    def test_load_expiring(self):
+        """Tests a state expiring within the margin is discarded."""
+        auth = FakeAuth(expires_in=60)
+        auth.authenticate()
+        TokenCache(self.path, margin=300).save(auth)
+
+        other = FakeAuth()
+        self.assertFalse(TokenCache(self.path, margin=300).load(other))
+        self.assertIsNone(other.auth_ref)
+
+    def test_load_corrupt(self):
+        """Tests a corrupt cache file is ignored."""
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertFalse(TokenCache(self.path).load(FakeAuth()))
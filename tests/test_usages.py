@@ -0,0 +1,166 @@
+import mock
+import threading
+import unittest
+
+from os_usage.common.resource_usages import ResourceUsages
+from os_usage.common.usages import DuplicateMetricError
+from os_usage.common.usages import RESOURCES_DROP
+from os_usage.common.usages import RESOURCES_LAZY
+from os_usage.common.usages import TenantUsage
+from os_usage.common.usages import Usages
+
+
+SERVER = {
+    'instance_id': u'abc',
+    'name': u'server',
+    'hours': 1.5,
+    'vcpus': 2,
+    'flavor': u'm1.small',
+    'ended_at': None
+}
+VOLUME = {'volume_id': u'def', 'hours': 2.0, 'size': 10}
+
+
+class TestResourceUsages(unittest.TestCase):
+    """Unit tests for the columnar resource usages container"""
+
+    def test_round_trip(self):
+        """Tests rows come back equal and in order."""
+        rows = [SERVER, VOLUME, dict(SERVER, instance_id=u'xyz')]
+        resource_usages = ResourceUsages(rows)
+        self.assertEquals(len(resource_usages), 3)
+        self.assertEquals(list(resource_usages), rows)
+        self.assertEquals(resource_usages[1], VOLUME)
+        self.assertEquals(resource_usages, rows)
+
+    def test_mixed_column_types(self):
+        """Tests a column falls back when a value does not fit its type."""
+        rows = [{'size': 10}, {'size': None}, {'size': u'big'}]
+        self.assertEquals(list(ResourceUsages(rows)), rows)
+
+    def test_strings_interned(self):
+        """Tests equal strings share one object across containers."""
+        strings = {}
+        first = ResourceUsages([dict(SERVER)], strings=strings)
+        second = ResourceUsages(
+            [dict(SERVER, flavor=u''.join([u'm1.', u'small']))],
+            strings=strings
+        )
+        self.assertIs(first[0]['flavor'], second[0]['flavor'])
+
+
+class TestTenantUsage(unittest.TestCase):
+    """Unit tests for TenantUsage"""
+
+    def test_metrics(self):
+        """Tests schema and other metrics are both iterated."""
+        tenant_usage = TenantUsage('tenant')
+        tenant_usage.add_metric('nova-total_hours', 3)
+        tenant_usage.add_metric('other', 'value')
+        self.assertEquals(tenant_usage.metrics,
+                          {'nova-total_hours': 3.0, 'other': 'value'})
+
+    def test_duplicate_metric(self):
+        """Tests adding a metric twice raises."""
+        tenant_usage = TenantUsage('tenant')
+        tenant_usage.add_metric('nova-total_hours', 3)
+        self.assertRaises(DuplicateMetricError, tenant_usage.add_metric,
+                          'nova-total_hours', 4)
+
+    def test_iadd(self):
+        """Tests += merges metrics and resource usages."""
+        first = TenantUsage('tenant')
+        first.add_metric('nova-total_hours', 1)
+        first.add_resource_usages([SERVER])
+        second = TenantUsage('tenant')
+        second.add_metric('cinder-total_hours', 2)
+        second.add_resource_usages([VOLUME])
+        first += second
+        self.assertEquals(first.metrics, {'nova-total_hours': 1.0,
+                                          'cinder-total_hours': 2.0})
+        self.assertEquals(list(first.resource_usages), [SERVER, VOLUME])
+
+    def test_lazy(self):
+        """Tests lazy rows are converted on first access only."""
+        first = TenantUsage('tenant', resources=RESOURCES_LAZY)
+        first.add_resource_usages([SERVER])
+        second = TenantUsage('tenant', resources=RESOURCES_LAZY)
+        second.add_resource_usages([VOLUME])
+        with mock.patch.object(ResourceUsages, 'extend') as extend:
+            first += second
+            self.assertFalse(extend.called)
+        self.assertEquals(list(first.resource_usages), [SERVER, VOLUME])
+        self.assertTrue(first.resource_usages is first.resource_usages)
+
+    def test_drop(self):
+        """Tests dropped rows keep metrics only."""
+        tenant_usage = TenantUsage('tenant', resources=RESOURCES_DROP)
+        tenant_usage.add_metric('nova-total_hours', 3)
+        tenant_usage.add_resource_usages([SERVER])
+        self.assertEquals(list(tenant_usage),
+                          [('nova-total_hours', 3.0)])
+        self.assertEquals(len(tenant_usage.resource_usages), 0)
+        self.assertRaises(ValueError, TenantUsage, 'tenant',
+                          resources='other')
+        self.assertRaises(ValueError, Usages, None, resources='other')
+
+    def test_add_usage_dict(self):
+        """Tests Usages builds tenant usages from a usage dict."""
+        usages = Usages(None)
+        usages.add_usage_dict({
+            'tenant': {'metrics': {'total_hours': 1.5},
+                       'resource_usages': [SERVER]}
+        }, 'nova')
+        tenant_usage = usages.get_tenant_usage('tenant')
+        self.assertEquals(list(tenant_usage), [('nova-total_hours', 1.5)])
+        self.assertEquals(list(tenant_usage.resource_usages), [SERVER])
+
+    def test_iter_service_usages(self):
+        """Tests services are fetched in parallel and added as they finish."""
+        usages = Usages(mock.Mock(), glance=False)
+
+        def list_usages(service, *args):
+            return {'tenant': {'metrics': {'total_hours': 1.0}}}
+
+        with mock.patch.object(usages, 'list_usages',
+                               side_effect=list_usages):
+            results = list(usages.iter_service_usages(None, None))
+        self.assertEquals(sorted(result[0] for result in results),
+                          ['cinder', 'nova'])
+        self.assertEquals(usages.get_tenant_usage('tenant').metrics,
+                          {'nova-total_hours': 1.0,
+                           'cinder-total_hours': 1.0})
+
+    def test_iter_service_usages_error(self):
+        """Tests an error in a fetch thread is raised to the caller."""
+        usages = Usages(mock.Mock(), glance=False, cinder=False)
+        with mock.patch.object(usages, 'list_usages',
+                               side_effect=ValueError('boom')):
+            self.assertRaises(ValueError, list,
+                              usages.iter_service_usages(None, None))
+
+    def test_iter_service_usages_stopped(self):
+        """Tests fetch threads close their responses when iteration stops."""
+        usages = Usages(mock.Mock(), glance=False)
+        started = {'nova': threading.Event(), 'cinder': threading.Event()}
+        closed = {'nova': threading.Event(), 'cinder': threading.Event()}
+
+        def iter_list_usages(service, *args):
+            # Hold the first usage dict until both fetches run, a fetch
+            # still queued when the pool stops never opens a response.
+            started[service].set()
+            for event in started.values():
+                event.wait(5)
+            try:
+                while True:
+                    yield {'tenant': {'metrics': {'total_hours': 1.0}}}
+            finally:
+                closed[service].set()
+
+        with mock.patch.object(usages, 'iter_list_usages',
+                               side_effect=iter_list_usages):
+            results = usages.iter_service_usages(None, None)
+            next(results)
+            results.close()
+        for service, event in closed.items():
+            self.assertTrue(event.wait(5), service)
@@ -0,0 +1,63 @@
+import datetime
+import unittest
+
+from os_usage.common import usage_dict
+from os_usage.common import windows
+
+
+class TestWindows(unittest.TestCase):
+    """Unit tests for window helpers"""
+
+    def test_day_windows(self):
+        """Tests windows are split at midnight."""
+        start = datetime.datetime(2016, 1, 1, 12)
+        end = datetime.datetime(2016, 1, 3, 6)
+        self.assertEquals(list(windows.day_windows(start, end)), [
+            (start, datetime.datetime(2016, 1, 2)),
+            (datetime.datetime(2016, 1, 2), datetime.datetime(2016, 1, 3)),
+            (datetime.datetime(2016, 1, 3), end)
+        ])
+
+    def test_merge_usage_dicts(self):
+        """Tests metrics are summed and resources collapsed by id."""
+        merged = usage_dict.merge_usage_dicts([
+            {'t': {'metrics': {'total_hours': 1},
+                   'resource_usages': [{'volume_id': 'v', 'hours': 1}]}},
+            {'t': {'metrics': {'total_hours': 2},
+                   'resource_usages': [{'volume_id': 'v', 'hours': 2},
+                                       {'volume_id': 'w', 'hours': 2}]}}
+        ])
+        self.assertEquals(merged['t']['metrics'], {'total_hours': 3})
+        self.assertEquals(merged['t']['resource_usages'], [
+            {'volume_id': 'v', 'hours': 3},
+            {'volume_id': 'w', 'hours': 2}
+        ])
+
+    def test_split_window(self):
+        """Tests a range is split into equal windows covering it."""
+        start = datetime.datetime(2016, 1, 1)
+        end = datetime.datetime(2016, 1, 4)
+        self.assertEquals(windows.split_window(start, end, 3), [
+            (start, datetime.datetime(2016, 1, 2)),
+            (datetime.datetime(2016, 1, 2), datetime.datetime(2016, 1, 3)),
+            (datetime.datetime(2016, 1, 3), end)
+        ])
+
+    def test_fetch_windows(self):
+        """Tests sub windows are fetched in parallel and merged exactly."""
+        start = datetime.datetime(2016, 1, 1)
+        end = datetime.datetime(2016, 4, 1)
+
+        def fetch(window_start, window_end):
+            hours = (window_end - window_start).total_seconds() / 3600.0
+            return {'t': {'metrics': {'total_hours': hours},
+                          'resource_usages': [{'instance_id': 'i',
+                                               'hours': hours}]}}
+
+        merged = windows.fetch_windows(fetch, start, end, 4)
+        hours = (end - start).total_seconds() / 3600.0
+        self.assertAlmostEquals(merged['t']['metrics']['total_hours'], hours)
+        self.assertEquals(len(merged['t']['resource_usages']), 1)
+        self.assertAlmostEquals(
+            merged['t']['resource_usages'][0]['hours'], hours
+        )